@@ -0,0 +1,171 @@
+"""Fair sharing of the server's bandwidth among streams.
+
+Every stream has a token bucket refilled at a multiple of its real-time byte
+rate and starting with a burst allowance, so a render can fill its buffer fast
+and then reads at most that much faster than it plays. Under a global cap the
+bucket rates are the max-min fair shares of it, weighted by priority class:
+streams needing less than their share keep their pace, and what they leave is
+split among the others.
+"""
+
+import heapq
+import itertools
+import logging
+import threading
+from time import monotonic
+
+logger = logging.getLogger("Bandwidth")
+
+PRIORITY_WEIGHTS = {'low': 1, 'normal': 2, 'high': 4}
+DEFAULT_PRIORITY = 'normal'
+UNLIMITED = float('inf')
+
+
+class TokenBucket:
+    """Bytes allowed at rate (bytes/s), up to capacity saved while idle.
+
+    Reservations always succeed and may leave the bucket in debt: the delay
+    returned is how long the caller has to hold back the bytes to keep the rate.
+    """
+
+    def __init__(self, rate, capacity, clock=monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = capacity
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        if self.rate == UNLIMITED:
+            self.tokens = self.capacity
+        else:
+            self.tokens = min(self.capacity,
+                              self.tokens + self.rate * (now - self.updated))
+        self.updated = now
+
+    def set_rate(self, rate):
+        self.refill()
+        self.rate = rate
+
+    def reserve(self, nbytes):
+        """Seconds to wait before nbytes are within the rate"""
+        if self.rate == UNLIMITED:
+            return 0
+
+        self.refill()
+        self.tokens -= nbytes
+        return -self.tokens / self.rate if self.tokens < 0 else 0
+
+
+class Stream:
+    def __init__(self, bucket, byte_rate, weight):
+        self.bucket = bucket
+        self.byte_rate = byte_rate
+        self.weight = weight
+
+
+class BandwidthScheduler:
+    """Token buckets of the open streams, keyed by render, paced at pace times
+    their byte rate with burst seconds of allowance; global_rate (bytes/s, 0 for
+    none) is shared among them by priority weight"""
+
+    def __init__(self, pace=2.0, burst=8.0, global_rate=0, weights=None,
+                 clock=monotonic):
+        self.pace = pace
+        self.burst = burst
+        self.global_rate = global_rate
+        self.weights = {**PRIORITY_WEIGHTS, **(weights or {})}
+        self.clock = clock
+        self.streams = {}  # key -> Stream
+        self.lock = threading.Lock()
+
+    def add(self, key, byte_rate, priority=DEFAULT_PRIORITY):
+        """Start pacing a stream playing byte_rate bytes/s, 0 if unknown"""
+        weight = self.weights.get(priority, self.weights[DEFAULT_PRIORITY])
+        bucket = TokenBucket(UNLIMITED, self.burst * byte_rate, self.clock)
+        with self.lock:
+            self.streams[key] = Stream(bucket, byte_rate, weight)
+            self.rebalance()
+
+    def remove(self, key):
+        with self.lock:
+            if self.streams.pop(key, None):
+                self.rebalance()
+
+    def reserve(self, key, nbytes):
+        """Seconds to hold back nbytes read from the stream; 0 for unknown keys"""
+        with self.lock:
+            stream = self.streams.get(key)
+            return stream.bucket.reserve(nbytes) if stream else 0
+
+    def rates(self):
+        with self.lock:
+            return {key: stream.bucket.rate for key, stream in self.streams.items()}
+
+    def rebalance(self):
+        """Weighted max-min fair rates: streams wanting less than their share of
+        what is left get what they want, the rest split it by weight"""
+        # unpaced streams, or those of unknown rate, only have the global cap
+        wanted = {key: self.pace * stream.byte_rate or UNLIMITED
+                  for key, stream in self.streams.items()}
+
+        rates = wanted
+        if self.global_rate:
+            rates, left, pending = {}, self.global_rate, set(wanted)
+            while pending:
+                per_weight = left / sum(self.streams[key].weight for key in pending)
+                satisfied = [key for key in pending
+                             if wanted[key] <= per_weight * self.streams[key].weight]
+                if not satisfied:
+                    for key in pending:
+                        rates[key] = per_weight * self.streams[key].weight
+                    break
+
+                for key in satisfied:
+                    rates[key] = wanted[key]
+                    left -= wanted[key]
+                    pending.remove(key)
+
+        for key, rate in rates.items():
+            self.streams[key].bucket.set_rate(rate)
+
+
+class DelayQueue:
+    """Runs functions once their delay has passed, in order, on one thread"""
+
+    def __init__(self):
+        self.heap = []
+        self.sequence = itertools.count()  # keeps equal deadlines in order
+        self.stopped = False
+        self.changed_c = threading.Condition()
+        threading.Thread(target=self.run, name='DelayQueue', daemon=True).start()
+
+    def call_later(self, delay, function, *args):
+        with self.changed_c:
+            heapq.heappush(
+                self.heap, (monotonic() + delay, next(self.sequence), function, args))
+            self.changed_c.notify()
+
+    def next_due(self):
+        return self.stopped or (self.heap and self.heap[0][0] <= monotonic())
+
+    def run(self):
+        while True:
+            with self.changed_c:
+                while not self.next_due():
+                    timeout = self.heap[0][0] - monotonic() if self.heap else None
+                    self.changed_c.wait(timeout)
+                if self.stopped:
+                    return
+                _, _, function, args = heapq.heappop(self.heap)
+
+            try:
+                function(*args)
+            except Exception:
+                logger.exception(f"Delayed call to {function} failed")
+
+    def stop(self):
+        with self.changed_c:
+            self.stopped = True
+            self.changed_c.notify()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""Build time and search latency of the catalog index on a synthetic catalog.
+
+The server builds the sorted arrays before it serves and the trigram postings
+afterwards, in the background: 'scan' rows are the searches answered while the
+postings build, 'postings' rows the ones answered after. First pages are timed
+on a fresh result cache, next pages continue from the first page's cursor.
+
+Usage: python3 -m bench.catalog [--tracks N] [--rounds N]
+"""
+
+import argparse
+import random
+import resource
+import statistics
+import time
+from typing import NamedTuple
+
+from catalog_index import CatalogIndex
+
+SYLLABLES = ['an', 'ba', 'ce', 'do', 'el', 'fi', 'go', 'ha', 'in', 'ka', 'lo', 'ma',
+             'ne', 'or', 'pa', 're', 'si', 'ta', 'un', 'vo']
+RARE_WORDS = ['jazz', 'fjord', 'quixote']  # one title in RARE_EVERY has one
+RARE_EVERY = 5000
+
+QUERIES = [  # (name, query, prefix)
+    ('dense prefix', 'ma', True),
+    ('no-match prefix', 'quix', True),
+    ('dense 2-char', 'an', False),
+    ('sparse 2-char', 'zz', False),
+    ('dense word', 'lomane', False),
+    ('sparse word', 'fjord', False),
+]
+
+
+class Track(NamedTuple):
+    id: str
+    title: str
+    filename: str
+
+
+def synthetic_tracks(count, seed=7):
+    rng = random.Random(seed)
+    words = [''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(5000)]
+    for i in range(count):
+        title = rng.choices(words, k=rng.randint(2, 4))
+        if rng.randrange(RARE_EVERY) == 0:
+            title[-1] = rng.choice(RARE_WORDS)
+        filename = f"{i:07d}-{'-'.join(title)}.mp3"
+        yield Track(filename, ' '.join(title).title(), filename)
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(call, rounds):
+    """Median ms of call over rounds, and its last result"""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = call()
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), result
+
+
+def measure(catalog, rounds, limit):
+    rows = []
+    for name, query, prefix in QUERIES:
+        def first_page():
+            catalog.results.clear()
+            return catalog.search(query, prefix, '', limit)
+
+        first, (tracks, cursor) = timed(first_page, rounds)
+        after, _ = timed(lambda: catalog.search(query, prefix, cursor, limit), rounds)
+        rows.append((name, query, len(tracks), first, after if cursor else None))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=1_000_000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--limit', type=int, default=50)
+    args = parser.parse_args()
+
+    tracks = list(synthetic_tracks(args.tracks))
+    rss = max_rss_mb()
+    start = time.perf_counter()
+    catalog = CatalogIndex(tracks, build_postings=False)
+    sorted_secs = time.perf_counter() - start
+    sorted_mb = max_rss_mb() - rss
+    list_ms, _ = timed(lambda: catalog.list('title', '', args.limit), args.rounds)
+    scan_rows = measure(catalog, args.rounds, args.limit)
+
+    rss = max_rss_mb()
+    start = time.perf_counter()
+    catalog.install_postings({}, catalog.collect_postings(catalog.keys))
+    postings_secs = time.perf_counter() - start
+    postings_mb = max_rss_mb() - rss
+    postings_rows = measure(catalog, args.rounds, args.limit)
+
+    print(f"{args.tracks} tracks, {args.limit} per page")
+    print(f"sorted arrays: {sorted_secs:.1f} s, +{sorted_mb:.0f} MB max RSS")
+    print(f"postings:      {postings_secs:.1f} s, +{postings_mb:.0f} MB max RSS")
+    print(f"list page:     {list_ms:.2f} ms\n")
+    print(f"{'search':<9} {'kind':<15} {'query':<10} {'found':>6} {'first (ms)':>11} "
+          f"{'next (ms)':>10}")
+    for mode, rows in [('scan', scan_rows), ('postings', postings_rows)]:
+        for name, query, found, first, after in rows:
+            after = f"{after:>10.2f}" if after is not None else f"{'-':>10}"
+            print(f"{mode:<9} {name:<15} {query!r:<10} {found:>6} {first:>11.2f} {after}")
+
+
+if __name__ == '__main__':
+    main()
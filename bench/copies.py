@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Allocations and payload copies of the chunk data path, before and after mmap.
+
+The mmap row is the server's default path. The block cache rows read through
+StreamedFile with MediaServer.CacheSize set: cold with every block a miss and
+copied out of the mapping, warm with every block already cached.
+
+Usage: python3 -m bench.copies [--track FILE] [--chunk-size N]
+"""
+
+import argparse
+import time
+import tracemalloc
+from pathlib import Path
+
+from chunk_cache import BlockCache
+from handle_pool import HandlePool
+from media_server import MappedFile, Spotifice, StreamedFile, open_mapped_file
+
+CACHE_SIZE = 64 * 1024 * 1024  # MediaServer.CacheBlockSize default
+CACHE_BLOCK_SIZE = 64 * 1024
+
+
+def read_file(path, chunk_size):
+    """Former StreamedFile.read: a new bytes object per chunk"""
+    with open(path, 'rb') as file:
+        return list(iter(lambda: file.read(chunk_size), b''))
+
+
+def read_mmap(path, chunk_size):
+    mapped = MappedFile(path)
+    return [mapped.read_at(offset, chunk_size)
+            for offset in range(0, len(mapped.data), chunk_size)]
+
+
+def cached_reader(cache=None):
+    """Reads through a block cache, a fresh one per read unless given"""
+    def read_cached(path, chunk_size):
+        track = Spotifice.TrackInfo(id=path.name, title=path.stem, filename=path.name)
+        streamed_file = StreamedFile(track, path, HandlePool(1, open_mapped_file),
+                                     cache or BlockCache(CACHE_SIZE, CACHE_BLOCK_SIZE))
+        return list(iter(lambda: streamed_file.read(chunk_size), b''))
+    return read_cached
+
+
+def gst_allocate_fill(chunks):
+    from gi.repository import Gst  # type: ignore
+
+    for chunk in chunks:
+        buf = Gst.Buffer.new_allocate(None, len(chunk), None)
+        buf.fill(0, chunk)
+
+
+def gst_wrapped(chunks):
+    from gi.repository import Gst  # type: ignore
+
+    for chunk in chunks:
+        Gst.Buffer.new_wrapped(chunk)
+
+
+def measure(read, path, chunk_size, rounds):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    chunks = read(path, chunk_size)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        read(path, chunk_size)
+    rate = rounds * len(chunks) / (time.perf_counter() - start)
+
+    return len(chunks), allocated / len(chunks), rate
+
+
+def measure_gst(push, chunks, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        push(chunks)
+    return rounds * len(chunks) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--track', default='test/media/4s.mp3', type=Path)
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--rounds', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'server read':<18} {'chunks':>7} {'bytes alloc/chunk':>18} "
+          f"{'copies/chunk':>13} {'chunks/s':>11}")
+    warm = BlockCache(CACHE_SIZE, CACHE_BLOCK_SIZE)
+    cached_reader(warm)(args.track, args.chunk_size)
+    for name, read in [('file.read', read_file), ('mmap memoryview', read_mmap),
+                       ('block cache, cold', cached_reader()),
+                       ('block cache, warm', cached_reader(warm))]:
+        count, allocated, rate = measure(read, args.track, args.chunk_size, args.rounds)
+        print(f"{name:<18} {count:>7} {allocated:>18.0f} "
+              f"{allocated / args.chunk_size:>13.2f} {rate:>11.0f}")
+
+    try:
+        import gi
+        gi.require_version('Gst', '1.0')
+        from gi.repository import Gst  # type: ignore
+        Gst.init(None)
+    except (ImportError, ValueError):
+        print("GStreamer not available, skipping render buffers")
+        return
+
+    # GLib allocations are invisible to tracemalloc, only throughput is reported
+    chunks = read_file(args.track, args.chunk_size)
+    print(f"\n{'render buffer':<18} {'chunks/s':>11}")
+    for name, push in [('allocate+fill', gst_allocate_fill),
+                       ('new_wrapped', gst_wrapped)]:
+        print(f"{name:<18} {measure_gst(push, chunks, args.rounds):>11.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Time to first audio of play(), rebuilding the pipeline for every track vs
+keeping one warm pipeline.
+
+Measured from the play() call until the first buffer reaches the sink.
+
+Usage: python3 -m bench.first_audio [--media DIR] [--track ID] [--rounds N]
+                                    [--sink ELEMENT]
+"""
+
+import argparse
+import statistics
+import time
+from pathlib import Path
+
+import Ice
+
+from gst_player import GstPlayer
+from media_render import MediaRenderI
+from media_server import MediaServerI, Spotifice
+
+
+def measure(reuse, args):
+    player = GstPlayer(pipeline=f'appsrc name=src ! decodebin ! {args.sink} name=sink',
+                       reuse_pipeline=reuse)
+
+    ic = Ice.initialize()
+    adapter = ic.createObjectAdapterWithEndpoints('BenchAdapter', 'tcp -h 127.0.0.1')
+    server_servant = MediaServerI(Path(args.media))
+    server = Spotifice.MediaServerPrx.uncheckedCast(adapter.addWithUUID(server_servant))
+    render = Spotifice.MediaRenderPrx.uncheckedCast(
+        adapter.addWithUUID(MediaRenderI(player)))
+    adapter.activate()
+
+    samples = []
+    try:
+        render.bind_media_server(server)
+        render.load_track(args.track)
+        for _ in range(args.rounds):
+            start = time.monotonic()
+            render.play()
+            if not player.first_audio_e.wait(5):
+                raise RuntimeError("No audio reached the sink")
+            samples.append(time.monotonic() - start)
+            render.stop()
+    finally:
+        player.shutdown()
+        server_servant.shutdown()
+        ic.destroy()
+
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--media', default='test/media')
+    parser.add_argument('--track', default='4s.mp3')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--sink', default='fakesink sync=true',
+                        help="sink element, e.g. autoaudiosink for a real device")
+    args = parser.parse_args()
+
+    print(f"{'pipeline':>10} {'first':>9} {'median':>9} {'max':>9}")
+    for reuse in (False, True):
+        samples = [s * 1000 for s in measure(reuse, args)]
+        print(f"{'reused' if reuse else 'rebuilt':>10} {samples[0]:7.1f}ms "
+              f"{statistics.median(samples):7.1f}ms {max(samples):7.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
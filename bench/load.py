@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""Capacity benchmark: N headless renders streaming at real-time pace.
+
+In 'pull' mode every simulated render opens a stream and calls get_audio_chunk,
+keeping at most --prebuffer seconds ahead of a real-time playout clock; an
+underrun is counted whenever a chunk arrives after the clock needed it. In
+'e2e' mode each render is a real MediaRenderI whose GstPlayer decodes into a
+fakesink. The server runs in-process or as a subprocess; results go out as JSON.
+
+Usage: python3 -m bench.load [--renders N] [--duration S] [--mode pull|e2e]
+                             [--server inprocess|subprocess] [--output FILE]
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import Ice
+
+import media_server
+from media_control import wait_ready
+from media_server import Spotifice
+
+
+def initialize(props=None):
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    for key, value in (props or {}).items():
+        init_data.properties.setProperty(key, value)
+    return Ice.initialize(init_data)
+
+
+def server_props(args):
+    return {
+        'MediaServerAdapter.Endpoints': f'tcp -h 127.0.0.1 -p {args.port}',
+        'MediaServer.Content': args.media,
+        'MediaServer.IndexFile': ':memory:',
+        'MediaServer.WatchInterval': '0',
+        **dict(prop.split('=', 1) for prop in args.prop),
+    }
+
+
+class InProcessServer:
+    def __init__(self, args):
+        self.ic = initialize(server_props(args))
+        self.thread = threading.Thread(target=media_server.main, args=(self.ic,))
+        self.thread.start()
+
+    def stop(self):
+        self.ic.shutdown()
+        self.thread.join(5)
+        self.ic.destroy()
+
+
+class SubprocessServer:
+    def __init__(self, args):
+        self.config = tempfile.NamedTemporaryFile('w', suffix='.config')
+        for key, value in server_props(args).items():
+            self.config.write(f'{key} = {value}\n')
+        self.config.flush()
+        self.process = subprocess.Popen(
+            [sys.executable, 'media_server.py', self.config.name],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait(5)
+        self.config.close()
+
+
+def connect(ic, args):
+    server = Spotifice.MediaServerPrx.uncheckedCast(
+        ic.stringToProxy(f'mediaServer1:tcp -h 127.0.0.1 -p {args.port}'))
+    wait_ready(server, 10)
+    return server
+
+
+class SimulatedRender(threading.Thread):
+    """Pulls tracks one after another as a render playing them would"""
+
+    def __init__(self, index, server, tracks, args, stopped):
+        super().__init__(daemon=True)
+        self.render_id = Ice.Identity(name=f'bench-render-{index}')
+        # one connection per render, like separate render processes
+        self.server = server.ice_connectionId(self.render_id.name)
+        self.tracks = tracks[index % len(tracks):] + tracks[:index % len(tracks)]
+        self.args = args
+        self.stopped = stopped
+        self.latencies = []
+        self.received = 0
+        self.underruns = 0
+        self.errors = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            for track in self.tracks:
+                try:
+                    self.play(track)
+                except Ice.Exception:
+                    self.errors += 1
+                if self.stopped.is_set():
+                    break
+
+    def play(self, track):
+        byte_rate = track.bitrate * 125
+        self.server.open_stream(track.id, self.render_id)
+        played_from = None  # playout clock origin
+        received = 0
+
+        while not self.stopped.is_set():
+            if played_from is not None:
+                ahead = received / byte_rate - (time.monotonic() - played_from)
+                if ahead < 0:
+                    self.underruns += 1
+                    played_from = time.monotonic() - received / byte_rate
+                elif ahead > self.args.prebuffer:
+                    self.stopped.wait(ahead - self.args.prebuffer)
+                    continue
+
+            start = time.perf_counter()
+            chunk = self.server.get_audio_chunk(self.render_id, self.args.chunk_size)
+            self.latencies.append(time.perf_counter() - start)
+            if not chunk:
+                return
+
+            received += len(chunk)
+            self.received += len(chunk)
+            if played_from is None:
+                played_from = time.monotonic()
+
+
+def percentile(values, q):
+    if len(values) < 2:
+        return values[0] if values else None
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def run_pull(server, tracks, args):
+    stopped = threading.Event()
+    renders = [SimulatedRender(i, server, tracks, args, stopped)
+               for i in range(args.renders)]
+    start = time.monotonic()
+    for render in renders:
+        render.start()
+
+    time.sleep(args.duration)
+    stopped.set()
+    for render in renders:
+        render.join(5)
+    elapsed = time.monotonic() - start
+
+    latencies = [latency for render in renders for latency in render.latencies]
+    return {
+        'throughput_bytes_per_s': round(sum(r.received for r in renders) / elapsed),
+        'chunks': len(latencies),
+        'chunk_latency_ms': {'p50': ms(percentile(latencies, 50)),
+                             'p99': ms(percentile(latencies, 99)),
+                             'max': ms(max(latencies, default=None))},
+        'underruns': sum(r.underruns for r in renders),
+        'errors': sum(r.errors for r in renders),
+    }
+
+
+def run_e2e(server, tracks, args):
+    from gst_player import GstPlayer
+    from media_render import MediaRenderI
+
+    ic = initialize()
+    adapter = ic.createObjectAdapterWithEndpoints('BenchRenders', 'tcp -h 127.0.0.1')
+    adapter.activate()
+    server = Spotifice.MediaServerPrx.uncheckedCast(ic.stringToProxy(str(server)))
+
+    players, servants = [], []
+    try:
+        for i in range(args.renders):
+            player = GstPlayer(
+                pipeline='appsrc name=src ! decodebin ! fakesink name=sink sync=true')
+            players.append(player)
+            servants.append(MediaRenderI(player))
+
+        start = time.monotonic()
+        for i, servant in enumerate(servants):
+            render = Spotifice.MediaRenderPrx.uncheckedCast(
+                adapter.add(servant, Ice.Identity(name=f'bench-render-{i}')))
+            queue = tracks[i % len(tracks):] + tracks[:i % len(tracks)]
+            render.bind_media_server(server)
+            render.load_track(queue[0].id)
+            for track in queue[1:]:
+                render.enqueue(track.id)
+            render.play()
+
+        time.sleep(args.duration)
+        elapsed = time.monotonic() - start
+
+        waits = [servant.need_data_wait for servant in servants]
+        served = served_bytes(server)
+        return {
+            'throughput_bytes_per_s': round(served / elapsed) if served else None,
+            'chunks': sum(wait.samples('', {})[-1].value for wait in waits),
+            'need_data_wait_ms': {
+                'p50': ms(max((w.quantile(0.5) or 0) for w in waits)),
+                'p99': ms(max((w.quantile(0.99) or 0) for w in waits))},
+            'underruns': sum(servant.underruns.value for servant in servants),
+            'gapless_transitions': sum(s.transitions.value for s in servants),
+        }
+    finally:
+        for player in players:
+            player.shutdown()
+        ic.destroy()
+
+
+def served_bytes(server):
+    stats = Spotifice.StatsPrx.uncheckedCast(server, 'stats')
+    for family in stats.get_metrics():
+        if family.name == 'spotifice_served_bytes_total':
+            return family.samples[0].value
+    return None
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--renders', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--mode', choices=['pull', 'e2e'], default='pull')
+    parser.add_argument('--server', choices=['inprocess', 'subprocess'],
+                        default='inprocess')
+    parser.add_argument('--media', default='test/media')
+    parser.add_argument('--port', type=int, default=10100)
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--prebuffer', type=float, default=2, help='seconds')
+    parser.add_argument('--prop', action='append', default=[],
+                        help='extra server property, e.g. MediaServer.Dispatch=async')
+    parser.add_argument('--output', help='write the JSON report here too')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    server_process = (SubprocessServer if args.server == 'subprocess'
+                      else InProcessServer)(args)
+    ic = initialize({'Ice.ThreadPool.Client.Size': '4'})
+    try:
+        server = connect(ic, args)
+        tracks = [track for track in server.get_all_tracks() if track.bitrate]
+        run = run_e2e if args.mode == 'e2e' else run_pull
+        results = run(server, tracks, args)
+    finally:
+        ic.destroy()
+        server_process.stop()
+
+    report = {
+        'revision': revision(),
+        'mode': args.mode,
+        'server': args.server,
+        'renders': args.renders,
+        'duration_s': args.duration,
+        'chunk_size': args.chunk_size,
+        'server_props': args.prop,
+        **results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""Cold-start time of the Spotifice entry points.
+
+Every round starts fresh interpreters: 'import' is the time to import each
+entry module (Slice loading, GStreamer bindings...), 'process' the wall time of
+an interpreter doing only that import, and 'ready' the time from launching the
+server or render until its first object answers a ping. Run it with and
+without `make slice` to compare generated Slice modules against compiling the
+Slice at startup. Results go out as JSON.
+
+Usage: python3 -m bench.startup [--rounds N] [--output FILE]
+"""
+
+import argparse
+import json
+import logging
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import Ice
+
+import slice_loader
+from bench.load import initialize, revision
+from media_control import wait_ready
+
+ENTRY_POINTS = ['media_server', 'media_render', 'media_control', 'media_stats']
+TIMED_IMPORT = ('import time; start = time.perf_counter(); import {}; '
+                'print(time.perf_counter() - start)')
+
+
+def time_import(module):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', TIMED_IMPORT.format(module)],
+                            capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode:
+        return None, None
+    return float(result.stdout.split()[-1]), elapsed
+
+
+def time_ready(script, props, proxy, ic, timeout):
+    with tempfile.NamedTemporaryFile('w', suffix='.config') as config:
+        config.writelines(f'{key} = {value}\n' for key, value in props.items())
+        config.flush()
+
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, script, config.name],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(ic.stringToProxy(proxy), timeout)
+            return time.perf_counter() - start
+        except Ice.Exception:
+            return None
+        finally:
+            process.terminate()
+            process.wait(5)
+
+
+def summary(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return {'median_ms': round(statistics.median(values) * 1000, 1),
+            'min_ms': round(min(values) * 1000, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--media', default='test/media')
+    parser.add_argument('--port', type=int, default=10200)
+    parser.add_argument('--timeout', type=float, default=10, help='seconds to be ready')
+    parser.add_argument('--output', help='write the JSON report here too')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    results = {}
+    for module in ENTRY_POINTS:
+        imports, processes = zip(*(time_import(module) for _ in range(args.rounds)))
+        results[module] = {'import': summary(imports), 'process': summary(processes)}
+
+    servers = {
+        'media_server': ({
+            'MediaServerAdapter.Endpoints': f'tcp -h 127.0.0.1 -p {args.port}',
+            'MediaServer.Content': args.media,
+            'MediaServer.IndexFile': ':memory:',
+            'MediaServer.WatchInterval': '0',
+            'MediaServer.GroupClock.Port': '-1',
+        }, f'mediaServer1:tcp -h 127.0.0.1 -p {args.port}'),
+        'media_render': ({
+            'MediaRenderAdapter.Endpoints': f'tcp -h 127.0.0.1 -p {args.port + 1}',
+        }, f'mediaRender1:tcp -h 127.0.0.1 -p {args.port + 1}'),
+    }
+    ic = initialize()
+    try:
+        for module, (props, proxy) in servers.items():
+            results[module]['ready'] = summary(
+                time_ready(f'{module}.py', props, proxy, ic, args.timeout)
+                for _ in range(args.rounds))
+    finally:
+        ic.destroy()
+
+    report = {
+        'revision': revision(),
+        'slice': 'generated' if slice_loader.generated_is_fresh() else 'runtime',
+        'rounds': args.rounds,
+        'entry_points': results,
+    }
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""Pull vs push streaming throughput under injected round-trip latency.
+
+Usage: python3 -m bench.streaming [--media DIR] [--track ID] [--latency MS,...]
+"""
+
+import argparse
+import threading
+import time
+from pathlib import Path
+
+import Ice
+
+from media_render import AudioSinkI
+from media_server import MediaServerI, Spotifice
+
+
+class DelayedMediaServerI(MediaServerI):
+    """Charges one round trip to every pull request and every credit grant"""
+
+    def __init__(self, media_dir, delay):
+        super().__init__(media_dir)
+        self.delay = delay
+
+    def get_audio_chunk(self, render_id, chunk_size, current=None):
+        time.sleep(self.delay)
+        return super().get_audio_chunk(render_id, chunk_size, current)
+
+    def grant_credits(self, render_id, credits, current=None):
+        grant = super().grant_credits
+        threading.Timer(self.delay, grant, (render_id, credits)).start()
+
+
+def initialize():
+    init_data = Ice.InitializationData()
+    init_data.properties = Ice.createProperties()
+    init_data.properties.setProperty('Ice.ThreadPool.Server.Size', '4')
+    init_data.properties.setProperty('Ice.MessageSizeMax', '0')
+    return Ice.initialize(init_data)
+
+
+def pull(server, render_id, args, adapter):
+    total = 0
+    while chunk := server.get_audio_chunk(render_id, args.chunk_size):
+        total += len(chunk)
+    return total
+
+
+def push(server, render_id, args, adapter):
+    sink = AudioSinkI()
+    sink_prx = Spotifice.AudioSinkPrx.uncheckedCast(adapter.addWithUUID(sink))
+    credits_prx = server.ice_oneway()
+    server.start_push(render_id, sink_prx, args.chunk_size, args.window)
+
+    total = 0
+    while chunk := sink.read(timeout=5):
+        total += len(chunk)
+        credits_prx.grant_credits(render_id, 1)
+
+    adapter.remove(sink_prx.ice_getIdentity())
+    return total
+
+
+def measure(server, adapter, mode, args):
+    render_id = Ice.Identity(name=f'bench-{mode.__name__}')
+    server.open_stream(args.track, render_id)
+
+    start = time.monotonic()
+    total = mode(server, render_id, args, adapter)
+    elapsed = time.monotonic() - start
+
+    server.close_stream(render_id)
+    return total / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--media', default='test/media')
+    parser.add_argument('--track', default='4s.mp3')
+    parser.add_argument('--latency', default='0,5,20,50',
+                        help='comma separated round-trip latencies in ms')
+    parser.add_argument('--chunk-size', type=int, default=4096)
+    parser.add_argument('--window', type=int, default=8)
+    args = parser.parse_args()
+
+    print(f"{'rtt (ms)':>8} {'pull (kB/s)':>12} {'push (kB/s)':>12}")
+    for latency in [int(x) for x in args.latency.split(',')]:
+        with initialize() as server_ic, initialize() as client_ic:
+            servant = DelayedMediaServerI(Path(args.media), latency / 1000)
+            server_adapter = server_ic.createObjectAdapterWithEndpoints(
+                'MediaServerAdapter', 'tcp -h 127.0.0.1')
+            proxy = server_adapter.add(servant, Ice.stringToIdentity('mediaServer1'))
+            server_adapter.activate()
+
+            client_adapter = client_ic.createObjectAdapterWithEndpoints(
+                'SinkAdapter', 'tcp -h 127.0.0.1')
+            client_adapter.activate()
+
+            server = Spotifice.MediaServerPrx.uncheckedCast(
+                client_ic.stringToProxy(str(proxy)))
+            rates = [measure(server, client_adapter, mode, args) / 1000
+                     for mode in (pull, push)]
+
+        print(f"{latency:>8} {rates[0]:>12.1f} {rates[1]:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
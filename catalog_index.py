@@ -0,0 +1,243 @@
+import base64
+import heapq
+import json
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, defaultdict
+
+SORT_FIELDS = ('title', 'filename')
+
+
+def encode_cursor(position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Position (sort key, track id) after which a page starts"""
+    if not cursor:
+        return None
+
+    try:
+        key, track_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(key), str(track_id)
+    except Exception:
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def prefix_range(entries, prefix):
+    """(start, end) of the sorted (key, id) entries whose key starts with prefix"""
+    return (bisect_left(entries, (prefix,)),
+            bisect_left(entries, (prefix + '\U0010ffff',)))
+
+
+class CatalogIndex:
+    """In-memory browse and search index over track titles and filenames.
+
+    Keeps one sorted array of (key, id) per sort field plus a trigram index,
+    so pages and searches never walk the whole catalog.
+
+    A search page is first looked for by walking the titles from the cursor,
+    which finds common matches after a few entries. Rarer ones are collected
+    from the trigram postings and sorted once, and the sorted matches are kept
+    per query for the pages that follow, until the catalog changes.
+
+    The postings are the slow part to build. Without build_postings they are
+    left to build_postings_in(lock) and substring searches walk every title
+    until they are in.
+    """
+
+    SCAN_FACTOR = 8  # titles walked per result wanted before using the postings
+    RESULT_CACHE_SIZE = 128  # queries whose sorted matches are kept
+
+    def __init__(self, tracks=(), build_postings=True):
+        self.tracks = {}  # id -> TrackInfo
+        self.keys = {}  # id -> sort key of each field
+        self.postings = None  # trigram -> track ids, once built
+        self.changed = None  # ids added or removed while the postings build
+        self.results = OrderedDict()  # (query, prefix) -> sorted (title key, id)
+        for track in tracks:
+            self.index(track)
+        self.sorted = {field: sorted((keys[i], track_id)
+                                     for track_id, keys in self.keys.items())
+                       for i, field in enumerate(SORT_FIELDS)}
+        if build_postings:
+            self.install_postings({}, self.collect_postings(self.keys))
+
+    def __len__(self):
+        return len(self.tracks)
+
+    @staticmethod
+    def sort_key(track, field):
+        return getattr(track, field).lower()
+
+    def add(self, track):
+        if track.id in self.tracks:
+            self.remove(track.id)
+
+        self.index(track)
+        for field in SORT_FIELDS:
+            insort(self.sorted[field], (self.sort_key(track, field), track.id))
+
+    def index(self, track):
+        """Index track everywhere but in the sorted arrays"""
+        self.tracks[track.id] = track
+        self.keys[track.id] = tuple(self.sort_key(track, field) for field in SORT_FIELDS)
+        self.results.clear()
+        self.post(track.id, self.keys[track.id], ())
+
+    def remove(self, track_id):
+        if self.tracks.pop(track_id, None) is None:
+            return
+
+        keys = self.keys.pop(track_id)
+        self.results.clear()
+        for field, key in zip(SORT_FIELDS, keys):
+            entries = self.sorted[field]
+            del entries[bisect_left(entries, (key, track_id))]
+        self.post(track_id, (), keys)
+
+    def post(self, track_id, keys, old_keys):
+        """Move track_id from the postings of old_keys to those of keys"""
+        if self.postings is None:
+            if self.changed is not None:
+                self.changed.add(track_id)
+            return
+
+        for key in old_keys:
+            for gram in trigrams(key):
+                self.postings[gram].discard(track_id)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+        for key in keys:
+            for gram in trigrams(key):
+                self.postings[gram].add(track_id)
+
+    @staticmethod
+    def collect_postings(keys):
+        postings = defaultdict(set)
+        for track_id, track_keys in keys.items():
+            for key in track_keys:
+                for gram in trigrams(key):
+                    postings[gram].add(track_id)
+        return postings
+
+    def build_postings_in(self, lock):
+        """Build the postings holding lock, which guards every use of the
+        index, only to copy the keys and to install the result"""
+        with lock:
+            self.changed = set()
+            keys = dict(self.keys)
+
+        postings = self.collect_postings(keys)
+        with lock:
+            self.install_postings(keys, postings)
+
+    def install_postings(self, keys, postings):
+        """Postings built from keys, patched for the changes made since"""
+        changed, self.changed = self.changed or (), None
+        self.postings = postings
+        for track_id in changed:
+            self.post(track_id, self.keys.get(track_id, ()), keys.get(track_id, ()))
+        self.results.clear()
+
+    @staticmethod
+    def start(entries, cursor):
+        position = decode_cursor(cursor)
+        return bisect_right(entries, position) if position else 0
+
+    def page(self, entries, cursor, limit):
+        """Tracks of up to limit entries after cursor, plus the next cursor"""
+        start = self.start(entries, cursor)
+        selected = entries[start:start + limit]
+        more = start + limit < len(entries)
+        next_cursor = encode_cursor(selected[-1]) if more and selected else ''
+        return [self.tracks[track_id] for _, track_id in selected], next_cursor
+
+    def list(self, field, cursor, limit):
+        return self.page(self.sorted[field], cursor, limit)
+
+    def search(self, query, prefix, cursor, limit):
+        """Tracks whose title or filename starts with (or contains) query"""
+        query = query.lower()
+        if (entries := self.results.get((query, prefix))) is not None:
+            self.results.move_to_end((query, prefix))
+            return self.page(entries, cursor, limit)
+
+        if (found := self.scan(query, prefix, cursor, limit)) is not None:
+            return found
+        return self.page(self.sorted_matches(query, prefix), cursor, limit)
+
+    def matches(self, track_id, query, prefix):
+        if prefix:
+            return any(key.startswith(query) for key in self.keys[track_id])
+        return any(query in key for key in self.keys[track_id])
+
+    def scan(self, query, prefix, cursor, limit):
+        """Page found walking the titles after cursor; None if matches are too
+        sparse to fill it within SCAN_FACTOR entries per track"""
+        entries = self.sorted['title']
+        start = self.start(entries, cursor)
+        end = min(start + (limit + 1) * self.SCAN_FACTOR, len(entries))
+        selected = []
+        for i in range(start, end):
+            if self.matches(entries[i][1], query, prefix):
+                selected.append(entries[i])
+                if len(selected) > limit:  # one more tells there is a next page
+                    return ([self.tracks[track_id] for _, track_id in selected[:-1]],
+                            encode_cursor(selected[-2]))
+
+        if end < len(entries):
+            return None
+        return [self.tracks[track_id] for _, track_id in selected], ''
+
+    def sorted_matches(self, query, prefix):
+        """All matches in title order, kept for the next pages of the query"""
+        if prefix:
+            # title matches are a run of the sorted titles, only filename ones
+            # need sorting
+            titles, filenames = self.sorted['title'], self.sorted['filename']
+            start, end = prefix_range(titles, query)
+            by_title = titles[start:end]
+            start, end = prefix_range(filenames, query)
+            by_filename = sorted((self.keys[track_id][0], track_id)
+                                 for _, track_id in filenames[start:end]
+                                 if not self.keys[track_id][0].startswith(query))
+            entries = list(heapq.merge(by_title, by_filename))
+        elif self.postings is None:
+            entries = [entry for entry in self.sorted['title']
+                       if self.matches(entry[1], query, False)]
+        else:
+            entries = sorted((self.keys[track_id][0], track_id)
+                             for track_id in self.substring_matches(query))
+
+        self.results[(query, prefix)] = entries
+        while len(self.results) > self.RESULT_CACHE_SIZE:
+            self.results.popitem(last=False)
+        return entries
+
+    def prefix_matches(self, query):
+        ids = set()
+        for field in SORT_FIELDS:
+            entries = self.sorted[field]
+            start, end = prefix_range(entries, query)
+            ids.update(track_id for _, track_id in entries[start:end])
+        return ids
+
+    def substring_matches(self, query):
+        if len(query) >= 3:
+            grams = sorted(trigrams(query), key=lambda g: len(self.postings.get(g, ())))
+            candidates = set(self.postings.get(grams[0], ()))
+            for gram in grams[1:]:
+                candidates &= self.postings.get(gram, set())
+        else:
+            candidates = set()
+            for gram, ids in self.postings.items():
+                if query in gram:
+                    candidates |= ids
+            candidates |= self.prefix_matches(query)
+
+        return {track_id for track_id in candidates
+                if self.matches(track_id, query, False)}
@@ -0,0 +1,75 @@
+import threading
+from collections import OrderedDict
+
+
+class BlockCache:
+    """Server-wide LRU of fixed-size file blocks, bounded by a memory budget.
+
+    Blocks are keyed by a file key plus block index; a short block marks the
+    end of the file. They are whatever load_block returns, which should own
+    its memory (bytes) for the budget to bound it; reads within a block are
+    slices of it, not copies.
+    """
+
+    def __init__(self, budget, block_size=64 * 1024):
+        assert block_size > 0
+
+        self.budget = budget
+        self.block_size = block_size
+        self.blocks = OrderedDict()  # (file_key, index) -> bytes-like
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        return dict(size=self.size, blocks=len(self.blocks), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+    def read(self, file_key, offset, size, load_block):
+        """Up to size bytes at offset; load_block(index) reads a block from disk"""
+        parts = []
+        end = offset + size
+        while offset < end:
+            index, start = divmod(offset, self.block_size)
+            block = self.get_block(file_key, index, load_block)
+            part = memoryview(block)[start:start + end - offset]
+            if not part:
+                break
+
+            parts.append(part)
+            offset += len(part)
+            if len(block) < self.block_size:
+                break
+
+        return parts[0] if len(parts) == 1 else b''.join(parts)
+
+    def get_block(self, file_key, index, load_block):
+        key = (file_key, index)
+        with self.lock:
+            if (block := self.blocks.get(key)) is not None:
+                self.blocks.move_to_end(key)
+                self.hits += 1
+                return block
+
+            self.misses += 1
+
+        block = load_block(index)
+        self.store(key, block)
+        return block
+
+    def store(self, key, block):
+        if len(block) > self.budget:
+            return
+
+        with self.lock:
+            if key in self.blocks:
+                return
+
+            self.blocks[key] = block
+            self.size += len(block)
+            while self.size > self.budget:
+                _, evicted = self.blocks.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
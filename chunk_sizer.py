@@ -0,0 +1,67 @@
+import logging
+from math import ceil
+
+logger = logging.getLogger("ChunkSizer")
+
+
+class ChunkSizer:
+    """Sizes the reads of a pulled stream: the fewest RPCs that still keep a
+    buffer margin.
+
+    Playback goes on from the margin left in the buffer while a read is in
+    flight, so a read may take at most `budget` of the seconds that margin
+    lasts at the stream's byte rate. Reads that take under half of it double
+    in size and reads over it halve, within [min_read, max_read] bytes. A read
+    is count chunks of chunk_size, and a read only takes more chunks once they
+    have reached max_chunk.
+
+    Readers that can keep up to `depth` reads in flight get enough of them to
+    deliver headroom times the byte rate when each read takes as long as the
+    last one did, up to max_depth.
+    """
+
+    def __init__(self, read_size, margin, byte_rate=0, min_read=1024,
+                 max_read=512 * 1024, max_chunk=64 * 1024, budget=0.5,
+                 max_depth=1, headroom=1.5):
+        assert 0 < min_read <= max_read and max_depth >= 1
+        self.margin = margin  # bytes buffered when a refill starts
+        self.byte_rate = byte_rate  # playback rate, 0 while unknown
+        self.min_read = min_read
+        self.max_read = max_read
+        self.max_chunk = max_chunk
+        self.budget = budget
+        self.max_depth = max_depth
+        self.headroom = headroom
+        self.read_size = min(max(read_size, min_read), max_read)
+        self.depth = 1  # reads in flight
+
+    def next_read(self):
+        """(chunk_size, count) for the next read"""
+        chunk_size = min(self.read_size, self.max_chunk)
+        return chunk_size, ceil(self.read_size / chunk_size)
+
+    def observe(self, nbytes, elapsed):
+        """Adapt to a read of nbytes that took elapsed seconds"""
+        if not self.byte_rate or not nbytes:
+            return
+
+        depth = ceil(self.headroom * self.byte_rate * elapsed / nbytes)
+        depth = min(max(depth, 1), self.max_depth)
+        if depth != self.depth:
+            logger.debug(f"Reads in flight {self.depth} -> {depth}")
+            self.depth = depth
+
+        allowed = self.budget * self.margin / self.byte_rate
+        if elapsed > allowed:
+            size = max(self.read_size // 2, self.min_read)
+        elif elapsed < allowed / 2 and nbytes >= self.read_size:
+            # short reads, at the end of the stream or cut by the server's
+            # bounds, would not get any bigger
+            size = min(self.read_size * 2, self.max_read)
+        else:
+            return
+
+        if size != self.read_size:
+            logger.debug(f"Read size {self.read_size} -> {size} bytes "
+                         f"({elapsed * 1000:.1f} ms per read)")
+            self.read_size = size
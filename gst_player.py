@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 
 import logging
-import queue
 import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from time import monotonic
 
 import gi
 
 gi.require_version('Gst', '1.0')
-from gi.repository import Gst  # type: ignore # noqa: E402
+from gi.repository import GLib, Gst  # type: ignore # noqa: E402
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("GstPlayer")
 
-Gst.init(None)
+gst_init_lock = threading.Lock()
+
+
+def init_gst():
+    """Gst.init on first use: scanning the plugin registry is the slowest part of
+    a render's startup and importing this module should not pay for it"""
+    with gst_init_lock:
+        if not Gst.is_initialized():
+            Gst.init(None)
 
 
 state_map = {
@@ -24,83 +33,246 @@ state_map = {
     None: 'STOP'
 }
 
-class GstPlayer(threading.Thread):
+
+class PlayerWorkers:
+    """Threads shared by all the players of a process: a small pool running
+    their commands and one GLib main loop dispatching their bus messages"""
+
+    def __init__(self, size=2):
+        init_gst()
+        self.executor = ThreadPoolExecutor(size, thread_name_prefix='GstPlayer')
+        self.loop = GLib.MainLoop()
+        threading.Thread(target=self.loop.run, name='GstMainLoop', daemon=True).start()
+
+    def shutdown(self):
+        self.loop.quit()
+        self.executor.shutdown()
+
+
+shared_workers_lock = threading.Lock()
+shared_workers = None
+
+
+def get_shared_workers():
+    global shared_workers
+    with shared_workers_lock:
+        if shared_workers is None:
+            shared_workers = PlayerWorkers()
+        return shared_workers
+
+
+CLOCK_SYNC_SECS = 2
+net_clocks_lock = threading.Lock()
+net_clocks = {}  # (address, port) -> GstNetClientClock
+
+
+def network_clock(address, port, timeout=CLOCK_SYNC_SECS):
+    """Clock following the GstNetTimeProvider at address:port, shared by all the
+    players of the process"""
+    init_gst()
+    with net_clocks_lock:
+        if (clock := net_clocks.get((address, port))) is None:
+            gi.require_version('GstNet', '1.0')
+            from gi.repository import GstNet  # type: ignore
+
+            clock = net_clocks[address, port] = GstNet.NetClientClock.new(
+                'group', address, port, 0)
+
+    if not clock.wait_for_sync(timeout * Gst.SECOND):
+        logger.warning(f"Clock at {address}:{port} not synced yet")
+    return clock
+
+
+class CommandQueue:
+    """Commands of one player, run in order and one at a time on a shared pool"""
+
+    def __init__(self, executor, handler):
+        self.executor = executor
+        self.handler = handler
+        self.pending = deque()
+        self.scheduled = False
+        self.lock = threading.Lock()
+
+    def put(self, command):
+        with self.lock:
+            self.pending.append(command)
+            if self.scheduled:
+                return
+            self.scheduled = True
+
+        self.executor.submit(self.drain)
+
+    def drain(self):
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.scheduled = False
+                    return
+                command = self.pending.popleft()
+
+            try:
+                self.handler(command)
+            except Exception:
+                logger.exception(f"Command {command} failed")
+
+
+class GstPlayer:
     CHUNK_SIZE = 4096
-    PIPELINE = 'appsrc name=src ! decodebin ! autoaudiosink'
+    PIPELINE = 'appsrc name=src ! decodebin ! autoaudiosink name=sink'
     EVENT_TIMEOUT_SECS = 2
 
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.command_queue = queue.Queue()
+    def __init__(self, pipeline=None, reuse_pipeline=False, workers=None):
+        """pipeline needs an appsrc named 'src'; a first buffer probe goes on the
+        element named 'sink'. With reuse_pipeline, one pipeline is kept warm
+        across tracks and flushed between them instead of being rebuilt.
+        Commands run on workers, the process wide PlayerWorkers by default."""
+        init_gst()
+        self.pipeline_description = pipeline or self.PIPELINE
+        self.reuse_pipeline = reuse_pipeline
+        self.workers = workers or get_shared_workers()
+        self.command_queue = CommandQueue(self.workers.executor, self.run_command)
+        self.shutdown_e = threading.Event()
         self.play_confirmed_e = threading.Event()
         self.stop_confirmed_e = threading.Event()
         self.stop_confirmed_e.set()
 
         self.pipeline: Gst.Pipeline = None
+        self.clock = None  # to slave the pipeline to, with base_time (ns)
+        self.base_time = None
+        self.pipeline_clock = None
+        self.active = False
+        self.stashed = None
         self.get_chunk_hook = None
         self.track_ended_hook = lambda: None
 
         self.show_stats = False
 
-    def run(self):
-        while True:
-            cmd = self.command_queue.get()
-            logger.debug(f"Processing command: {cmd}")
-            match cmd:
-                case 'CONFIGURED':
-                    self.activate_stream()
-                case 'STOP':
-                    if self.deactivate_stream():
-                        threading.Thread(target=self.track_ended_hook).start()
-                case 'SHUTDOWN':
-                    self.deactivate_stream()
-                    break
-                case _:
-                    logger.warning(f"Unexpected command: {cmd}")
+        self.play_requested = None  # monotonic times of the last play, for tracing
+        self.activated = None
+        self.pipeline_ready = None
+        self.time_to_first_audio = None
+        self.first_audio_e = threading.Event()
+        self.sink_probed = False
+
+    def run_command(self, cmd):
+        logger.debug(f"Processing command: {cmd}")
+        match cmd:
+            case 'CONFIGURED':
+                self.activate_stream()
+            case 'STOP':
+                if self.deactivate_stream():
+                    # not on a worker: the hook may wait for this player's commands
+                    threading.Thread(target=self.track_ended_hook).start()
+            case 'SHUTDOWN':
+                self.deactivate_stream()
+                if self.pipeline:
+                    self.release_pipeline()
+                self.shutdown_e.set()
+            case _:
+                logger.warning(f"Unexpected command: {cmd}")
 
     def setup_pipeline(self):
-        retval = Gst.parse_launch(self.PIPELINE)
+        retval = Gst.parse_launch(self.pipeline_description)
         self.appsrc = retval.get_by_name('src')
         self.appsrc.set_property('format', Gst.Format.TIME)
         self.appsrc.set_property('block', True)
         self.appsrc.set_property('is-live', True)
         self.appsrc.set_property('max-bytes', 8192)
         self.appsrc.connect('need-data', self.on_need_data)
+
+        self.sink_probed = False
+        if sink := retval.get_by_name('sink'):
+            sink.get_static_pad('sink').add_probe(
+                Gst.PadProbeType.BUFFER, self.on_sink_buffer)
+            self.sink_probed = True
+
+        retval.get_bus().add_watch(GLib.PRIORITY_DEFAULT, self.on_bus_message)
         return retval
 
     def activate_stream(self):
+        self.activated = monotonic()
         self.last_time = None
         self.stop_confirmed_e.clear()
-        self.pipeline = self.setup_pipeline()
+        self.stashed = None
+        if self.pipeline and self.pipeline_clock is not self.clock:
+            self.release_pipeline()
+
+        if self.pipeline is None:
+            self.pipeline = self.setup_pipeline()
+            self.pipeline_clock = self.clock
+        else:
+            self.appsrc.send_event(Gst.Event.new_flush_stop(True))
+
+        if self.clock:
+            # every player given the same clock and base time renders the same
+            # stream position at the same instant
+            self.pipeline.use_clock(self.clock)
+            self.pipeline.set_start_time(Gst.CLOCK_TIME_NONE)
+            self.pipeline.set_base_time(self.base_time)
+
+        self.active = True
         self.pipeline.set_state(Gst.State.PLAYING)
+        self.pipeline_ready = monotonic()
         self.play_confirmed_e.set()
         logger.info("Playing...")
 
     def deactivate_stream(self):
-        if not self.pipeline:
+        if not self.active:
             return False
 
+        self.active = False
         self.play_confirmed_e.clear()
+        if self.reuse_pipeline:
+            # drops queued data and the EOS of the last track, keeping
+            # decoders and the negotiated audio sink for the next one
+            self.appsrc.send_event(Gst.Event.new_flush_start())
+            self.pipeline.set_state(Gst.State.PAUSED)
+        else:
+            self.release_pipeline()
+
+        self.stop_confirmed_e.set()
+        logger.info("Stopped.")
+        return True
+
+    def release_pipeline(self):
         self.appsrc.disconnect_by_func(self.on_need_data)
+        self.pipeline.get_bus().remove_watch()
         self.pipeline.set_state(Gst.State.NULL)
         self.pipeline = None
-        self.stop_confirmed_e.set()
-        logger.info("Stopped.")
+
+    def on_bus_message(self, bus, message):
+        if message.type == Gst.MessageType.ERROR:
+            error, debug = message.parse_error()
+            logger.error(f"Pipeline error: {error.message}")
+            logger.debug(debug)
+            self.command_queue.put('STOP')
         return True
 
+    def on_sink_buffer(self, pad, info):
+        if not self.first_audio_e.is_set():
+            self.time_to_first_audio = monotonic() - self.play_requested
+            self.first_audio_e.set()
+            logger.info(f"Time to first audio: {self.time_to_first_audio * 1000:.1f} ms")
+        return Gst.PadProbeReturn.OK
+
     def on_need_data(self, src, length):
         assert self.get_chunk_hook
 
+        if not self.active:
+            return
+
         chunk_size = length if length > 0 else self.CHUNK_SIZE
-        if not (chunk := self.get_chunk_hook(chunk_size)):
+        chunk, self.stashed = self.stashed, None
+        if not (chunk or (chunk := self.get_chunk_hook(chunk_size))):
             src.emit('end-of-stream')
             logger.info("Stream exhaused.")
             self.command_queue.put('STOP')
             return
 
-        buf = Gst.Buffer.new_allocate(None, len(chunk), None)
-        buf.fill(0, chunk)
-        src.emit('push-buffer', buf)
+        retval = src.emit('push-buffer', Gst.Buffer.new_wrapped(bytes(chunk)))
+        if retval == Gst.FlowReturn.FLUSHING and self.active:
+            # fetched while flush() was in progress, so it is already new data
+            self.stashed = chunk
 
         if self.show_stats:
             self.print_stats(len(chunk))
@@ -113,9 +285,17 @@ class GstPlayer(threading.Thread):
                 print(f"\rbitrate: {bitrate:.2f} kB/s    ", end='', flush=True)
         self.last_time = monotonic()
 
-    def configure(self, get_chunk_hook, track_ended_hook=None):
+    def configure(self, get_chunk_hook, track_ended_hook=None, clock=None,
+                  base_time=None):
+        """Play what get_chunk_hook returns; with clock, the pipeline runs on it
+        and starts at base_time (ns) on it"""
         self.get_chunk_hook = get_chunk_hook
         self.track_ended_hook = track_ended_hook or (lambda: None)
+        self.clock = clock
+        self.base_time = base_time
+        self.play_requested = monotonic()
+        self.activated = self.pipeline_ready = None
+        self.first_audio_e.clear()
         self.stop_confirmed_e.clear()
         self.command_queue.put('CONFIGURED')
 
@@ -136,8 +316,24 @@ class GstPlayer(threading.Thread):
         assert self.is_playing()
         self.pipeline.set_state(Gst.State.PLAYING)
 
+    def flush(self):
+        """Drop the audio queued in the pipeline, e.g. after a seek"""
+        if not self.active:
+            return
+
+        self.appsrc.send_event(Gst.Event.new_flush_start())
+        self.appsrc.send_event(Gst.Event.new_flush_stop(True))
+
+    def get_position(self):
+        """Time (ms) played since the stream started or was last flushed"""
+        if not self.active:
+            return 0
+
+        found, position = self.pipeline.query_position(Gst.Format.TIME)
+        return position // Gst.MSECOND if found else 0
+
     def get_state(self):
-        if self.pipeline is None:
+        if not self.active:
             return 'STOP'
 
         state = self.pipeline.get_state(1 * Gst.SECOND)
@@ -149,7 +345,12 @@ class GstPlayer(threading.Thread):
         return self.play_confirmed_e.is_set()
 
     def confirm_play_starts(self):
+        """True once the first buffer reaches the sink; pipelines without an
+        element named 'sink' are confirmed when set to play"""
+        deadline = monotonic() + self.EVENT_TIMEOUT_SECS
         retval = self.play_confirmed_e.wait(self.EVENT_TIMEOUT_SECS)
+        if retval and self.sink_probed:
+            retval = self.first_audio_e.wait(max(0, deadline - monotonic()))
         logger.debug(f"play confirmed: {retval}")
         return retval
 
@@ -158,5 +359,5 @@ class GstPlayer(threading.Thread):
             self.stop()
 
         self.command_queue.put('SHUTDOWN')
-        self.join()
+        self.shutdown_e.wait()
         logger.info("Shutdown complete.")
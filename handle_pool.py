@@ -0,0 +1,68 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class HandlePool:
+    """Bounded LRU of open file handles shared by all streams.
+
+    Streams borrow a handle only for the duration of a read. Once the pool
+    grows over capacity, idle handles are closed least recently used first.
+    """
+
+    def __init__(self, capacity, opener):
+        self.capacity = capacity
+        self.opener = opener
+        self.handles = OrderedDict()  # key -> [handle, borrowers]
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            borrowed = sum(1 for _, borrowers in self.handles.values() if borrowers)
+        return dict(handles=len(self.handles), borrowed=borrowed, opened=self.opened)
+
+    @contextmanager
+    def borrow(self, key):
+        entry = self.acquire(key)
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                self.shrink()
+
+    def acquire(self, key):
+        with self.lock:
+            if entry := self.handles.get(key):
+                self.handles.move_to_end(key)
+                entry[1] += 1
+                return entry
+
+        handle = self.opener(key)
+        with self.lock:
+            if entry := self.handles.get(key):
+                handle.close()
+            else:
+                entry = self.handles[key] = [handle, 0]
+                self.opened += 1
+
+            entry[1] += 1
+            self.shrink()
+            return entry
+
+    def shrink(self):
+        excess = len(self.handles) - self.capacity
+        if excess <= 0:
+            return
+
+        idle = [key for key, (_, borrowers) in self.handles.items() if not borrowers]
+        for key in idle[:excess]:
+            handle, _ = self.handles.pop(key)
+            handle.close()
+
+    def close_all(self):
+        with self.lock:
+            for handle, _ in self.handles.values():
+                handle.close()
+            self.handles.clear()
@@ -0,0 +1,140 @@
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("JitterBuffer")
+
+
+def parse_watermark(value, byte_rate):
+    """'64k', '2M' and '32768' are bytes; '1.5s' is seconds of audio at byte_rate"""
+    value = value.strip().lower()
+    if value.endswith('s'):
+        return int(float(value[:-1]) * byte_rate)
+
+    multipliers = {'k': 1024, 'm': 1024 * 1024}
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+
+    return int(value)
+
+
+class JitterBuffer:
+    """Read-ahead buffer filled by a background thread.
+
+    Prefetching starts whenever the level drops to the low watermark and goes
+    on until the high watermark is reached, so read() only copies from memory.
+    Sources with a close() method are closed once the buffer stops.
+    """
+
+    def __init__(self, fetch, low_watermark, high_watermark, chunk_size=4096,
+                 underrun_counter=None):
+        assert 0 <= low_watermark < high_watermark
+
+        self.fetch = fetch
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.chunk_size = chunk_size
+
+        self.chunks = deque()
+        self.level = 0
+        self.eos = False
+        self.stopped = False
+        self.reposition = None
+        self.underruns = 0
+        self.underrun_counter = underrun_counter
+        self.overruns = 0
+        self.changed_c = threading.Condition()
+        self.thread = threading.Thread(target=self.prefetch, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.changed_c:
+            self.stopped = True
+            self.changed_c.notify_all()
+
+        logger.info(f"Stopped: {self.stats()}")
+
+    def stats(self):
+        return dict(level=self.level, underruns=self.underruns, overruns=self.overruns)
+
+    def reset(self, reposition):
+        """Drop buffered data and refill from wherever reposition() moves the
+        source to. It runs on the prefetch thread, so never during a fetch."""
+        with self.changed_c:
+            self.chunks.clear()
+            self.level = 0
+            self.eos = False
+            self.reposition = reposition
+            self.changed_c.notify_all()
+
+    def needs_refill(self):
+        return (self.level <= self.low_watermark and not self.eos) or \
+            self.reposition or self.stopped
+
+    def prefetch(self):
+        try:
+            self.fill()
+        finally:
+            if close := getattr(self.fetch, 'close', None):
+                close()
+
+    def fill(self):
+        while True:
+            with self.changed_c:
+                self.changed_c.wait_for(self.needs_refill)
+                if self.stopped:
+                    return
+                reposition, self.reposition = self.reposition, None
+
+            if reposition:
+                reposition()
+
+            while self.level < self.high_watermark:
+                chunk = self.fetch(self.chunk_size)
+                with self.changed_c:
+                    if self.stopped:
+                        return
+
+                    if self.reposition:
+                        break  # fetched before a reset
+
+                    if not chunk:
+                        self.eos = True
+                        self.changed_c.notify_all()
+                        break
+
+                    self.chunks.append(chunk)
+                    self.level += len(chunk)
+                    if self.level > self.high_watermark:
+                        self.overruns += 1
+                    self.changed_c.notify_all()
+
+    def has_data(self):
+        return self.chunks or self.eos or self.stopped
+
+    def read(self, size, timeout=None):
+        """Next buffered chunk, cut to size bytes; empty at end of stream, None on
+        timeout. Whole chunks are handed out as they are, without copying."""
+        with self.changed_c:
+            if not self.has_data():
+                self.underruns += 1
+                if self.underrun_counter:
+                    self.underrun_counter.inc()
+                if not self.changed_c.wait_for(self.has_data, timeout):
+                    logger.warning("Timeout waiting for audio data")
+                    return None
+
+            if not self.chunks:
+                return b''
+
+            chunk = self.chunks.popleft()
+            if len(chunk) > size:
+                self.chunks.appendleft(chunk[size:])
+                chunk = chunk[:size]
+
+            self.level -= len(chunk)
+            self.changed_c.notify_all()
+            return chunk
@@ -0,0 +1,133 @@
+import logging
+import os
+import sqlite3
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import mp3info
+
+logger = logging.getLogger("LibraryIndex")
+
+
+class TrackRecord(NamedTuple):
+    filename: str
+    mtime_ns: int
+    size: int
+    title: str
+    artist: str
+    album: str
+    duration: int  # ms
+    bitrate: int   # kbit/s
+
+
+class LibraryIndex:
+    """On-disk catalog of probed tracks.
+
+    A scan lists the media directory and only probes files whose mtime or size
+    changed since they were indexed; probing runs on a worker pool. Seek tables
+    are built on first use and kept until the file changes.
+    """
+
+    SCHEMA = """CREATE TABLE IF NOT EXISTS tracks (
+        filename TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, title TEXT,
+        artist TEXT, album TEXT, duration INTEGER, bitrate INTEGER);
+        CREATE TABLE IF NOT EXISTS seek_tables (
+        path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, step INTEGER,
+        offsets BLOB)"""
+
+    def __init__(self, path, workers=8):
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(str(path), check_same_thread=False)
+        with self.db:
+            self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def records(self):
+        with self.lock:
+            rows = self.db.execute('SELECT * FROM tracks').fetchall()
+        return {row[0]: TrackRecord(*row) for row in rows}
+
+    @staticmethod
+    def list_media(media_dir, suffix='.mp3'):
+        """filename -> (mtime_ns, size) of every media file"""
+        retval = {}
+        with os.scandir(media_dir) as entries:
+            for entry in entries:
+                if entry.is_file() and entry.name.lower().endswith(suffix):
+                    stat = entry.stat()
+                    retval[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        return retval
+
+    def scan(self, media_dir):
+        """Records for all media files, sorted by filename"""
+        media_dir = Path(media_dir)
+        known = self.records()
+        present = self.list_media(media_dir)
+        stale = [name for name, stamp in present.items()
+                 if name not in known or known[name][1:3] != stamp]
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            probed = list(executor.map(
+                lambda name: self.probe(media_dir / name, *present[name]), stale))
+
+        removed = known.keys() - present.keys()
+        self.store(probed, removed)
+        logger.info(f"Scan: {len(present)} files, {len(probed)} probed, "
+                    f"{len(removed)} removed")
+
+        records = {**known, **{record.filename: record for record in probed}}
+        return [records[name] for name in sorted(present)]
+
+    def update(self, filepath):
+        stat = filepath.stat()
+        record = self.probe(filepath, stat.st_mtime_ns, stat.st_size)
+        self.store([record], [])
+        return record
+
+    def remove(self, filename):
+        self.store([], [filename])
+
+    def store(self, records, removed):
+        with self.lock, self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)', records)
+            self.db.executemany(
+                'DELETE FROM tracks WHERE filename = ?', [(name,) for name in removed])
+
+    def seek_table(self, filepath):
+        stat = filepath.stat()
+        with self.lock:
+            row = self.db.execute(
+                'SELECT mtime_ns, size, step, offsets FROM seek_tables WHERE path = ?',
+                (str(filepath),)).fetchone()
+
+        if row and row[:2] == (stat.st_mtime_ns, stat.st_size):
+            return mp3info.SeekTable(row[2], array('Q', row[3]).tolist())
+
+        table = mp3info.seek_table(filepath)
+        with self.lock, self.db:
+            self.db.execute(
+                'INSERT OR REPLACE INTO seek_tables VALUES (?, ?, ?, ?, ?)',
+                (str(filepath), stat.st_mtime_ns, stat.st_size, table.step,
+                 array('Q', table.offsets).tobytes()))
+        return table
+
+    @staticmethod
+    def probe(filepath, mtime_ns, size):
+        try:
+            info = mp3info.probe(filepath)
+        except Exception as e:
+            logger.warning(f"Probe failed for '{filepath.name}': {e}")
+            return TrackRecord(filepath.name, mtime_ns, size, filepath.stem, '', '', 0, 0)
+
+        tags = info.tags
+        return TrackRecord(
+            filepath.name, mtime_ns, size, tags.get('title') or filepath.stem,
+            tags.get('artist', ''), tags.get('album', ''), info.duration, info.bitrate)
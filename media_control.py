@@ -1,24 +1,39 @@
 #!/usr/bin/env python3
 
 import sys
-from time import sleep
+from time import monotonic, sleep
 
 import Ice
 
-Ice.loadSlice('-I{} spotifice_v0.ice'.format(Ice.getSliceDir()))
-import Spotifice  # type: ignore # noqa: E402
+import tracing
+from slice_loader import Spotifice
 
+PAGE_SIZE = 20
+READY_TIMEOUT = 5  # seconds for servers being started along with us
 
-def get_proxy(ic, property, cls):
-    proxy = ic.propertyToProxy(property)
 
-    for _ in range(5):
+def wait_ready(proxy, timeout=READY_TIMEOUT):
+    """Ping proxy until its server is up, retrying with exponential backoff;
+    the last error is raised once timeout seconds have passed"""
+    deadline = monotonic() + timeout
+    delay = 0.01
+    while True:
         try:
             proxy.ice_ping()
-            break
-        except Ice.ConnectionRefusedException:
-            sleep(0.5)
+            return
+        except (Ice.ConnectionRefusedException, Ice.ConnectTimeoutException):
+            if (remaining := deadline - monotonic()) <= 0:
+                raise
+            sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.5)
+
+
+def get_proxy(ic, property, cls, timeout=READY_TIMEOUT):
+    proxy = ic.propertyToProxy(property)
+    if proxy is None:
+        raise RuntimeError(f'Missing property {property}')
 
+    wait_ready(proxy, timeout)
     object = cls.checkedCast(proxy)
     if object is None:
         raise RuntimeError(f'Invalid proxy for {property}')
@@ -26,15 +41,36 @@ def get_proxy(ic, property, cls):
     return object
 
 
+def get_replicas(ic, server):
+    """server and the replicas in MediaServer.Replica.<n>.Proxy properties"""
+    replicas = ic.getProperties().getPropertiesForPrefix('MediaServer.Replica.')
+    return [server] + [Spotifice.MediaServerPrx.uncheckedCast(ic.stringToProxy(proxy))
+                       for _, proxy in sorted(replicas.items())]
+
+
+def traced_play(render):
+    """render.play() under a new trace, reported with trace_report.py"""
+    trace = tracing.new_trace_id()
+    with tracing.span(trace, 'control', 'play'):
+        render.play(context=tracing.trace_context(trace))
+    if tracing.span_log:
+        print(f"Play traced as {trace}")
+
+
 def main(ic):
+    tracing.configure(ic.getProperties())
     server = get_proxy(ic, 'MediaServer.Proxy', Spotifice.MediaServerPrx)
     render = get_proxy(ic, 'MediaRender.Proxy', Spotifice.MediaRenderPrx)
 
-    print("Fetching all tracks...")
-    tracks = server.get_all_tracks()
+    print("Fetching first page of tracks...")
+    page = server.list_tracks(Spotifice.SortKey.Title, '', PAGE_SIZE)
+    tracks = page.tracks
     for t in tracks:
         print(f"- {t.title}")
 
+    if page.next_cursor:
+        print("- ...")
+
     if not tracks:
         print("No tracks found.")
         return
@@ -42,17 +78,19 @@ def main(ic):
     print(f"Requesting info for track {tracks[0].id}")
     print(f"Track title: {tracks[0].title}")
 
-    render.bind_media_server(server)
+    render.bind_media_servers(get_replicas(ic, server))
     render.stop()
 
     print("Loading track into MediaRender...")
     render.load_track(tracks[0].id)
-    render.play()
+    traced_play(render)
     sleep(5)  # Let it play for 5 seconds
 
-    render.stop()
-    render.load_track(tracks[1].id)
-    render.play()
+    print("Queueing the rest of the page...")
+    for track in tracks[1:]:
+        render.enqueue(track.id)
+
+    render.next()
     sleep(3)
 
 
@@ -2,25 +2,516 @@
 
 import logging
 import sys
+import threading
+from collections import deque
 from contextlib import contextmanager
+from functools import partial
+from time import monotonic
 
 import Ice
 from Ice import identityToString as id2str
 
-from gst_player import GstPlayer
-
-Ice.loadSlice('-I{} spotifice_v0.ice'.format(Ice.getSliceDir()))
-import Spotifice  # type: ignore # noqa: E402
+import mp3info
+import tracing
+from chunk_sizer import ChunkSizer
+from gst_player import GstPlayer, PlayerWorkers, network_clock
+from jitter_buffer import JitterBuffer, parse_watermark
+from media_stats import FACET as STATS_FACET
+from media_stats import StatsI
+from metrics import Registry
+from slice_loader import Spotifice
+from track_cache import TrackCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("MediaRender")
 
+READ_TIMEOUT_MS = 5000  # a stream read taking longer fails over to another replica
+
+
+class AudioSinkI(Spotifice.AudioSink):
+    """Receives pushed chunks and hands them out in stream order"""
+
+    def __init__(self):
+        self.chunks = {}  # offset -> AudioChunk
+        self.next_offset = 0
+        self.end_offset = None
+        self.ready_c = threading.Condition()
+
+    def push_chunk(self, offset, chunk, current=None):
+        with self.ready_c:
+            self.chunks[offset] = chunk
+            self.ready_c.notify()
+
+    def end_of_stream(self, offset, current=None):
+        with self.ready_c:
+            self.end_offset = offset
+            self.ready_c.notify()
+
+    def is_ready(self):
+        return self.next_offset in self.chunks or self.next_offset == self.end_offset
+
+    def read(self, timeout=None):
+        with self.ready_c:
+            if not self.ready_c.wait_for(self.is_ready, timeout):
+                logger.warning("Timeout waiting for pushed chunk")
+                return None
+
+            chunk = self.chunks.pop(self.next_offset, b'')
+            self.next_offset += len(chunk)
+            return chunk
+
+
+class ThroughputMeter:
+    """Moving average of the observed transfer rate, in bytes/s"""
+
+    def __init__(self, alpha=0.3):
+        self.alpha = alpha
+        self.rate = None
+
+    def add(self, nbytes, elapsed):
+        if elapsed <= 0:
+            return
+
+        sample = nbytes / elapsed
+        self.rate = sample if self.rate is None else \
+            self.rate + self.alpha * (sample - self.rate)
+
+
+def choose_bitrate(variants, rate, headroom=1.5):
+    """Highest variant that rate (bytes/s) sustains with headroom; the original
+    (last) one while there is no measurement"""
+    if rate is None:
+        return variants[-1]
+
+    affordable = [bitrate for bitrate in variants
+                  if bitrate and bitrate * 125 * headroom <= rate]
+    return affordable[-1] if affordable else variants[0]
+
+
+def observe(nbytes, elapsed, meter, sizer):
+    meter.add(nbytes, elapsed)
+    if sizer:
+        sizer.observe(nbytes, elapsed)
+
+
+class ChunkReader:
+    """Pulls a stream with offset-addressed read_chunks.
+
+    Steps down to a lower bitrate variant when the measured rate can not sustain
+    real-time playback of the current one, and back up once it affords a higher
+    one; the server finds where to go on from through the seek tables. If the
+    server stops responding, reopens the stream on the next of replicas(server)
+    and goes on from the same offset; a stream the server closed, as it does
+    with those idle past its lease, is reopened on the same server. With a
+    ChunkSizer, it sizes the reads instead of chunks_per_read and keeps as many
+    of them in flight as the sizer's depth, each at the offset the previous one
+    ends at.
+    """
+
+    SWITCH_INTERVAL = 2  # seconds between bitrate switch attempts
+
+    def __init__(self, server, render_id, track_id, chunks_per_read, meter,
+                 variants=(0,), bitrate=0, replicas=lambda failed: [],
+                 failovers=None, sizer=None):
+        self.server = server
+        self.render_id = render_id
+        self.track_id = track_id
+        self.chunks_per_read = chunks_per_read
+        self.meter = meter
+        self.variants = variants
+        self.bitrate = bitrate
+        self.replicas = replicas
+        self.failovers = failovers
+        self.sizer = sizer
+        self.trace = None  # of the play waiting for the first read
+        self.offset = 0
+        self.pending = deque()
+        self.inflight = deque()  # (offset, nbytes, reads in flight, sent, Future)
+        self.seek_position = None  # ms, to locate again after a bitrate switch
+        self.switch_after = 0  # monotonic time of the next switch attempt
+
+    def __call__(self, chunk_size, reopened=False):
+        if not self.pending:
+            try:
+                self.fetch(chunk_size)
+            except Spotifice.IOError as e:
+                logger.error(e)
+                return None
+            except Spotifice.StreamError as e:
+                # e.g. a prefetched stream reaped while the current track played
+                if reopened or not self.reopen(self.server):
+                    logger.critical(e)
+                    return None
+                logger.warning(f"Stream of '{self.track_id}' reopened at offset "
+                               f"{self.offset}: {e.reason}")
+                return self(chunk_size, reopened=True)
+            except Ice.LocalException as e:
+                if not self.fail_over(e):
+                    logger.critical(e)
+                    return None
+                return self(chunk_size)
+            except Ice.Exception as e:
+                logger.critical(e)
+                return None
+
+            if not self.pending:
+                return b''
+
+        return self.pending.popleft()
+
+    def locate(self, position):
+        """Function moving the reader to position (ms), for JitterBuffer.reset"""
+        offset = self.server.seek_stream(self.render_id, position)
+        bitrate = self.bitrate
+        return lambda: self.seek(position, offset, bitrate)
+
+    def seek(self, position, offset, bitrate):
+        """Continue from position (ms), at offset unless the stream switched
+        bitrate since it was located"""
+        self.offset = offset
+        self.seek_position = None if bitrate == self.bitrate else position
+        self.pending.clear()
+        self.inflight.clear()
+
+    def fetch(self, chunk_size):
+        if self.seek_position is not None:
+            self.offset = self.server.seek_stream(self.render_id, self.seek_position)
+            self.seek_position = None
+            self.inflight.clear()
+
+        count, depth = self.chunks_per_read, 1
+        if self.sizer:
+            (chunk_size, count), depth = self.sizer.next_read(), self.sizer.depth
+
+        trace, self.trace = self.trace, None
+        with tracing.span(trace, 'render', 'first_read'):
+            server = tracing.traced_proxy(
+                self.server.ice_invocationTimeout(READ_TIMEOUT_MS), trace)
+            offset = self.inflight[-1][0] + self.inflight[-1][1] if self.inflight \
+                else self.offset
+            while len(self.inflight) < depth:
+                self.inflight.append((offset, count * chunk_size, len(self.inflight) + 1,
+                                      monotonic(), server.read_chunksAsync(
+                                          self.render_id, offset, count, chunk_size)))
+                offset += count * chunk_size
+
+            _, wanted, concurrent, sent, future = self.inflight.popleft()
+            chunks = future.result()
+
+        nbytes = sum(len(chunk) for chunk in chunks)
+        elapsed = monotonic() - sent
+        self.meter.add(nbytes, elapsed / concurrent)  # the share of the link it had
+        if self.sizer:
+            self.sizer.observe(nbytes, elapsed)
+        if nbytes != wanted:
+            # the track ended or the server bounded the read: the reads sent
+            # after it start past where it ended
+            self.inflight.clear()
+
+        self.pending.extend(chunks)
+        self.offset += nbytes
+        if chunks:
+            self.adapt_bitrate()
+
+    def fail_over(self, error):
+        """Reopen the stream on another replica; False if none takes it"""
+        for server in self.replicas(self.server):
+            if not self.reopen(server):
+                continue
+
+            logger.warning(f"Stream of '{self.track_id}' failed over at offset "
+                           f"{self.offset}: {error}")
+            self.server = server
+            if self.failovers:
+                self.failovers.inc()
+            return True
+
+        return False
+
+    def reopen(self, server):
+        """Open the stream on server at the current offset; False if it fails"""
+        try:
+            if self.bitrate:
+                self.switch(server, self.bitrate)
+            else:
+                server.open_stream(self.track_id, self.render_id)
+        except Ice.Exception as e:
+            logger.warning(f"Replica '{id2str(server.ice_getIdentity())}' failed: {e}")
+            return False
+
+        self.pending.clear()
+        self.inflight.clear()
+        return True
+
+    def adapt_bitrate(self):
+        if not self.bitrate or self.meter.rate is None or monotonic() < self.switch_after:
+            return
+
+        target = choose_bitrate(self.variants, self.meter.rate)
+        if not target or target == self.bitrate or \
+                target < self.bitrate <= self.meter.rate / 125:
+            return  # down only when the current bitrate is not sustained
+
+        bitrate = self.bitrate
+        self.switch(self.server, target)
+        self.switch_after = monotonic() + self.SWITCH_INTERVAL
+        if self.bitrate == bitrate:
+            logger.info(f"Variant for {target}k not ready yet, retrying later")
+        else:
+            logger.info(f"Switched from {bitrate}k to {self.bitrate}k")
+
+    def switch(self, server, bitrate):
+        """Open the variant for bitrate on server, where the stream is now"""
+        point = server.open_stream_variant_at(
+            self.track_id, self.render_id, bitrate, self.bitrate, self.offset)
+        if (point.bitrate, point.offset) != (self.bitrate, self.offset):
+            self.inflight.clear()  # reads sent ahead are of the file left
+        self.offset = point.offset
+        self.set_bitrate(point.bitrate)
+
+    def set_bitrate(self, bitrate):
+        self.bitrate = bitrate
+        if self.sizer:
+            self.sizer.byte_rate = bitrate * 125
+
+
+class TokenReader:
+    """Pulls a stateless stream with read_token.
+
+    Servers keep nothing for the stream, so if one stops responding the same
+    token is read from the next of replicas(server).
+    """
+
+    def __init__(self, server, track_id, chunks_per_read, meter, bitrate=0,
+                 replicas=lambda failed: [], failovers=None, sizer=None):
+        self.server = server
+        self.track_id = track_id
+        self.chunks_per_read = chunks_per_read
+        self.meter = meter
+        self.bitrate = bitrate  # highest variant to stream, 0 for the original
+        self.replicas = replicas
+        self.failovers = failovers
+        self.sizer = sizer
+        self.trace = None
+        self.token = None
+        self.pending = deque()
+
+    def open(self, position=0):
+        self.token = tracing.traced_proxy(self.server, self.trace).open_stream_token(
+            self.track_id, self.bitrate, position)
+        return self
+
+    def __call__(self, chunk_size):
+        if not self.pending:
+            try:
+                self.fetch(chunk_size)
+            except (Spotifice.IOError, Spotifice.StreamError) as e:
+                logger.error(e)
+                return None
+            except Ice.LocalException as e:
+                if not self.fail_over(e):
+                    logger.critical(e)
+                    return None
+                return self(chunk_size)
+            except Ice.Exception as e:
+                logger.critical(e)
+                return None
+
+            if not self.pending:
+                return b''
+
+        return self.pending.popleft()
+
+    def fetch(self, chunk_size):
+        count = self.chunks_per_read
+        if self.sizer:
+            chunk_size, count = self.sizer.next_read()
+
+        trace, self.trace = self.trace, None
+        start = monotonic()
+        with tracing.span(trace, 'render', 'first_read'):
+            server = self.server.ice_invocationTimeout(READ_TIMEOUT_MS)
+            result = tracing.traced_proxy(server, trace).read_token(
+                self.token, count, chunk_size)
+        observe(sum(len(chunk) for chunk in result.chunks), monotonic() - start,
+                self.meter, self.sizer)
+        self.pending.extend(result.chunks)
+        self.token = result.token
+
+    def fail_over(self, error):
+        if not (servers := self.replicas(self.server)):
+            return False
+
+        logger.warning(f"Stream of '{self.track_id}' failed over: {error}")
+        self.server = servers[0]
+        if self.failovers:
+            self.failovers.inc()
+        return True
+
+    def locate(self, position):
+        """Function moving the reader to position (ms), for JitterBuffer.reset"""
+        token = self.server.open_stream_token(self.track_id, self.bitrate, position)
+        return lambda: self.seek(token)
+
+    def seek(self, token):
+        self.token = token
+        self.pending.clear()
+
+
+class FileReader:
+    """Reads a cached track from its local file"""
+
+    bitrate = 0  # the original file, as cached
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'rb')
+        self.table = None
+
+    def __call__(self, chunk_size):
+        try:
+            return self.file.read(chunk_size)
+        except OSError as e:
+            logger.error(f"Error reading '{self.path}': {e}")
+            return None
+
+    def locate(self, position):
+        """Function moving the reader to position (ms), for JitterBuffer.reset"""
+        if self.table is None:
+            try:
+                self.table = mp3info.seek_table(self.path)
+            except (OSError, ValueError) as e:
+                raise Spotifice.IOError(str(self.path), f"Error indexing file: {e}")
+
+        offset = self.table.offset(position)
+        return lambda: self.file.seek(offset)
+
+    def close(self):
+        self.file.close()
+
+
+class CacheFiller:
+    """Passes on what reader pulls while writing it to a track cache entry,
+    committed once the whole track has streamed in order. Errors, seeks and
+    bitrate switches drop the entry."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.bitrate = reader.bitrate
+
+    def __call__(self, chunk_size):
+        chunk = self.reader(chunk_size)
+        if not self.writer:
+            return chunk
+
+        if chunk is None or self.reader.bitrate != self.bitrate:
+            self.drop()
+        elif chunk == b'':
+            self.writer.commit()
+            self.writer = None
+        elif not self.writer.write(chunk):
+            self.writer = None  # over the cache budget
+        return chunk
+
+    def locate(self, position):
+        reposition = self.reader.locate(position)
+
+        def seek():
+            self.drop()
+            reposition()
+        return seek
+
+    def drop(self):
+        if self.writer:
+            self.writer.abort()
+            self.writer = None
+
+    def close(self):
+        self.drop()
+
+
+def stream_reader(buffer):
+    """Reader pulling the stream of buffer, None without one"""
+    if not buffer:
+        return None
+    fetch = buffer.fetch
+    return fetch.reader if isinstance(fetch, CacheFiller) else fetch
+
+
+class Prefetch:
+    """Queue head opened and buffering ahead of its turn"""
+
+    def __init__(self, track, render_id):
+        self.track = track
+        self.render_id = render_id
+        self.buffer = None
+        self.ready = threading.Event()
+
+
+def next_identity(render_id):
+    """Second stream identity of a render, used to open the next track early"""
+    return Ice.Identity(name=render_id.name + '.next', category=render_id.category)
+
 
 class MediaRenderI(Spotifice.MediaRender):
-    def __init__(self, player):
+    CHUNK_SIZE = 4096
+
+    def __init__(self, player, push_window=0, watermarks=('1s', '4s'),
+                 chunks_per_read=4, adaptive=True, stream_tokens=False,
+                 adaptive_chunks=True, track_cache=None, byte_rate=16000,
+                 reads_in_flight=4):
         self.player = player
-        self.server: Spotifice.MediaServerPrx = None
+        self.track_cache = track_cache
+        self.adaptive_chunks = adaptive_chunks
+        self.reads_in_flight = reads_in_flight  # at most, for offset-addressed reads
+        self.stream_tokens = stream_tokens
+        self.push_window = push_window
+        self.chunks_per_read = chunks_per_read
+        self.adaptive = adaptive
+        self.throughput = ThroughputMeter()
+        self.watermarks = watermarks  # as parse_watermark takes them
+        self.byte_rate = byte_rate  # of streams whose bitrate is unknown
+        self.server: Spotifice.MediaServerPrx = None  # for catalog requests
+        self.servers = []  # replicas streams are spread over
         self.current_track = None
+        self.sink_prx = None
+        self.group = None  # (MediaServerPrx, AudioSinkI) of the group joined
+        self.buffer = None
+        self.queue = deque()  # TrackInfo
+        self.prefetched = None
+        self.stream_id = None  # identity of the stream feeding the player
+        self.play_current = None
+        self.plays = 0  # play() calls, to match track_ended with its playback
+        self.start_position = 0  # ms, where the next play() starts
+        self.position_base = 0   # ms, track position when the player clock was 0
+        self.lock = threading.RLock()
+        self.metrics = Registry()
+        self.register_metrics()
+
+    def register_metrics(self):
+        registry = self.metrics
+        self.need_data_wait = registry.histogram(
+            'spotifice_render_need_data_seconds', "Time the player waits for a chunk")
+        self.underruns = registry.counter(
+            'spotifice_render_underruns_total', "Reads that found the buffer empty")
+        self.transitions = registry.counter(
+            'spotifice_render_gapless_transitions_total', "Tracks spliced without a gap")
+        self.failovers = registry.counter(
+            'spotifice_render_failovers_total', "Streams moved to another replica")
+        self.cache_hits = registry.counter(
+            'spotifice_render_cache_hits_total', "Tracks played from the local cache")
+        self.cache_misses = registry.counter(
+            'spotifice_render_cache_misses_total', "Tracks not in the local cache")
+        registry.gauge('spotifice_render_cache_bytes', "Size of the local track cache",
+                       function=lambda: self.track_cache.size if self.track_cache else 0)
+        registry.gauge('spotifice_render_buffer_bytes', "Read-ahead buffer fill level",
+                       function=lambda: self.buffer.level if self.buffer else 0)
+        registry.gauge('spotifice_render_throughput_bytes',
+                       "Measured transfer rate (B/s)",
+                       function=lambda: self.throughput.rate or 0)
+        registry.gauge('spotifice_render_queue_tracks', "Tracks in the play queue",
+                       function=lambda: len(self.queue))
 
     def ensure_player_stopped(self):
         if self.player.is_playing():
@@ -33,19 +524,54 @@ class MediaRenderI(Spotifice.MediaRender):
     # --- RenderConnectivity ---
 
     def bind_media_server(self, media_server, current=None):
-        try:
-            proxy = media_server.ice_timeout(500)
-            proxy.ice_ping()
-        except Ice.ConnectionRefusedException as e:
-            raise Spotifice.BadReference(reason=f"MediaServer not reachable: {e}")
+        self.bind_media_servers([media_server], current)
+
+    def bind_media_servers(self, media_servers, current=None):
+        if not media_servers:
+            raise Spotifice.BadReference(reason="No MediaServer given")
 
-        self.server = media_server
-        logger.info(f"Bound to MediaServer '{id2str(media_server.ice_getIdentity())}'")
+        reachable = []
+        for media_server in media_servers:
+            try:
+                proxy = media_server.ice_timeout(500)
+                proxy.ice_ping()
+                reachable.append(media_server)
+            except Ice.LocalException as e:
+                error = e
+                logger.warning(
+                    f"MediaServer '{id2str(media_server.ice_getIdentity())}' "
+                    f"not reachable: {e}")
+
+        if not reachable:
+            raise Spotifice.BadReference(reason=f"MediaServer not reachable: {error}")
+
+        self.server = reachable[0]
+        self.servers = list(media_servers)
+        for media_server in media_servers:
+            logger.info(
+                f"Bound to MediaServer '{id2str(media_server.ice_getIdentity())}'")
 
     def unbind_media_server(self, current=None):
         self.server = None
+        self.servers = []
         logger.info("Unbound MediaServer")
 
+    def servers_by_load(self, exclude=None):
+        """Reachable replicas, those with fewer open streams first; all of them
+        are asked at once"""
+        probes = [(index, server,
+                   server.ice_invocationTimeout(500).get_active_streamsAsync())
+                  for index, server in enumerate(self.servers) if server != exclude]
+        loads = []
+        for index, server, probe in probes:
+            try:
+                loads.append((probe.result(), index, server))
+            except Ice.LocalException as e:
+                logger.warning(
+                    f"MediaServer '{id2str(server.ice_getIdentity())}' failed: {e}")
+
+        return [server for _, _, server in sorted(loads)]
+
     # --- ContentManager ---
 
     def load_track(self, track_id, current=None):
@@ -54,6 +580,7 @@ class MediaRenderI(Spotifice.MediaRender):
         try:
             with self.keep_playing_state(current):
                 self.current_track = self.server.get_track_info(track_id)
+                self.start_position = 0
 
             logger.info(f"Current track set to: {self.current_track.title}")
 
@@ -64,6 +591,137 @@ class MediaRenderI(Spotifice.MediaRender):
     def get_current_track(self, current=None):
         return self.current_track
 
+    def enqueue(self, track_id, current=None):
+        self.ensure_server_bound()
+
+        track = self.server.get_track_info(track_id)
+        with self.lock:
+            self.queue.append(track)
+
+        logger.info(f"Enqueued: {track.title}")
+        self.start_prefetch()
+
+    def next(self, current=None):
+        self.ensure_server_bound()
+        if not self.queue:
+            raise Spotifice.TrackError(reason="Queue is empty")
+
+        with self.keep_playing_state(current):
+            with self.lock:
+                prefetch = self.drop_prefetch()
+                self.current_track = self.queue.popleft()
+                self.start_position = 0
+            self.release_prefetch(prefetch)
+
+        logger.info(f"Current track set to: {self.current_track.title}")
+
+    def clear_queue(self, current=None):
+        with self.lock:
+            self.queue.clear()
+            prefetch = self.drop_prefetch()
+
+        self.release_prefetch(prefetch)
+
+    def get_queue(self, current=None):
+        with self.lock:
+            return list(self.queue)
+
+    # --- next track prefetch ---
+
+    def start_prefetch(self):
+        """Open the queue head in the background while the current track plays"""
+        with self.lock:
+            if self.push_window or not self.buffer or self.prefetched or not self.queue \
+                    or not self.player.is_playing():
+                return
+
+            render_id = self.play_current.id
+            if self.stream_id == render_id:
+                render_id = next_identity(render_id)
+            self.prefetched = prefetch = Prefetch(self.queue[0], render_id)
+
+        threading.Thread(target=self.prefetch, args=(prefetch,), daemon=True).start()
+
+    def prefetch(self, prefetch):
+        try:
+            buffer = self.open_source(prefetch.track, prefetch.render_id)
+            logger.info(f"Prefetching: {prefetch.track.title}")
+        except Ice.Exception as e:
+            logger.error(f"Prefetch of '{prefetch.track.id}' failed: {e}")
+            buffer = None
+
+        with self.lock:
+            if self.prefetched is prefetch:
+                prefetch.buffer, buffer = buffer, None
+
+        if buffer:  # dropped while opening
+            buffer.stop()
+            self.close_prefetched(buffer, prefetch.render_id)
+        prefetch.ready.set()
+
+    def drop_prefetch(self):
+        prefetch, self.prefetched = self.prefetched, None
+        if prefetch and prefetch.buffer:
+            prefetch.buffer.stop()
+        return prefetch
+
+    def release_prefetch(self, prefetch):
+        """Close the stream of a dropped prefetch, outside the lock"""
+        if prefetch:
+            self.close_prefetched(prefetch.buffer, prefetch.render_id)
+
+    @staticmethod
+    def close_prefetched(buffer, render_id):
+        # on the replica the reader opened it on, which may not be self.server;
+        # cached and token streams leave nothing open
+        if isinstance(reader := stream_reader(buffer), ChunkReader):
+            try:
+                reader.server.close_stream(render_id)
+            except Ice.LocalException as e:
+                logger.warning(f"Can not close prefetched stream: {e}")
+
+    def splice_next(self):
+        """Hand the prefetched queue head to the player in place of the ended
+        track, so playback goes on without a pipeline restart"""
+        with self.lock:
+            prefetch = self.prefetched
+
+        if not prefetch or not prefetch.ready.wait(self.player.EVENT_TIMEOUT_SECS):
+            return False
+
+        with self.lock:
+            if self.prefetched is not prefetch or not prefetch.buffer or not self.buffer:
+                return False
+
+            self.buffer.stop()
+            self.buffer = prefetch.buffer
+            self.stream_id = prefetch.render_id
+            self.current_track = self.queue.popleft()
+            self.prefetched = None
+            self.position_base = -self.player.get_position()
+
+        self.transitions.inc()
+        logger.info(f"Gapless transition to: {self.current_track.title}")
+        self.start_prefetch()
+        return True
+
+    def track_ended(self, play):
+        """Releases the streams of a track that played to the end, and starts the
+        next queued one when it was not prefetched"""
+        current = self.play_current
+        with self.lock:
+            if not self.buffer or play != self.plays:
+                return
+            grouped = self.group is not None
+
+        try:
+            self.stop(current)
+            if self.queue and not grouped:
+                self.next(current)
+                self.play(current)
+        except Ice.Exception as e:
+            logger.error(f"Can not play next queued track: {e}")
+
     # --- PlaybackController ---
 
     @contextmanager
@@ -78,48 +736,391 @@ class MediaRenderI(Spotifice.MediaRender):
                 self.play(current)
 
     def play(self, current=None):
-        def get_chunk_hook(chunk_size):
-            try:
-                return self.server.get_audio_chunk(current.id, chunk_size)
-            except Spotifice.IOError as e:
-                logger.error(e)
-            except Ice.Exception as e:
-                logger.critical(e)
-
         assert current, "remote invocation required"
 
+        trace = tracing.current_trace(current)
+        with tracing.span(trace, 'render', 'play'):
+            self.start_playing(current, trace)
+
+        player = self.player
+        tracing.record(trace, 'render', 'pipeline', player.activated,
+                       player.pipeline_ready)
+        if player.time_to_first_audio is not None:
+            tracing.record(trace, 'render', 'first_audio', player.play_requested,
+                           player.play_requested + player.time_to_first_audio)
+
+    def start_playing(self, current, trace):
         self.ensure_player_stopped()
         self.ensure_server_bound()
 
         if not self.current_track:
             raise Spotifice.TrackError(reason="No track loaded")
 
+        self.leave_group(current)
+        with self.lock:
+            prefetch = self.drop_prefetch()
+        self.release_prefetch(prefetch)
+
+        position, self.start_position = self.start_position, 0
+        if self.push_window:
+            with tracing.span(trace, 'render', 'open_stream'):
+                server = tracing.traced_proxy(self.server, trace)
+                _, bitrate = self.open_track(self.current_track, current.id, server)
+                if position:
+                    server.seek_stream(current.id, position)
+            buffer = self.start_buffer(self.setup_push(current),
+                                       bitrate or self.current_track.bitrate)
+        else:
+            buffer = self.open_source(self.current_track, current.id, position, trace)
+
+        with self.lock:
+            self.buffer = buffer
+            self.stream_id = current.id
+            self.play_current = current
+            self.position_base = position
+            self.plays += 1
+
+        self.player.configure(self.read_buffer(), partial(self.track_ended, self.plays))
+        with tracing.span(trace, 'render', 'confirm_play'):
+            if not self.player.confirm_play_starts():
+                self.abort_play(current)
+                raise Spotifice.PlayerError(reason="Failed to confirm playback")
+
+        self.start_prefetch()
+
+    def open_track(self, track, render_id, server):
+        """Open a stream for track on server; (variants, bitrate) being streamed"""
+        variants, bitrate = [0], 0
         try:
-            self.server.open_stream(self.current_track.id, current.id)
+            if self.adaptive:
+                variants = server.get_variants(track.id)
+                bitrate = server.open_stream_variant(
+                    track.id, render_id, choose_bitrate(variants, self.throughput.rate))
+                logger.info(f"Streaming '{track.id}' at {bitrate}k")
+            else:
+                server.open_stream(track.id, render_id)
         except Spotifice.BadIdentity as e:
             logger.error(f"Error starting stream: {e.reason}")
             raise Spotifice.StreamError(reason="Strean setup failed")
 
-        self.player.configure(get_chunk_hook)
+        return variants, bitrate
+
+    def open_source(self, track, render_id, position=0, trace=None):
+        """Started read-ahead buffer pulling track from the local cache or else
+        the least loaded replica, from position (ms). Opening it and its first
+        read go along trace."""
+        if self.track_cache:
+            with tracing.span(trace, 'render', 'open_cached'):
+                cached = self.cached_reader(track, position)
+            if cached:
+                return self.start_buffer(cached, track.bitrate)
+
+        with tracing.span(trace, 'render', 'pick_server'):
+            servers = self.servers_by_load()
+        if not servers:
+            raise Spotifice.IOError(reason="No MediaServer available")
+
+        server = servers[0]
+        traced_server = tracing.traced_proxy(server, trace)
+        if self.stream_tokens:
+            with tracing.span(trace, 'render', 'open_stream'):
+                bitrate = 0
+                if self.adaptive:
+                    bitrate = choose_bitrate(traced_server.get_variants(track.id),
+                                             self.throughput.rate)
+                reader = TokenReader(server, track.id, self.chunks_per_read,
+                                     self.throughput, bitrate, self.servers_by_load,
+                                     self.failovers, self.chunk_sizer(track, bitrate))
+                reader.trace = trace
+                reader.open(position)
+            return self.start_buffer(self.filling(track, reader, position),
+                                     bitrate or track.bitrate)
+
+        with tracing.span(trace, 'render', 'open_stream'):
+            variants, bitrate = self.open_track(track, render_id, traced_server)
+            reader = ChunkReader(server, render_id, track.id, self.chunks_per_read,
+                                 self.throughput, variants, bitrate,
+                                 self.servers_by_load, self.failovers,
+                                 self.chunk_sizer(track, bitrate))
+            reader.trace = trace
+            if position:
+                reader.offset = traced_server.seek_stream(render_id, position)
+        return self.start_buffer(self.filling(track, reader, position),
+                                 bitrate or track.bitrate)
+
+    def cached_reader(self, track, position):
+        """FileReader of track from position (ms) if it is cached, else None"""
+        if (path := self.track_cache.get(track)) is None:
+            self.cache_misses.inc()
+            return None
+
+        reader = None
+        try:
+            reader = FileReader(path)
+            if position:
+                reader.locate(position)()
+        except (OSError, Spotifice.IOError) as e:
+            if reader:
+                reader.close()
+            logger.warning(f"Dropping cached '{track.id}': {e}")
+            self.track_cache.discard(path.name)
+            return None
+
+        self.cache_hits.inc()
+        logger.info(f"Playing '{track.id}' from the cache")
+        return reader
+
+    def filling(self, track, reader, position):
+        """reader, also filling the cache if it streams the whole original track"""
+        if not self.track_cache or position or reader.bitrate not in (0, track.bitrate):
+            return reader
+
+        try:
+            writer = self.track_cache.writer(track)
+        except OSError as e:
+            logger.warning(f"Can not cache '{track.id}': {e}")
+            return reader
+        return CacheFiller(reader, writer) if writer else reader
+
+    def chunk_sizer(self, track, bitrate):
+        """ChunkSizer keeping the low watermark as margin, reading at most what
+        refills the buffer up to the high one"""
+        if not self.adaptive_chunks:
+            return None
+
+        bitrate = bitrate or track.bitrate or 0
+        low, high = self.buffer_watermarks(bitrate)
+        return ChunkSizer(self.CHUNK_SIZE * self.chunks_per_read, low, bitrate * 125,
+                          max_read=max(high - low, self.CHUNK_SIZE),
+                          max_depth=self.reads_in_flight)
+
+    def buffer_watermarks(self, bitrate):
+        """(low, high) watermarks in bytes for a stream at bitrate (kbps), those
+        given in seconds converted at its byte rate"""
+        low, high = (parse_watermark(value, (bitrate or 0) * 125 or self.byte_rate)
+                     for value in self.watermarks)
+        return low, max(high, low + self.CHUNK_SIZE)
+
+    def start_buffer(self, fetch, bitrate):
+        return JitterBuffer(fetch, *self.buffer_watermarks(bitrate), self.CHUNK_SIZE,
+                            self.underruns).start()
+
+    def seek(self, position, current=None):
+        if self.group:
+            # the group shares one pushed stream, members can not move it alone
+            raise Spotifice.PlayerError(reason="Can not seek in a group")
+
+        self.ensure_server_bound()
+        if position < 0:
+            raise Spotifice.PlayerError(reason="Invalid seek position")
+
+        if not self.player.is_playing():
+            self.start_position = position
+            return
+
+        if self.push_window:
+            # chunks already pushed can not be recalled, restart the push instead
+            with self.keep_playing_state(current):
+                self.start_position = position
+            return
+
+        with self.lock:
+            buffer = self.buffer
+
+        buffer.reset(buffer.fetch.locate(position))
+        self.player.flush()
+        self.position_base = position
+        logger.info(f"Seek to {position} ms")
+
+    def get_position(self, current=None):
+        if not self.player.is_playing():
+            return self.start_position
+        return self.position_base + self.player.get_position()
+
+    def setup_push(self, current):
+        sink = AudioSinkI()
+        self.sink_prx = Spotifice.AudioSinkPrx.uncheckedCast(
+            current.adapter.addWithUUID(sink))
+
+        try:
+            self.server.start_push(
+                current.id, self.sink_prx, self.CHUNK_SIZE, self.push_window)
+        except (Spotifice.BadReference, Spotifice.StreamError) as e:
+            logger.error(f"Error starting push: {e.reason}")
+            self.remove_sink(current)
+            raise Spotifice.StreamError(reason="Push setup failed")
+
+        return self.push_hook(current, sink, self.server)
+
+    def push_hook(self, current, sink, server):
+        def get_chunk_hook(chunk_size):
+            # a stalled push is an underrun, waited out while the sink is in use
+            while (chunk := sink.read(self.player.EVENT_TIMEOUT_SECS)) is None:
+                if self.sink_prx is not sink_prx:
+                    return None
+            if chunk:
+                credits_prx.grant_credits(current.id, 1)
+            return chunk
+
+        sink_prx = self.sink_prx
+        credits_prx = server.ice_oneway()
+        return get_chunk_hook
+
+    def read_buffer(self):
+        def get_chunk_hook(chunk_size):
+            with self.need_data_wait.time():
+                while buffer := self.buffer:
+                    chunk = buffer.read(chunk_size, self.player.EVENT_TIMEOUT_SECS)
+                    if chunk is None:
+                        continue  # an underrun: only the end of the stream ends it
+                    if chunk or not self.splice_next():
+                        return chunk
+
+        return get_chunk_hook
+
+    def remove_sink(self, current):
+        if self.sink_prx and current:
+            current.adapter.remove(self.sink_prx.ice_getIdentity())
+        self.sink_prx = None
+
+    def close_streams(self, server, render_id):
+        try:
+            server.close_stream(render_id)
+            server.close_stream(next_identity(render_id))
+        except Ice.LocalException as e:
+            logger.warning(f"Can not close streams: {e}")
+
+    # --- GroupMember ---
+
+    def join_group(self, server, track_id, current=None):
+        if self.player.is_playing():
+            self.stop(current)
+        self.leave_group(current)
+
+        self.current_track = server.get_track_info(track_id)
+        sink = AudioSinkI()
+        self.sink_prx = Spotifice.AudioSinkPrx.uncheckedCast(
+            current.adapter.addWithUUID(sink))
+        self.group = (server, sink)
+        logger.info(f"Joined group stream of '{track_id}'")
+        return self.sink_prx
+
+    def start_group(self, clock, current=None):
+        if not self.group:
+            raise Spotifice.PlayerError(reason="Not in a group")
+
+        self.ensure_player_stopped()
+        server, sink = self.group
+        buffer = self.start_buffer(self.push_hook(current, sink, server),
+                                   self.current_track.bitrate)
+        with self.lock:
+            self.buffer = buffer
+            self.stream_id = current.id
+            self.play_current = current
+            self.position_base = 0
+            self.plays += 1
+
+        net_clock = network_clock(clock.address, clock.port) if clock.address else None
+        self.player.configure(self.read_buffer(), partial(self.track_ended, self.plays),
+                              net_clock, clock.base_time)
         if not self.player.confirm_play_starts():
+            self.abort_play(current)
             raise Spotifice.PlayerError(reason="Failed to confirm playback")
 
+    def leave_group(self, current):
+        """Release the group stream, so the group no longer waits for this render"""
+        with self.lock:
+            group, self.group = self.group, None
+
+        if group and current:
+            self.close_streams(group[0], current.id)
+            self.remove_sink(current)
+
     def stop(self, current=None):
-        if self.server and current:
-            self.server.close_stream(current.id)
+        with self.lock:
+            buffer, self.buffer = self.buffer, None
+            prefetch = self.drop_prefetch()
+
+        if buffer:
+            buffer.stop()
+
+        self.leave_group(current)
+
+        # token streams leave nothing open on the servers
+        if self.server and current and (self.push_window or not self.stream_tokens):
+            # the current and prefetched streams may live on different replicas
+            readers = [stream_reader(b) for b in [buffer, prefetch and prefetch.buffer]]
+            servers = [reader.server for reader in readers
+                       if isinstance(reader, ChunkReader)] or [self.server]
+            for server in dict.fromkeys(servers):
+                self.close_streams(server, current.id)
+
+        self.remove_sink(current)
 
         if not self.player.stop():
             raise Spotifice.PlayerError(reason="Failed to confirm stop")
 
         logger.info("Stopped")
 
+    def abort_play(self, current):
+        """Stop a play the player did not confirm, so no stream of it stays open
+        and the player is free for the next one"""
+        try:
+            self.stop(current)
+        except Spotifice.PlayerError as e:
+            logger.error(f"Aborting play: {e.reason}")
+
 
-def main(ic, player):
-    servant = MediaRenderI(player)
+def render_identities(properties):
+    return properties.getPropertyAsListWithDefault(
+        'MediaRender.Identities', ['mediaRender1'])
+
+
+def main(ic, *players):
+    """Serve one MediaRender per player, named after MediaRender.Identities"""
+    properties = ic.getProperties()
+    tracing.configure(properties)
+    push_window = properties.getPropertyAsIntWithDefault('MediaRender.PushWindow', 0)
+    # seconds convert at each stream's bitrate, at ByteRate where it is unknown
+    byte_rate = properties.getPropertyAsIntWithDefault(
+        'MediaRender.Prefetch.ByteRate', 16000)
+    watermarks = tuple(
+        properties.getPropertyWithDefault(name, default)
+        for name, default in [('MediaRender.Prefetch.LowWatermark', '1s'),
+                              ('MediaRender.Prefetch.HighWatermark', '4s')])
+    for watermark in watermarks:
+        parse_watermark(watermark, byte_rate)  # fail on bad values at startup
+    chunks_per_read = properties.getPropertyAsIntWithDefault(
+        'MediaRender.ChunksPerRead', 4)
+    adaptive = properties.getPropertyAsIntWithDefault('MediaRender.AdaptiveBitrate', 1)
+    stream_tokens = properties.getPropertyAsIntWithDefault('MediaRender.StreamTokens', 0)
+    adaptive_chunks = properties.getPropertyAsIntWithDefault(
+        'MediaRender.AdaptiveChunks', 1)
+    reads_in_flight = properties.getPropertyAsIntWithDefault(
+        'MediaRender.ReadsInFlight', 4)
+    if reads_in_flight < 1:
+        raise ValueError(f"Invalid MediaRender.ReadsInFlight {reads_in_flight}")
+
+    # shared by every render of the process, which owns the directory
+    track_cache = None
+    if cache_dir := properties.getProperty('MediaRender.Cache.Directory'):
+        track_cache = TrackCache(cache_dir, int(properties.getPropertyWithDefault(
+            'MediaRender.Cache.Size', str(1024 ** 3))))
+
+    identities = render_identities(properties)
+    if len(identities) != len(players):
+        raise ValueError(
+            f"{len(identities)} render identities for {len(players)} players")
 
     adapter = ic.createObjectAdapter("MediaRenderAdapter")
-    proxy = adapter.add(servant, ic.stringToIdentity("mediaRender1"))
-    logger.info(f"MediaRender: {proxy}")
+    for name, player in zip(identities, players):
+        servant = MediaRenderI(
+            player, push_window, watermarks, chunks_per_read, bool(adaptive),
+            bool(stream_tokens), bool(adaptive_chunks), track_cache, byte_rate,
+            reads_in_flight)
+        proxy = adapter.add(servant, ic.stringToIdentity(name))
+        adapter.addFacet(StatsI(servant.metrics), proxy.ice_getIdentity(), STATS_FACET)
+        logger.info(f"MediaRender: {proxy}")
 
     adapter.activate()
     ic.waitForShutdown()
@@ -131,12 +1132,23 @@ if __name__ == "__main__":
     if len(sys.argv) < 2:
         sys.exit("Usage: media_render.py <config-file>")
 
-    player = GstPlayer()
-    player.start()
-    try:
-        with Ice.initialize(sys.argv[1]) as communicator:
-            main(communicator, player)
-    except KeyboardInterrupt:
-        logger.info("Server interrupted by user.")
-    finally:
-        player.shutdown()
+    with Ice.initialize(sys.argv[1]) as communicator:
+        properties = communicator.getProperties()
+        workers = PlayerWorkers(
+            properties.getPropertyAsIntWithDefault('MediaRender.Workers', 2))
+        players = [
+            GstPlayer(
+                pipeline=properties.getPropertyWithDefault(
+                    'MediaRender.Pipeline', GstPlayer.PIPELINE),
+                reuse_pipeline=bool(properties.getPropertyAsIntWithDefault(
+                    'MediaRender.ReusePipeline', 0)),
+                workers=workers)
+            for _ in render_identities(properties)]
+        try:
+            main(communicator, *players)
+        except KeyboardInterrupt:
+            logger.info("Server interrupted by user.")
+        finally:
+            for player in players:
+                player.shutdown()
+            workers.shutdown()
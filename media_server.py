@@ -1,130 +1,967 @@
 #!/usr/bin/env python3
 
+import hashlib
 import logging
+import mmap
+import os
 import sys
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
+from time import monotonic, time
 
 import Ice
 from Ice import identityToString as id2str
 
-Ice.loadSlice('-I{} spotifice_v0.ice'.format(Ice.getSliceDir()))
-import Spotifice  # type: ignore # noqa: E402
+import mp3info
+import tracing
+from bandwidth import DEFAULT_PRIORITY, BandwidthScheduler, DelayQueue
+from catalog_index import CatalogIndex
+from chunk_cache import BlockCache
+from handle_pool import HandlePool
+from library_index import LibraryIndex
+from media_stats import FACET as STATS_FACET
+from media_stats import StatsI
+from media_watcher import MediaWatcher
+from metrics import Registry
+from render_group import NetClock, RenderGroupI
+from slice_loader import Spotifice
+from stream_token import StreamToken, TokenSigner, TokenStreamGauge, version_digest
+from tracing import traced
+from transcoder import VariantCache
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("MediaServer")
 
 
+def content_version(mtime_ns, size):
+    """Version of a media file for render caches; copies keeping the mtime, as
+    replicas synced with rsync -t, share it"""
+    return f'{size:x}-{mtime_ns:x}'
+
+
+class MappedFile:
+    """Memory-mapped media file; reads are memoryview slices, not copies"""
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        with open(filepath, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else None
+
+        self.data = memoryview(self.map) if self.map else memoryview(b'')
+
+    def read_at(self, offset, size):
+        return self.data[offset:offset + size]
+
+    def close(self):
+        self.data.release()
+        try:
+            if self.map:
+                self.map.close()
+        except BufferError:
+            # chunks still being marshalled keep the map alive until collected
+            pass
+        except Exception as e:
+            logger.error(f"Error closing '{self.filepath}': {e}")
+
+
+def open_mapped_file(key):
+    filepath, *_ = key
+    return MappedFile(filepath)
+
+
 class StreamedFile:
-    def __init__(self, track_info, media_dir):
+    """Logical position over a track; file handles are borrowed from the pool"""
+
+    def __init__(self, track_info, filepath, pool, cache=None):
         self.track = track_info
-        filepath = media_dir / track_info.filename
+        self.filepath = filepath
+        self.position = 0
+        self.pool = pool
+        self.cache = cache
+        self.counters = ()  # metrics counting the bytes read
+        self.last_access = monotonic()
 
         try:
-            self.file = open(filepath, 'rb')
+            stat = filepath.stat()
+            self.key = (str(filepath), stat.st_mtime_ns, stat.st_size)
+            with pool.borrow(self.key):
+                pass
         except Exception as e:
             raise Spotifice.IOError(track_info.filename, f"Error opening media file: {e}")
 
     def read(self, size):
-        return self.file.read(size)
+        data = self.read_at(self.position, size)
+        self.position += len(data)
+        return data
+
+    def read_at(self, offset, size):
+        self.last_access = monotonic()
+        with self.pool.borrow(self.key) as mapped:
+            if self.cache is None:
+                data = mapped.read_at(offset, size)
+            else:
+                # blocks are copies: the budget bounds their memory and they do
+                # not keep the mapping open once the pool evicts it
+                block_size = self.cache.block_size
+                data = self.cache.read(
+                    self.key, offset, size,
+                    lambda index: bytes(mapped.read_at(index * block_size, block_size)))
+
+        for counter in self.counters:
+            counter.inc(len(data))
+        return data
+
+    def idle_time(self):
+        return monotonic() - self.last_access
 
-    def close(self):
+    def __repr__(self):
+        return f"<StreamState '{self.track.id}'>"
+
+
+class ChunkPusher(threading.Thread):
+    """Streams a file into AudioSinks, reading each chunk once for all of them.
+
+    Each sink gets one chunk per credit granted by its render, so the slowest
+    member paces the others. The pusher stops when its last member is removed.
+    """
+
+    def __init__(self, streamed_file, sinks, chunk_size, window, finished_hook):
+        super().__init__(daemon=True)
+        self.streamed_file = streamed_file
+        self.sinks = dict(sinks)  # member -> AudioSink
+        self.chunk_size = chunk_size
+        self.credits = dict.fromkeys(self.sinks, window)
+        self.offset = 0
+        self.stopped = False
+        self.finished_hook = finished_hook
+        self.credits_c = threading.Condition()
+
+    def grant(self, member, credits):
+        with self.credits_c:
+            if member in self.credits:
+                self.credits[member] += credits
+                self.credits_c.notify()
+
+    def remove(self, member):
+        with self.credits_c:
+            self.sinks.pop(member, None)
+            self.credits.pop(member, None)
+            if not self.sinks:
+                self.stopped = True
+            self.credits_c.notify()
+
+    def stop(self):
+        with self.credits_c:
+            self.stopped = True
+            self.credits_c.notify()
+
+    def take_credit(self):
+        """Sinks to push the next chunk to; None once stopped"""
+        with self.credits_c:
+            self.credits_c.wait_for(
+                lambda: self.stopped or all(c > 0 for c in self.credits.values()))
+            if self.stopped:
+                return None
+
+            for member in self.credits:
+                self.credits[member] -= 1
+            return dict(self.sinks)
+
+    def run(self):
         try:
-            if self.file:
-                self.file.close()
+            while (sinks := self.take_credit()) is not None:
+                data = self.streamed_file.read(self.chunk_size)
+                if not data:
+                    for sink in sinks.values():
+                        sink.end_of_streamAsync(self.offset)
+                    logger.info(f"Push finished: '{self.streamed_file.track.id}'")
+                    break
+
+                for member, sink in sinks.items():
+                    sink.push_chunkAsync(self.offset, data).add_done_callback(
+                        partial(self.check_delivery, member))
+                self.offset += len(data)
+
         except Exception as e:
-            logger.error(f"Error closing file for track '{self.track.id}': {e}")
+            logger.error(f"Push aborted for track '{self.streamed_file.track.id}': {e}")
 
-    def __repr__(self):
-        return f"<StreamState '{self.track.id}'>"
+        self.finished_hook(self)
+
+    def check_delivery(self, member, future):
+        if future.exception():
+            logger.error(f"Push delivery to '{member}' failed: {future.exception()}")
+            self.remove(member)
 
 
 class MediaServerI(Spotifice.MediaServer):
-    def __init__(self, media_dir):
+    MAX_READ_SIZE = 512 * 1024
+    FRAME_SEARCH_SIZE = 4096  # bytes scanned for a frame start after switching variant
+    MAX_PAGE_SIZE = 500
+    CHANGE_LOG_SIZE = 10000
+    TOKEN_STREAM_IDLE = 10  # seconds a token stream counts as active after a read
+    SEEK_TABLE_CACHE_SIZE = 256  # files whose seek tables are kept
+
+    def __init__(self, media_dir, cache=None, pool=None, stream_lease=0, index=None,
+                 watch_interval=0, variants=None, token_secret=None, group_clock=None,
+                 chunk_bounds=(1024, 64 * 1024), scheduler=None, token_lifetime=3600):
         self.media_dir = Path(media_dir)
+        self.scheduler = scheduler  # BandwidthScheduler pacing reads, if any
+        self.delays = DelayQueue() if scheduler else None
+        self.min_chunk_size, self.max_chunk_size = chunk_bounds
+        self.group_clock = group_clock or NetClock(None)
+        self.groups = {}  # name -> RenderGroupI
+        self.tokens = TokenSigner(token_secret or os.urandom(32))
+        self.token_lifetime = token_lifetime  # seconds a token is valid, 0 forever
+        self.variants = variants
+        self.index = index
+        self.cache = cache
+        self.pool = pool or HandlePool(256, open_mapped_file)
         self.tracks = {}
         self.active_streams = {}  # media_render_id -> StreamedFile
+        self.pushers = {}  # media_render_id -> ChunkPusher
+        self.token_streams = TokenStreamGauge(self.TOKEN_STREAM_IDLE)
+        self.seek_tables = OrderedDict()  # StreamedFile key -> SeekTable, LRU
+        self.stream_lease = stream_lease
+        self.reaped_streams = 0
+        self.reaper_stopped = threading.Event()
+        self.lock = threading.RLock()
+        self.catalog_version = 0
+        self.changes = deque(maxlen=self.CHANGE_LOG_SIZE)
         self.load_media()
+        self.catalog = CatalogIndex(self.tracks.values(), build_postings=False)
+        threading.Thread(target=self.catalog.build_postings_in, args=(self.lock,),
+                         name='CatalogPostings', daemon=True).start()
+        self.metrics = Registry()
+        self.register_metrics()
+
+        if stream_lease > 0:
+            threading.Thread(target=self.reap_idle_streams, daemon=True).start()
+
+        self.watcher = None
+        if watch_interval > 0:
+            self.watcher = MediaWatcher(
+                self.media_dir, self.apply_media_changes, watch_interval)
+            self.watcher.start()
+
+    def register_metrics(self):
+        registry = self.metrics
+        self.served_bytes = registry.counter(
+            'spotifice_served_bytes_total', "Audio bytes read for all streams")
+        self.stream_bytes = registry.counter(
+            'spotifice_stream_bytes_total', "Audio bytes read per open stream",
+            ['render'])
+        self.read_latency = registry.histogram(
+            'spotifice_read_seconds', "Time to serve a stream read", ['operation'])
+        self.paced_seconds = registry.counter(
+            'spotifice_paced_seconds_total', "Time replies were held back by pacing")
+        registry.gauge('spotifice_open_streams', "Open streams",
+                       function=lambda: len(self.active_streams))
+        registry.gauge('spotifice_push_streams', "Streams being pushed",
+                       function=lambda: len(self.pushers))
+        registry.gauge('spotifice_token_streams', "Token streams read recently",
+                       function=self.token_streams.count)
+        registry.counter('spotifice_reaped_streams_total', "Idle streams closed by lease",
+                         function=lambda: self.reaped_streams)
+        registry.gauge('spotifice_open_files', "Mapped media files",
+                       function=lambda: self.pool.stats()['handles'])
+        registry.gauge('spotifice_catalog_tracks', "Tracks in the catalog",
+                       function=lambda: len(self.tracks))
+        registry.gauge('spotifice_catalog_version', "Catalog version",
+                       function=lambda: self.catalog_version)
+
+        if cache := self.cache:
+            for name in ['hits', 'misses', 'evictions']:
+                registry.counter(f'spotifice_cache_{name}_total', f"Block cache {name}",
+                                 function=lambda name=name: getattr(cache, name))
+            registry.gauge('spotifice_cache_bytes', "Block cache size",
+                           function=lambda: cache.size)
+
+    def stats(self):
+        return dict(active_streams=len(self.active_streams),
+                    reaped_streams=self.reaped_streams, pool=self.pool.stats())
+
+    def reap_idle_streams(self):
+        while not self.reaper_stopped.wait(self.stream_lease / 2):
+            for str_render_id, streamed_file in list(self.active_streams.items()):
+                if streamed_file.idle_time() > self.stream_lease:
+                    self.discard_stream(str_render_id)
+                    self.reaped_streams += 1
+                    logger.info(f"Reaped idle stream for render '{str_render_id}'")
 
     def ensure_track_exists(self, track_id):
         if track_id not in self.tracks:
             raise Spotifice.TrackError(track_id, "Track not found")
 
     def load_media(self):
-        for filepath in sorted(Path(self.media_dir).iterdir()):
-            if not filepath.is_file() or filepath.suffix.lower() != ".mp3":
-                continue
+        if self.index:
+            for record in self.index.scan(self.media_dir):
+                self.tracks[record.filename] = self.indexed_track_info(record)
+        else:
+            for filepath in sorted(Path(self.media_dir).iterdir()):
+                if not filepath.is_file() or filepath.suffix.lower() != ".mp3":
+                    continue
 
-            self.tracks[filepath.name] = self.track_info(filepath)
+                self.tracks[filepath.name] = self.track_info(filepath)
 
         logger.info(f"Load media:  {len(self.tracks)} tracks")
 
     @staticmethod
     def track_info(filepath):
+        stat = filepath.stat()
         return  Spotifice.TrackInfo(
             id=filepath.name,
             title=filepath.stem,
-            filename=filepath.name)
+            filename=filepath.name,
+            version=content_version(stat.st_mtime_ns, stat.st_size))
+
+    @staticmethod
+    def indexed_track_info(record):
+        return Spotifice.TrackInfo(
+            id=record.filename,
+            title=record.title,
+            filename=record.filename,
+            artist=record.artist or Ice.Unset,
+            album=record.album or Ice.Unset,
+            duration=record.duration or Ice.Unset,
+            bitrate=record.bitrate or Ice.Unset,
+            version=content_version(record.mtime_ns, record.size))
+
+    def apply_media_changes(self, updated, removed):
+        # probe before locking, catalog reads go on meanwhile
+        probed = {}
+        for filename in updated:
+            filepath = self.media_dir / filename
+            try:
+                probed[filename] = self.indexed_track_info(self.index.update(filepath)) \
+                    if self.index else self.track_info(filepath)
+            except FileNotFoundError:
+                continue
+
+        with self.lock:
+            changed = {str(self.media_dir / name) for name in [*updated, *removed]}
+            for key in [key for key in self.seek_tables if key[0] in changed]:
+                del self.seek_tables[key]
+
+            for filename in removed:
+                if self.tracks.pop(filename, None):
+                    self.catalog.remove(filename)
+                    if self.index:
+                        self.index.remove(filename)
+                    self.record_change(Spotifice.ChangeKind.Removed, filename)
+
+            for filename, info in probed.items():
+                kind = Spotifice.ChangeKind.Updated if filename in self.tracks \
+                    else Spotifice.ChangeKind.Added
+                self.tracks[filename] = info
+                self.catalog.add(info)
+                self.record_change(kind, filename, info)
+
+        logger.info(f"Catalog version {self.catalog_version}: {len(updated)} updated, "
+                    f"{len(removed)} removed")
+
+    def record_change(self, kind, track_id, info=None):
+        self.catalog_version += 1
+        self.changes.append(
+            Spotifice.TrackChange(self.catalog_version, kind, track_id, info))
 
     # ---- MusicLibrary ----
     def get_all_tracks(self, current=None):
-        return list(self.tracks.values())
+        with self.lock:
+            return list(self.tracks.values())
 
+    @traced('server')
     def get_track_info(self, track_id, current=None):
-        self.ensure_track_exists(track_id)
-        return self.tracks[track_id]
+        with self.lock:
+            self.ensure_track_exists(track_id)
+            return self.tracks[track_id]
+
+    def get_catalog_version(self, current=None):
+        return self.catalog_version
+
+    def get_changes(self, since_version, current=None):
+        with self.lock:
+            oldest = self.changes[0].version if self.changes else self.catalog_version + 1
+            if since_version > self.catalog_version or since_version < oldest - 1:
+                raise Spotifice.VersionError(
+                    str(since_version), "Changes not available, fetch the full catalog")
+
+            return [change for change in self.changes if change.version > since_version]
+
+    def list_tracks(self, key, cursor, limit, current=None):
+        field = 'filename' if key == Spotifice.SortKey.Filename else 'title'
+        return self.track_page(
+            cursor, limit, lambda size: self.catalog.list(field, cursor, size))
+
+    def search_tracks(self, query, prefix, cursor, limit, current=None):
+        return self.track_page(
+            cursor, limit, lambda size: self.catalog.search(query, prefix, cursor, size))
+
+    def track_page(self, cursor, limit, query):
+        limit = min(limit, self.MAX_PAGE_SIZE) if limit > 0 else self.MAX_PAGE_SIZE
+        try:
+            with self.lock:
+                tracks, next_cursor = query(limit)
+        except ValueError as e:
+            raise Spotifice.CursorError(cursor, str(e))
+
+        return Spotifice.TrackPage(tracks, next_cursor)
 
     # ---- StreamManager ----
+    @traced('server')
     def open_stream(self, track_id, render_id, current=None):
-        str_render_id = id2str(render_id)
-        self.ensure_track_exists(track_id)
+        track = self.get_track_info(track_id)
+        self.start_stream(track, self.media_dir / track.filename, render_id,
+                          track.bitrate, current)
 
+    def start_stream(self, track, filepath, render_id, bitrate, current):
+        """bitrate (kbps) of filepath paces reads, in the priority class given
+        by the 'priority' request context"""
+        str_render_id = id2str(render_id)
         if not render_id.name:
             raise Spotifice.BadIdentity(str_render_id, "Invalid render identity")
 
-        self.active_streams[str_render_id] = StreamedFile(
-            self.tracks[track_id], self.media_dir)
+        streamed_file = StreamedFile(track, filepath, self.pool, self.cache)
+        self.close_stream(render_id)
+        streamed_file.counters = (
+            self.served_bytes, self.stream_bytes.labels(str_render_id))
+        self.active_streams[str_render_id] = streamed_file
+        if self.scheduler:
+            ctx = current.ctx if current else {}
+            self.scheduler.add(str_render_id, (bitrate or 0) * 125,
+                               ctx.get('priority', DEFAULT_PRIORITY))
 
         logger.info("Open stream for track '{}' on render '{}'".format(
-            track_id, str_render_id))
+            track.id, str_render_id))
+
+    @traced('server')
+    def get_variants(self, track_id, current=None):
+        track = self.get_track_info(track_id)
+        original = track.bitrate or 0
+        ladder = self.variants.bitrates if self.variants else []
+        return [bitrate for bitrate in ladder if not original or bitrate < original] + \
+            [original]
+
+    def pick_variant(self, track_id, bitrate):
+        """Best variant not above bitrate; 0 if that is the original file"""
+        *variants, original = self.get_variants(track_id)
+        if original and bitrate >= original:
+            return 0
+
+        candidates = [b for b in variants if b <= bitrate]
+        return candidates[-1] if candidates else 0
+
+    @traced('server')
+    def open_stream_variant(self, track_id, render_id, bitrate, current=None):
+        track = self.get_track_info(track_id)
+        filepath = self.media_dir / track.filename
+
+        if variant := self.pick_variant(track_id, bitrate):
+            if (path := self.variants.get(filepath, variant)) is not None:
+                self.start_stream(track, path, render_id, variant, current)
+                return variant
+
+        self.start_stream(track, filepath, render_id, track.bitrate, current)
+        return track.bitrate or 0
+
+    @traced('server')
+    def open_stream_variant_at(self, track_id, render_id, bitrate, from_bitrate, offset,
+                               current=None):
+        track = self.get_track_info(track_id)
+        filepath = self.media_dir / track.filename
+        source = self.served_file(track, from_bitrate)
+
+        if not (variant := self.pick_variant(track_id, bitrate)):
+            path, served = filepath, track.bitrate or 0
+        elif (path := self.variants.get(filepath, variant)) is not None:
+            served = variant
+        elif source is not None:
+            path, served = source, from_bitrate  # until the variant is transcoded
+        else:
+            path, served = filepath, track.bitrate or 0
+
+        if path != source:
+            position = self.stream_time(track, source, from_bitrate, offset)
+            offset = self.frame_at(StreamedFile(track, path, self.pool, self.cache),
+                                   position)
+
+        self.start_stream(track, path, render_id, served, current)
+        self.active_streams[id2str(render_id)].position = offset
+        return Spotifice.StreamPoint(served, offset)
+
+    def served_file(self, track, bitrate):
+        """File streamed at a bitrate open_stream_variant returned; None if that
+        variant is not cached here"""
+        filepath = self.media_dir / track.filename
+        if not (variant := self.pick_variant(track.id, bitrate)):
+            return filepath
+        return self.variants.get(filepath, variant)
+
+    def stream_time(self, track, filepath, bitrate, offset):
+        """Position (ms) playing at offset of filepath, streamed at bitrate"""
+        if filepath is None:
+            return offset * 8 // bitrate  # a constant bitrate variant, cached elsewhere
+        streamed_file = StreamedFile(track, filepath, self.pool, self.cache)
+        return self.seek_table(streamed_file).position(offset)
+
+    def frame_at(self, streamed_file, position):
+        """Offset of the first frame starting at or after position (ms)"""
+        offset = self.seek_table(streamed_file).interpolate(position)
+        try:
+            data = bytes(streamed_file.read_at(offset, self.FRAME_SEARCH_SIZE))
+        except Exception as e:
+            raise Spotifice.IOError(
+                streamed_file.track.filename, f"Error reading file: {e}")
+
+        start, _ = mp3info.find_frame(data, 0)
+        return offset if start is None else offset + start
 
     def close_stream(self, render_id, current=None):
-        str_render_id = id2str(render_id)
-        if stream_state := self.active_streams.pop(str_render_id, None):
-            stream_state.close()
+        self.discard_stream(id2str(render_id))
+
+    @traced('server')
+    def get_active_streams(self, current=None):
+        """Streams read through a render identity, pushed (alone or to a group)
+        or recently continued with a token"""
+        return len(self.active_streams.keys() | self.pushers.keys()) + \
+            self.token_streams.count()
+
+    def issue_token(self, stream):
+        """Encoded stream token issued now"""
+        return self.tokens.encode(stream._replace(issued=int(time())))
+
+    def discard_stream(self, str_render_id):
+        if pusher := self.pushers.pop(str_render_id, None):
+            pusher.remove(str_render_id)
+
+        if self.active_streams.pop(str_render_id, None):
+            self.stream_bytes.remove(str_render_id)
+            if self.scheduler:
+                self.scheduler.remove(str_render_id)
             logger.info(f"Closed stream for render '{str_render_id}'")
 
-    def get_audio_chunk(self, render_id, chunk_size, current=None):
+    def find_stream(self, render_id):
         str_render_id = id2str(render_id)
         try:
-            streamed_file = self.active_streams[str_render_id]
+            return self.active_streams[str_render_id]
         except KeyError:
             raise Spotifice.StreamError(str_render_id, "No open stream for render")
 
+    @traced('server')
+    def get_audio_chunk(self, render_id, chunk_size, current=None):
+        streamed_file = self.find_stream(render_id)
+        with self.read_latency.labels('get_audio_chunk').time():
+            chunks = self.read_stream(
+                id2str(render_id), streamed_file, streamed_file.position, 1, chunk_size)
+
+        if not chunks:
+            logger.info(f"Track exhausted: '{streamed_file.track.id}'")
+            self.close_stream(render_id, current)
+            return b''
+
+        streamed_file.position += len(chunks[0])
+        return self.paced(id2str(render_id), chunks[0], len(chunks[0]))
+
+    @traced('server')
+    def read_chunks(self, render_id, offset, count, chunk_size, current=None):
+        streamed_file = self.find_stream(render_id)
+        with self.read_latency.labels('read_chunks').time():
+            chunks = self.read_stream(
+                id2str(render_id), streamed_file, offset, count, chunk_size)
+
+        return self.paced(id2str(render_id), chunks, sum(len(c) for c in chunks))
+
+    def paced(self, str_render_id, result, nbytes):
+        """result of a read of nbytes; a future completed with it later if the
+        stream is ahead of its bandwidth share. No dispatch thread waits."""
+        if not self.scheduler or not (delay := self.scheduler.reserve(
+                str_render_id, nbytes)):
+            return result
+
+        self.paced_seconds.inc(delay)
+        future = Ice.Future()
+        self.delays.call_later(delay, future.set_result, result)
+        return future
+
+    @traced('server')
+    def seek_stream(self, render_id, position, current=None):
+        streamed_file = self.find_stream(render_id)
+        if position < 0:
+            raise Spotifice.StreamError(id2str(render_id), "Invalid seek position")
+
+        streamed_file.position = self.seek_table(streamed_file).offset(position)
+        return streamed_file.position
+
+    def seek_table(self, streamed_file):
+        key = streamed_file.key
+        with self.lock:
+            if (table := self.seek_tables.get(key)) is not None:
+                self.seek_tables.move_to_end(key)
+                return table
+
         try:
-            data = streamed_file.read(chunk_size)
-            if not data:
-                logger.info(f"Track exhausted: '{streamed_file.track.id}'")
-                self.close_stream(render_id, current)
-            return data
+            table = self.index.seek_table(streamed_file.filepath) if self.index \
+                else mp3info.seek_table(streamed_file.filepath)
+        except (OSError, ValueError) as e:
+            raise Spotifice.IOError(
+                streamed_file.track.filename, f"Error indexing file: {e}")
+
+        with self.lock:
+            self.seek_tables[key] = table
+            while len(self.seek_tables) > self.SEEK_TABLE_CACHE_SIZE:
+                self.seek_tables.popitem(last=False)
+        return table
+
+    def read_stream(self, item, streamed_file, offset, count, chunk_size):
+        if offset < 0 or count <= 0 or chunk_size <= 0:
+            raise Spotifice.StreamError(item, "Invalid read parameters")
+
+        chunk_size = self.bound_chunk_size(chunk_size)
+        count = min(count, max(1, self.MAX_READ_SIZE // chunk_size))
+        chunks = []
+        try:
+            for _ in range(count):
+                data = streamed_file.read_at(offset, chunk_size)
+                if not data:
+                    break
+
+                chunks.append(data)
+                offset += len(data)
 
         except Exception as e:
             raise Spotifice.IOError(
                 streamed_file.track.filename, f"Error reading file: {e}")
 
+        return chunks
+
+    def bound_chunk_size(self, chunk_size):
+        """chunk_size within MinChunkSize and MaxChunkSize: renders sizing their
+        reads may ask for anything, and get the nearest size served"""
+        return min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+
+    # ---- stateless streams ----
+    @traced('server')
+    def open_stream_token(self, track_id, bitrate, position, current=None):
+        track = self.get_track_info(track_id)
+        if position < 0:
+            raise Spotifice.StreamError(track_id, "Invalid seek position")
+
+        variant = self.pick_variant(track_id, bitrate)
+        if variant and not self.variants.get(self.media_dir / track.filename, variant):
+            variant = 0
+
+        token = StreamToken(track_id, variant, self.source_version(track), 0)
+        if position:
+            streamed_file = self.token_file(token)
+            token = token._replace(offset=self.seek_table(streamed_file).offset(position))
+        self.token_streams.opened()
+        return self.issue_token(token)
+
+    @traced('server')
+    def read_token(self, token, count, chunk_size, current=None):
+        try:
+            stream = self.tokens.decode(token)
+        except ValueError as e:
+            raise Spotifice.StreamError(token, str(e))
+        if self.token_lifetime and time() - stream.issued > self.token_lifetime:
+            raise Spotifice.StreamError(token, "Token expired")
+
+        streamed_file = self.token_file(stream)
+        streamed_file.counters = (self.served_bytes,)
+        with self.read_latency.labels('read_token').time():
+            chunks = self.read_stream(
+                stream.track_id, streamed_file, stream.offset, count, chunk_size)
+
+        offset = stream.offset + sum(len(chunk) for chunk in chunks)
+        stream = stream._replace(offset=offset)
+        if not chunks:  # the end of the track ends the stream
+            self.token_streams.ended(stream.issued)
+            return Spotifice.TokenChunks(chunks, self.tokens.encode(stream))
+        self.token_streams.read(stream.issued)
+        return Spotifice.TokenChunks(chunks, self.issue_token(stream))
+
+    def source_version(self, track):
+        """version_digest of the original file of track, as tokens bind it"""
+        try:
+            stat = (self.media_dir / track.filename).stat()
+            return version_digest(content_version(stat.st_mtime_ns, stat.st_size))
+        except OSError as e:
+            raise Spotifice.IOError(track.filename, f"Error opening media file: {e}")
+
+    def token_file(self, token):
+        """StreamedFile the token reads; only shared caches back it, the server
+        keeps no state for the stream"""
+        if (track := self.tracks.get(token.track_id)) is None:
+            raise Spotifice.StreamError(token.track_id, "Track no longer available")
+
+        if self.source_version(track) != token.version:
+            raise Spotifice.StreamError(token.track_id, "Track changed")
+
+        filepath = self.media_dir / track.filename
+        if token.bitrate:
+            if not self.variants or \
+                    (filepath := self.variants.get(filepath, token.bitrate)) is None:
+                raise Spotifice.StreamError(
+                    token.track_id, f"Variant {token.bitrate}k not available")
+
+        return StreamedFile(track, filepath, self.pool, self.cache)
+
+    def start_push(self, render_id, sink, chunk_size, window, current=None):
+        str_render_id = id2str(render_id)
+        streamed_file = self.find_stream(render_id)
+
+        if not sink:
+            raise Spotifice.BadReference(str_render_id, "Invalid audio sink")
+
+        if chunk_size <= 0 or window <= 0:
+            raise Spotifice.StreamError(str_render_id, "Invalid push parameters")
+
+        if pusher := self.pushers.pop(str_render_id, None):
+            pusher.remove(str_render_id)
+
+        def finished_hook(pusher):
+            if self.pushers.get(str_render_id) is pusher:
+                self.close_stream(render_id)
+
+        pusher = ChunkPusher(streamed_file, {str_render_id: sink},
+                             self.bound_chunk_size(chunk_size), window, finished_hook)
+        self.pushers[str_render_id] = pusher
+        pusher.start()
+
+        logger.info(f"Push started for render '{str_render_id}' (window {window})")
+
+    # ---- GroupManager ----
+    def create_group(self, name, current=None):
+        if not name:
+            raise Spotifice.BadIdentity(name, "Invalid group name")
+
+        identity = Ice.Identity(name=name, category='group')
+        self.group_clock.start()
+        with self.lock:
+            if name not in self.groups:
+                server = Spotifice.MediaServerPrx.uncheckedCast(
+                    current.adapter.createProxy(current.id))
+                self.groups[name] = RenderGroupI(name, self, server, self.group_clock)
+                current.adapter.add(self.groups[name], identity)
+                logger.info(f"Created group '{name}'")
+
+        return Spotifice.RenderGroupPrx.uncheckedCast(
+            current.adapter.createProxy(identity))
+
+    def remove_group(self, name, current=None):
+        with self.lock:
+            group = self.groups.pop(name, None)
+
+        if group:
+            group.close()
+            current.adapter.remove(Ice.Identity(name=name, category='group'))
+            logger.info(f"Removed group '{name}'")
+
+    def open_group_stream(self, track_id):
+        track = self.get_track_info(track_id)
+        streamed_file = StreamedFile(
+            track, self.media_dir / track.filename, self.pool, self.cache)
+        streamed_file.counters = (self.served_bytes,)
+        return streamed_file
+
+    def start_group_push(self, streamed_file, sinks, chunk_size, window):
+        """Started pusher reading streamed_file once for all sinks, keyed by member
+        render identity, so members grant credits and close it as in start_push"""
+        for member in sinks:
+            self.discard_stream(member)
+
+        def finished_hook(pusher):
+            for member in sinks:
+                if self.pushers.get(member) is pusher:
+                    self.pushers.pop(member, None)
+
+        pusher = ChunkPusher(streamed_file, sinks, self.bound_chunk_size(chunk_size),
+                             window, finished_hook)
+        for member in sinks:
+            self.pushers[member] = pusher
+        pusher.start()
+        return pusher
+
+    def grant_credits(self, render_id, credits, current=None):
+        str_render_id = id2str(render_id)
+        if pusher := self.pushers.get(str_render_id):
+            pusher.grant(str_render_id, credits)
+
+    def shutdown(self):
+        self.reaper_stopped.set()
+        if self.watcher:
+            self.watcher.stop()
+        if self.variants:
+            self.variants.shutdown()
+
+        for pusher in list(self.pushers.values()):
+            pusher.stop()
+
+        self.active_streams.clear()
+        if self.delays:
+            self.delays.stop()
+        self.group_clock.close()
+        self.pool.close_all()
+
+
+class AsyncMediaServerI(MediaServerI):
+    """Stream operations run on an I/O executor and are dispatched asynchronously,
+    so Ice dispatch threads never block on disk reads."""
+
+    def __init__(self, *args, io_threads=16, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.executor = ThreadPoolExecutor(io_threads, thread_name_prefix='MediaServerIO')
+
+    def submit(self, operation, *args):
+        def run():
+            try:
+                result = operation(*args)
+            except Exception as e:
+                future.set_exception(e)
+                return
+
+            if isinstance(result, Ice.Future):  # paced read
+                result.add_done_callback(lambda paced: future.set_result(paced.result()))
+            else:
+                future.set_result(result)
+
+        future = Ice.Future()
+        self.executor.submit(run)
+        return future
+
+    def open_stream(self, track_id, render_id, current=None):
+        return self.submit(super().open_stream, track_id, render_id, current)
+
+    def get_audio_chunk(self, render_id, chunk_size, current=None):
+        return self.submit(super().get_audio_chunk, render_id, chunk_size, current)
+
+    def open_stream_variant(self, track_id, render_id, bitrate, current=None):
+        return self.submit(
+            super().open_stream_variant, track_id, render_id, bitrate, current)
+
+    def open_stream_variant_at(self, track_id, render_id, bitrate, from_bitrate, offset,
+                               current=None):
+        return self.submit(super().open_stream_variant_at, track_id, render_id, bitrate,
+                           from_bitrate, offset, current)
+
+    def seek_stream(self, render_id, position, current=None):
+        return self.submit(super().seek_stream, render_id, position, current)
+
+    def read_chunks(self, render_id, offset, count, chunk_size, current=None):
+        return self.submit(
+            super().read_chunks, render_id, offset, count, chunk_size, current)
+
+    def open_stream_token(self, track_id, bitrate, position, current=None):
+        return self.submit(
+            super().open_stream_token, track_id, bitrate, position, current)
+
+    def read_token(self, token, count, chunk_size, current=None):
+        return self.submit(super().read_token, token, count, chunk_size, current)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+        super().shutdown()
+
+
+def state_dir(properties, media_dir):
+    """Server-local directory for the library index and variants of media_dir,
+    which may be read-only or shared storage"""
+    if directory := properties.getProperty('MediaServer.StateDir'):
+        return Path(directory)
+
+    base = os.environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state'
+    media_dir = Path(media_dir).resolve()
+    digest = hashlib.sha256(str(media_dir).encode()).hexdigest()[:8]
+    return Path(base) / 'spotifice' / f'{media_dir.name}-{digest}'
+
 
 def main(ic):
     properties = ic.getProperties()
+    tracing.configure(properties)
     media_dir = properties.getPropertyWithDefault(
         'MediaServer.Content', 'media')
-    servant = MediaServerI(Path(media_dir))
+    # mapped files are already served from the page cache, so the block cache
+    # only pays off for media on storage without one and is off by default
+    cache_size = properties.getPropertyAsIntWithDefault('MediaServer.CacheSize', 0)
+    cache = None
+    if cache_size > 0:
+        cache = BlockCache(cache_size, properties.getPropertyAsIntWithDefault(
+            'MediaServer.CacheBlockSize', 64 * 1024))
+    pool = HandlePool(
+        properties.getPropertyAsIntWithDefault('MediaServer.MaxOpenFiles', 256),
+        open_mapped_file)
+    stream_lease = properties.getPropertyAsIntWithDefault('MediaServer.StreamLease', 300)
+    watch_interval = properties.getPropertyAsIntWithDefault(
+        'MediaServer.WatchInterval', 2)
+    state = state_dir(properties, media_dir)
+    if not (index_file := properties.getProperty('MediaServer.IndexFile')):
+        state.mkdir(parents=True, exist_ok=True)
+        index_file = str(state / 'index.db')
+    index = LibraryIndex(
+        index_file, properties.getPropertyAsIntWithDefault('MediaServer.ProbeWorkers', 8))
+
+    variants = None
+    if bitrates := properties.getPropertyAsList('MediaServer.Variants'):
+        variants = VariantCache(
+            properties.getPropertyWithDefault(
+                'MediaServer.VariantCache', str(state / 'variants')),
+            [int(bitrate) for bitrate in bitrates])
+
+    if not (token_secret := properties.getProperty('MediaServer.TokenSecret')):
+        logger.warning("No MediaServer.TokenSecret, stream tokens only valid here")
+
+    # port 0 takes any free port, a negative one disables group clock sync
+    clock_port = properties.getPropertyAsIntWithDefault('MediaServer.GroupClock.Port', 0)
+    group_clock = NetClock(clock_port if clock_port >= 0 else None,
+                           properties.getProperty('MediaServer.GroupClock.Address'))
+
+    chunk_bounds = (
+        properties.getPropertyAsIntWithDefault('MediaServer.MinChunkSize', 1024),
+        properties.getPropertyAsIntWithDefault('MediaServer.MaxChunkSize', 64 * 1024))
+    if not 0 < chunk_bounds[0] <= chunk_bounds[1]:
+        raise ValueError(f"Invalid MediaServer chunk size bounds {chunk_bounds}")
+
+    # off by default: renders measure their throughput on read latency, which
+    # the held back replies would pass off as a slow link
+    scheduler = None
+    pace = float(properties.getPropertyWithDefault('MediaServer.Pacing.Rate', '0'))
+    global_rate = properties.getPropertyAsInt('MediaServer.Pacing.GlobalRate')
+    if pace or global_rate:
+        weights = properties.getPropertiesForPrefix('MediaServer.Pacing.Priority.')
+        scheduler = BandwidthScheduler(
+            pace,
+            float(properties.getPropertyWithDefault('MediaServer.Pacing.Burst', '8')),
+            global_rate,
+            {key.rsplit('.', 1)[-1]: int(weight) for key, weight in weights.items()})
+
+    args = (Path(media_dir), cache, pool, stream_lease, index, watch_interval, variants,
+            token_secret.encode(), group_clock, chunk_bounds, scheduler,
+            properties.getPropertyAsIntWithDefault('MediaServer.TokenLifetime', 3600))
+    if properties.getPropertyWithDefault('MediaServer.Dispatch', 'sync') == 'async':
+        servant = AsyncMediaServerI(
+            *args,
+            io_threads=properties.getPropertyAsIntWithDefault(
+                'MediaServer.IOThreads', 16))
+    else:
+        servant = MediaServerI(*args)
 
     adapter = ic.createObjectAdapter("MediaServerAdapter")
     proxy = adapter.add(servant, ic.stringToIdentity("mediaServer1"))
+    adapter.addFacet(StatsI(servant.metrics), proxy.ice_getIdentity(), STATS_FACET)
     logger.info(f"MediaServer: {proxy}")
 
     adapter.activate()
     ic.waitForShutdown()
+    servant.shutdown()
 
+    logger.info(f"Stream stats: {servant.stats()}")
+    if cache:
+        logger.info(f"Cache stats: {cache.stats()}")
+    index.close()
     logger.info("Shutdown")
 
 
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import sys
+
+import Ice
+
+import metrics
+from slice_loader import Spotifice
+
+FACET = 'stats'
+
+
+class StatsI(Spotifice.Stats):
+    def __init__(self, registry):
+        self.registry = registry
+
+    def get_metrics(self, current=None):
+        return [Spotifice.MetricFamily(
+                    family.name, family.kind, family.help,
+                    [Spotifice.MetricSample(sample.name, sample.labels, sample.value)
+                     for sample in family.samples])
+                for family in self.registry.collect()]
+
+
+def scrape(ic, property):
+    proxy = ic.propertyToProxy(property)
+    stats = Spotifice.StatsPrx.uncheckedCast(proxy, FACET)
+    instance = ic.identityToString(proxy.ice_getIdentity())
+    return metrics.format_text(stats.get_metrics(), {'instance': instance})
+
+
+def main(ic):
+    for property in ['MediaServer.Proxy', 'MediaRender.Proxy']:
+        if not ic.getProperties().getProperty(property):
+            continue
+
+        try:
+            print(scrape(ic, property), end='')
+        except Ice.LocalException as e:
+            print(f"# {property} not available: {e}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("Usage: media_stats.py <config-file>")
+
+    with Ice.initialize(sys.argv[1]) as communicator:
+        main(communicator)
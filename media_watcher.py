@@ -0,0 +1,140 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+from pathlib import Path
+
+from library_index import LibraryIndex
+
+logger = logging.getLogger("MediaWatcher")
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_FROM = 0x040
+IN_MOVED_TO = 0x080
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify:
+    """Directory watch through libc inotify"""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        if libc.inotify_add_watch(self.fd, str(directory).encode(), self.MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f"Can not watch '{directory}'")
+
+    def close(self):
+        os.close(self.fd)
+
+    def read(self, timeout):
+        """(mask, name) events, waiting up to timeout seconds"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+
+        data = os.read(self.fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, pos)
+            pos += EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b'\0').decode(errors='surrogateescape')
+            events.append((mask, name))
+            pos += length
+        return events
+
+
+class MediaWatcher(threading.Thread):
+    """Reports media files written, moved in, deleted or moved out of a directory.
+
+    Uses inotify where available and falls back to polling the directory.
+    changed_hook(updated, removed) gets lists of filenames.
+    """
+
+    def __init__(self, media_dir, changed_hook, interval=2.0, suffix='.mp3'):
+        super().__init__(daemon=True)
+        self.media_dir = Path(media_dir)
+        self.changed_hook = changed_hook
+        self.interval = interval
+        self.suffix = suffix
+        self.stopped = threading.Event()
+
+        try:
+            self.inotify = Inotify(self.media_dir)
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify not available ({e}), polling every {interval}s")
+            self.inotify = None
+
+        self.snapshot = LibraryIndex.list_media(self.media_dir, suffix)
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        if self.inotify is None:
+            while not self.stopped.wait(self.interval):
+                self.rescan()
+            return
+
+        try:
+            while not self.stopped.is_set():
+                self.dispatch(self.inotify.read(self.interval))
+        finally:
+            self.inotify.close()
+
+    def rescan(self):
+        current = LibraryIndex.list_media(self.media_dir, self.suffix)
+        updated = sorted(name for name, stamp in current.items()
+                         if self.snapshot.get(name) != stamp)
+        removed = sorted(self.snapshot.keys() - current.keys())
+        self.snapshot = current
+        self.notify(updated, removed)
+
+    def dispatch(self, events):
+        if any(mask & IN_Q_OVERFLOW for mask, _ in events):
+            self.rescan()
+            return
+
+        updated, removed = [], []
+        for mask, name in events:
+            if not name.lower().endswith(self.suffix):
+                continue
+
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                updated.append(name)
+                if name in removed:
+                    removed.remove(name)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                removed.append(name)
+                if name in updated:
+                    updated.remove(name)
+
+        for name in removed:
+            self.snapshot.pop(name, None)
+        for name in updated:
+            try:
+                stat = (self.media_dir / name).stat()
+                self.snapshot[name] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                pass
+
+        self.notify(updated, removed)
+
+    def notify(self, updated, removed):
+        if not (updated or removed):
+            return
+
+        try:
+            self.changed_hook(updated, removed)
+        except Exception as e:
+            logger.error(f"Error applying media changes: {e}")
@@ -0,0 +1,202 @@
+"""In-process counters, gauges and histograms, collected on demand.
+
+Updates take one uncontended lock; values computed by a function are only read
+at collection time, so existing counters (cache, pool) cost nothing extra.
+"""
+
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from typing import NamedTuple
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5)
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: dict
+    value: float
+
+
+class Family(NamedTuple):
+    name: str
+    kind: str  # counter, gauge or histogram
+    help: str
+    samples: list
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [Sample(name, labels, self.value)]
+
+
+class Gauge(Counter):
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return Timer(self)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile; inf past the last
+        bucket, None without observations"""
+        with self.lock:
+            counts = list(self.counts)
+
+        rank = q * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                return bound
+        return None
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+
+        retval = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            retval.append(Sample(f'{name}_bucket', {**labels, 'le': format_value(bound)},
+                                 cumulative))
+        retval.append(Sample(f'{name}_sum', labels, total))
+        retval.append(Sample(f'{name}_count', labels, cumulative))
+        return retval
+
+
+class Timer:
+    """Context manager observing the elapsed seconds into a histogram"""
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(perf_counter() - self.start)
+
+
+class Function:
+    """Metric whose value is read from function at collection time"""
+
+    def __init__(self, function):
+        self.function = function
+
+    def samples(self, name, labels):
+        return [Sample(name, labels, self.function())]
+
+
+class MetricFamily:
+    """One named metric, optionally split by label values"""
+
+    def __init__(self, name, kind, help, factory, label_names=()):
+        self.name = name
+        self.kind = kind
+        self.help = help
+        self.factory = factory
+        self.label_names = tuple(label_names)
+        self.children = {}  # label values -> metric
+        self.lock = threading.Lock()
+        if not self.label_names:
+            self.children[()] = factory()
+
+    def labels(self, *values):
+        assert len(values) == len(self.label_names)
+        with self.lock:
+            if (child := self.children.get(values)) is None:
+                child = self.children[values] = self.factory()
+            return child
+
+    def remove(self, *values):
+        with self.lock:
+            self.children.pop(values, None)
+
+    def __getattr__(self, name):
+        # unlabelled families act as their only metric
+        return getattr(self.children[()], name)
+
+    def collect(self):
+        with self.lock:
+            children = list(self.children.items())
+
+        samples = []
+        for values, child in children:
+            samples.extend(child.samples(self.name, dict(zip(self.label_names, values))))
+        return Family(self.name, self.kind, self.help, samples)
+
+
+class Registry:
+    def __init__(self):
+        self.families = {}
+
+    def register(self, family):
+        assert family.name not in self.families, family.name
+        self.families[family.name] = family
+        return family
+
+    def counter(self, name, help, labels=(), function=None):
+        factory = (lambda: Function(function)) if function else Counter
+        return self.register(MetricFamily(name, 'counter', help, factory, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        factory = (lambda: Function(function)) if function else Gauge
+        return self.register(MetricFamily(name, 'gauge', help, factory, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(
+            MetricFamily(name, 'histogram', help, lambda: Histogram(buckets), labels))
+
+    def collect(self):
+        return [family.collect() for family in self.families.values()]
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_text(families, extra_labels=None):
+    """Prometheus text exposition of collected families"""
+    lines = []
+    for family in families:
+        lines.append(f'# HELP {family.name} {family.help}')
+        lines.append(f'# TYPE {family.name} {family.kind}')
+        for sample in family.samples:
+            labels = {**(extra_labels or {}), **sample.labels}
+            label_text = ','.join(
+                f'{key}="{escape(value)}"' for key, value in labels.items())
+            name = f'{sample.name}{{{label_text}}}' if label_text else sample.name
+            lines.append(f'{name} {format_value(sample.value)}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,288 @@
+"""Minimal MP3 probing: ID3v2 text tags, frame headers, Xing/Info and VBRI headers
+and time to byte offset seek tables"""
+
+import struct
+from bisect import bisect_right
+from typing import NamedTuple
+
+BITRATES = {  # (version is MPEG1, layer) -> kbit/s by index
+    (True, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (True, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (True, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (False, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (False, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (False, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+SAMPLE_RATES = {
+    3: [44100, 48000, 32000], 2: [22050, 24000, 16000], 0: [11025, 12000, 8000],
+}
+
+ID3_TEXT_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album',
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album',
+}
+
+ID3_ENCODINGS = ['latin-1', 'utf-16', 'utf-16-be', 'utf-8']
+
+SYNC_SEARCH_LIMIT = 64 * 1024
+
+VBRI_OFFSET = 36
+
+SEEK_STEP = 250  # ms between seek table entries built by a frame scan
+
+
+class FrameHeader(NamedTuple):
+    mpeg1: bool
+    layer: int
+    bitrate: int      # kbit/s
+    sample_rate: int  # Hz
+    mono: bool
+    samples: int      # per frame
+    length: int       # bytes, header included
+
+
+class Mp3Info(NamedTuple):
+    tags: dict
+    audio_start: int  # first frame offset
+    bitrate: int      # average kbit/s
+    sample_rate: int
+    duration: int     # ms
+    frames: int       # 0 if unknown (CBR without Xing/Info header)
+
+
+class SeekTable(NamedTuple):
+    step: int      # ms between entries
+    offsets: list  # byte offset of the frame playing at i * step ms
+
+    def offset(self, position):
+        """Offset to read from to play from position (ms)"""
+        if not self.offsets:
+            return 0
+        return self.offsets[min(max(position, 0) // self.step, len(self.offsets) - 1)]
+
+    def interpolate(self, position):
+        """Offset playing at position (ms), interpolated between entries; unlike
+        offset(), not necessarily a frame start"""
+        if len(self.offsets) < 2:
+            return self.offset(position)
+
+        index = min(max(position, 0) // self.step, len(self.offsets) - 2)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return start + (end - start) * (max(position, 0) - index * self.step) // self.step
+
+    def position(self, offset):
+        """Position (ms) playing at offset, interpolated between entries"""
+        if len(self.offsets) < 2:
+            return 0
+
+        index = min(max(bisect_right(self.offsets, offset) - 1, 0), len(self.offsets) - 2)
+        start, end = self.offsets[index], self.offsets[index + 1]
+        if end == start:
+            return index * self.step
+        return max(index * self.step + (offset - start) * self.step // (end - start), 0)
+
+
+def parse_frame_header(data):
+    if len(data) < 4 or data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+
+    version = (data[1] >> 3) & 3
+    layer = 4 - ((data[1] >> 1) & 3)
+    bitrate_index = data[2] >> 4
+    rate_index = (data[2] >> 2) & 3
+    if version == 1 or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+
+    mpeg1 = version == 3
+    bitrate = BITRATES[(mpeg1, layer)][bitrate_index]
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    padding = (data[2] >> 1) & 1
+    samples = 384 if layer == 1 else 1152 if mpeg1 or layer == 2 else 576
+
+    if layer == 1:
+        length = (12 * bitrate * 1000 // sample_rate + padding) * 4
+    else:
+        length = samples // 8 * bitrate * 1000 // sample_rate + padding
+
+    return FrameHeader(mpeg1, layer, bitrate, sample_rate, data[3] >> 6 == 3, samples,
+                       length)
+
+
+def synchsafe(data):
+    return data[0] << 21 | data[1] << 14 | data[2] << 7 | data[3]
+
+
+def parse_id3v2(data):
+    """(tags, tag length) of the ID3v2 tag at the start of data"""
+    if len(data) < 10 or data[:3] != b'ID3':
+        return {}, 0
+
+    major, flags = data[3], data[5]
+    end = 10 + synchsafe(data[6:10])
+    length = end + (10 if flags & 0x10 else 0)
+    id_size, header_size = (3, 6) if major == 2 else (4, 10)
+
+    tags = {}
+    pos = 10
+    while pos + header_size <= min(end, len(data)):
+        frame_id = data[pos:pos + id_size].decode('latin-1')
+        if not frame_id.strip('\0'):
+            break
+
+        size_bytes = data[pos + id_size:pos + 2 * id_size]
+        if major == 2:
+            size = int.from_bytes(size_bytes, 'big')
+        elif major == 4:
+            size = synchsafe(size_bytes)
+        else:
+            size = struct.unpack('>I', size_bytes)[0]
+
+        body = data[pos + header_size:pos + header_size + size]
+        if frame_id in ID3_TEXT_FRAMES and body and body[0] < len(ID3_ENCODINGS):
+            text = body[1:].decode(ID3_ENCODINGS[body[0]], errors='replace')
+            tags[ID3_TEXT_FRAMES[frame_id]] = text.split('\0')[0].strip()
+
+        pos += header_size + size
+
+    return tags, length
+
+
+def find_frame(data, start):
+    """Offset and header of the first frame whose successor is also a valid frame"""
+    end = min(len(data) - 4, start + SYNC_SEARCH_LIMIT)
+    pos = start
+    while pos < end:
+        pos = data.find(b'\xff', pos, end)
+        if pos < 0:
+            break
+
+        header = parse_frame_header(data[pos:pos + 4])
+        if header:
+            successor = data[pos + header.length:pos + header.length + 4]
+            if len(successor) < 4 or parse_frame_header(successor):
+                return pos, header
+        pos += 1
+
+    return None, None
+
+
+def xing_offset(header):
+    if header.mpeg1:
+        return 4 + (17 if header.mono else 32)
+    return 4 + (9 if header.mono else 17)
+
+
+def parse_xing(frame, header):
+    """(frames, bytes, TOC) from a Xing/Info header; zero and empty when absent"""
+    pos = xing_offset(header)
+    if frame[pos:pos + 4] not in (b'Xing', b'Info'):
+        return 0, 0, b''
+
+    flags = struct.unpack('>I', frame[pos + 4:pos + 8])[0]
+    pos += 8
+    frames = nbytes = 0
+    toc = b''
+    if flags & 1:
+        frames = struct.unpack('>I', frame[pos:pos + 4])[0]
+        pos += 4
+    if flags & 2:
+        nbytes = struct.unpack('>I', frame[pos:pos + 4])[0]
+        pos += 4
+    if flags & 4:
+        toc = bytes(frame[pos:pos + 100])
+    return frames, nbytes, toc
+
+
+def parse_vbri(frame):
+    """(frames, bytes, frames per entry, entry byte sizes) from a VBRI header;
+    None when absent"""
+    pos = VBRI_OFFSET
+    if frame[pos:pos + 4] != b'VBRI' or len(frame) < pos + 26:
+        return None
+
+    nbytes, frames, entries, scale, entry_size, frames_per_entry = \
+        struct.unpack('>IIHHHH', frame[pos + 10:pos + 26])
+    table = frame[pos + 26:pos + 26 + entries * entry_size]
+    sizes = [int.from_bytes(table[i:i + entry_size], 'big') * scale
+             for i in range(0, len(table) - entry_size + 1, entry_size)]
+    return frames, nbytes, frames_per_entry, sizes
+
+
+def read_head(file):
+    """Start of the file, up to the first frames after any ID3v2 tag; file size"""
+    _, tag_length = parse_id3v2(file.read(10))
+    file.seek(0)
+    data = file.read(tag_length + SYNC_SEARCH_LIMIT)
+    file.seek(0, 2)
+    return data, file.tell()
+
+
+def probe(path):
+    with open(path, 'rb') as file:
+        data, file_size = read_head(file)
+
+    tags, audio_start = parse_id3v2(data)
+    offset, header = find_frame(data, audio_start)
+    if header is None:
+        raise ValueError(f"No MPEG audio frames found in '{path}'")
+
+    frames, nbytes, _ = parse_xing(data[offset:offset + header.length], header)
+    if frames:
+        duration = frames * header.samples * 1000 // header.sample_rate
+        nbytes = nbytes or file_size - offset
+        bitrate = nbytes * 8 // duration if duration else header.bitrate
+    else:
+        bitrate = header.bitrate
+        duration = (file_size - offset) * 8 // bitrate
+
+    return Mp3Info(tags, offset, bitrate, header.sample_rate, duration, frames)
+
+
+def seek_table(path, step=SEEK_STEP):
+    """Seek table from the Xing TOC or VBRI table when the file has one, from a
+    scan of every frame otherwise"""
+    with open(path, 'rb') as file:
+        data, file_size = read_head(file)
+        _, audio_start = parse_id3v2(data)
+        offset, header = find_frame(data, audio_start)
+        if header is None:
+            raise ValueError(f"No MPEG audio frames found in '{path}'")
+
+        frame_ms = header.samples * 1000 / header.sample_rate
+        frames, nbytes, toc = parse_xing(data[offset:offset + header.length], header)
+        if frames and len(toc) == 100:
+            nbytes = nbytes or file_size - offset
+            return SeekTable(max(1, round(frames * frame_ms / 100)),
+                             [offset + entry * nbytes // 256 for entry in toc])
+
+        if vbri := parse_vbri(data[offset:]):
+            _, _, frames_per_entry, sizes = vbri
+            offsets = [offset + header.length]
+            for size in sizes[:-1]:
+                offsets.append(offsets[-1] + size)
+            return SeekTable(max(1, round(frames_per_entry * frame_ms)), offsets)
+
+        file.seek(0)
+        start = offset + header.length if frames else offset
+        return scan_seek_table(file.read(), start, step)
+
+
+def scan_seek_table(data, offset, step=SEEK_STEP):
+    """Seek table from walking the frames of data, starting at offset"""
+    offsets = []
+    elapsed = 0.0  # ms
+    pos = offset
+    while pos < len(data) - 4:
+        header = parse_frame_header(data[pos:pos + 4])
+        if header is None:
+            pos, header = find_frame(data, pos + 1)
+            if header is None:
+                break
+
+        while len(offsets) * step <= elapsed:
+            offsets.append(pos)
+        elapsed += header.samples * 1000 / header.sample_rate
+        pos += header.length
+
+    return SeekTable(step, offsets)
@@ -0,0 +1,162 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import Ice
+from Ice import identityToString as id2str
+
+from slice_loader import Spotifice
+from transcoder import load_gst
+
+logger = logging.getLogger("RenderGroup")
+
+
+class NetClock:
+    """Network time provider group members slave their pipelines to, started
+    for the first group; disabled with port None or without GStreamer, and then
+    members play unsynced"""
+
+    def __init__(self, port, address=''):
+        self.address = address
+        self.listen_port = port
+        self.clock = self.provider = None
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        with self.lock:
+            if self.started or self.listen_port is None:
+                return
+
+            self.started = True
+            if (Gst := load_gst()) is None:
+                logger.warning("GStreamer not available, groups will not be clock synced")
+                return
+
+            import gi
+            gi.require_version('GstNet', '1.0')
+            from gi.repository import GstNet  # type: ignore
+
+            self.clock = Gst.SystemClock.obtain()
+            self.provider = GstNet.NetTimeProvider.new(self.clock, None, self.listen_port)
+            logger.info(f"Group clock on port {self.port}")
+
+    @property
+    def port(self):
+        return self.provider.props.port if self.provider else 0
+
+    def close(self):
+        self.provider = self.clock = None
+
+    def group_clock(self, delay, current):
+        """GroupClock starting delay ns from now, announced at the address
+        members reach this server through"""
+        if not self.clock:
+            return Spotifice.GroupClock('', 0, 0)
+
+        address = self.address or getattr(current.con.getInfo(), 'localAddress', '')
+        return Spotifice.GroupClock(address, self.port, self.clock.get_time() + delay)
+
+
+class RenderGroupI(Spotifice.RenderGroup):
+    """Operations calling members run one at a time on the group's own thread
+    and are dispatched asynchronously: members call back into the server while
+    they join or stop."""
+
+    CHUNK_SIZE = 4096
+    WINDOW = 16
+    START_DELAY = 500 * 1000 * 1000  # ns, for every member to preroll
+
+    def __init__(self, name, server, server_prx, clock):
+        self.name = name
+        self.server = server
+        self.server_prx = server_prx
+        self.clock = clock
+        self.members = {}  # render identity -> MediaRenderPrx
+        self.pusher = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix=f'Group-{name}')
+
+    def submit(self, operation, *args):
+        def run():
+            try:
+                future.set_result(operation(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+        future = Ice.Future()
+        self.executor.submit(run)
+        return future
+
+    def add_member(self, render, current=None):
+        if not render:
+            raise Spotifice.BadReference(self.name, "Invalid render")
+
+        with self.lock:
+            self.members[id2str(render.ice_getIdentity())] = render
+
+    def remove_member(self, render, current=None):
+        with self.lock:
+            member = self.members.pop(id2str(render.ice_getIdentity()), None)
+
+        if member:
+            return self.submit(self.stop_member, member)
+
+    def get_members(self, current=None):
+        with self.lock:
+            return list(self.members.values())
+
+    def play(self, track_id, current=None):
+        return self.submit(self.start, track_id, current)
+
+    def start(self, track_id, current):
+        self.stop_members()
+        streamed_file = self.server.open_group_stream(track_id)
+
+        with self.lock:
+            members = dict(self.members)
+
+        sinks = {}
+        for key, member in members.items():
+            try:
+                sinks[key] = member.join_group(self.server_prx, track_id)
+            except Ice.Exception as e:
+                logger.warning(f"Render '{key}' could not join '{self.name}': {e}")
+
+        if not sinks:
+            raise Spotifice.PlayerError(self.name, "No member could join the group")
+
+        self.pusher = self.server.start_group_push(
+            streamed_file, sinks, self.CHUNK_SIZE, self.WINDOW)
+        clock = self.clock.group_clock(self.START_DELAY, current)
+        for key in sinks:
+            try:
+                members[key].start_group(clock)
+            except Ice.Exception as e:
+                logger.warning(f"Render '{key}' could not start: {e}")
+                self.pusher.remove(key)
+
+        logger.info(f"Group '{self.name}' playing '{track_id}' on {len(sinks)} renders")
+
+    def stop(self, current=None):
+        return self.submit(self.stop_members)
+
+    def close(self):
+        self.submit(self.stop_members)
+        self.executor.shutdown(wait=False)
+
+    def stop_members(self):
+        with self.lock:
+            members = list(self.members.values())
+            pusher, self.pusher = self.pusher, None
+
+        if pusher:
+            pusher.stop()
+            for member in members:
+                self.stop_member(member)
+
+    def stop_member(self, member):
+        try:
+            member.stop()
+        except Ice.Exception as e:
+            logger.warning(f"Can not stop '{id2str(member.ice_getIdentity())}': {e}")
@@ -0,0 +1,34 @@
+"""Spotifice Slice definitions for every module of the process.
+
+`make slice` generates spotifice_v0_ice.py and the Spotifice package next to
+this file; they are imported while they are newer than spotifice_v0.ice, and
+the Slice is compiled at runtime otherwise (or when they were never built).
+"""
+
+import logging
+from pathlib import Path
+
+import Ice
+
+SLICE = Path(__file__).with_name('spotifice_v0.ice')
+GENERATED = SLICE.with_name('spotifice_v0_ice.py')
+
+logger = logging.getLogger("Slice")
+
+
+def generated_is_fresh():
+    try:
+        return GENERATED.stat().st_mtime >= SLICE.stat().st_mtime
+    except FileNotFoundError:
+        return False
+
+
+if generated_is_fresh():
+    import Spotifice  # type: ignore
+else:
+    if GENERATED.exists():
+        logger.warning(f"{GENERATED.name} is older than {SLICE.name}, run 'make slice'")
+    Ice.loadSlice('', ['-I' + Ice.getSliceDir(), str(SLICE)])
+    import Spotifice  # type: ignore
+
+__all__ = ['Spotifice']
@@ -0,0 +1,112 @@
+import base64
+import hashlib
+import hmac
+import struct
+import threading
+from time import time
+from typing import NamedTuple
+
+HEADER = struct.Struct('>QQIH')  # offset, source version, issued, bitrate
+MAC_SIZE = 12
+
+
+def version_digest(version):
+    """64 bits standing for a content version in tokens"""
+    return int.from_bytes(hashlib.sha256(version.encode()).digest()[:8], 'big')
+
+
+class StreamToken(NamedTuple):
+    """Everything a server needs to serve the next read of a stream"""
+    track_id: str
+    bitrate: int  # variant streamed, 0 for the original file
+    version: int  # version_digest of the original file, so tokens do not outlive it
+    offset: int
+    issued: int = 0  # Unix time (s), renewed on every read
+
+
+class TokenSigner:
+    """Encodes stream tokens as compact base64url strings authenticated with an
+    HMAC, so clients can hold them but not forge them. Servers sharing the
+    secret accept each other's tokens."""
+
+    def __init__(self, secret):
+        self.secret = secret
+
+    def mac(self, payload):
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()[:MAC_SIZE]
+
+    def encode(self, token):
+        payload = HEADER.pack(
+            token.offset, token.version, token.issued, token.bitrate) + \
+            token.track_id.encode()
+        return base64.urlsafe_b64encode(payload + self.mac(payload)).rstrip(b'=').decode()
+
+    def decode(self, text):
+        """StreamToken in text; ValueError if it is malformed or was not signed
+        with this secret"""
+        try:
+            data = base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+        except (ValueError, TypeError):
+            raise ValueError("Malformed token")
+
+        payload, mac = data[:-MAC_SIZE], data[-MAC_SIZE:]
+        if len(payload) < HEADER.size or not hmac.compare_digest(mac, self.mac(payload)):
+            raise ValueError("Invalid token signature")
+
+        offset, version, issued, bitrate = HEADER.unpack_from(payload)
+        return StreamToken(
+            payload[HEADER.size:].decode(), bitrate, version, offset, issued)
+
+
+class TokenStreamGauge:
+    """Token streams read within the last one or two periods, counted without
+    any state per stream.
+
+    A stream is counted in a period on its first read there, told apart from
+    the next ones by the issue time of the token it continues. Streams counted
+    in the previous period stay counted until they read again or end.
+    """
+
+    def __init__(self, period, clock=time):
+        self.period = period
+        self.clock = clock
+        self.bucket = None  # current period, as Unix time // period
+        self.current = 0  # streams counted in it
+        self.carried = 0  # streams of the previous period not seen in this one
+        self.lock = threading.Lock()
+
+    def roll(self):
+        bucket = int(self.clock()) // self.period
+        if bucket != self.bucket:
+            self.carried = self.current if bucket - 1 == self.bucket else 0
+            self.bucket, self.current = bucket, 0
+        return bucket
+
+    def opened(self):
+        with self.lock:
+            self.roll()
+            self.current += 1
+
+    def read(self, issued):
+        """A read continuing a token issued at issued"""
+        with self.lock:
+            bucket = self.roll()
+            if (last := issued // self.period) == bucket:
+                return
+            if last == bucket - 1:
+                self.carried = max(self.carried - 1, 0)
+            self.current += 1
+
+    def ended(self, issued):
+        """The last read of a stream, continuing a token issued at issued"""
+        with self.lock:
+            bucket = self.roll()
+            if (last := issued // self.period) == bucket:
+                self.current = max(self.current - 1, 0)
+            elif last == bucket - 1:
+                self.carried = max(self.carried - 1, 0)
+
+    def count(self):
+        with self.lock:
+            self.roll()
+            return self.current + self.carried
@@ -1,4 +1,7 @@
 import logging
+import subprocess
+import sys
+import tempfile
 import time
 from functools import cached_property
 from threading import Thread
@@ -47,6 +50,26 @@ class IceTestCase(TestCase):
         thread = Thread(target=main, args=args)
         thread.start()
         self.addCleanup(self.server_shutdown, ic, thread)
+        return ic
+
+    def create_server_process(self, script, props):
+        """Server running script in a process of its own, so a test can kill it"""
+        config = tempfile.NamedTemporaryFile('w', suffix='.config')
+        self.addCleanup(config.close)
+        for k, v in props.items():
+            config.write(f'{k} = {v}\n')
+        config.flush()
+
+        process = subprocess.Popen([sys.executable, script, config.name],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        self.addCleanup(self.process_shutdown, process)
+        return process
+
+    @staticmethod
+    def process_shutdown(process):
+        if process.poll() is None:
+            process.terminate()
+        process.wait(5)
 
     @staticmethod
     def server_shutdown(ic, thread):
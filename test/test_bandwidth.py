@@ -0,0 +1,87 @@
+import threading
+from unittest import TestCase
+
+from bandwidth import BandwidthScheduler, DelayQueue, TokenBucket
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTests(TestCase):
+    def test_burst_then_rate(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, 4000, clock)
+
+        self.assertEqual(bucket.reserve(4000), 0)
+        self.assertEqual(bucket.reserve(500), 0.5)
+
+        clock.now = 1.5
+        self.assertEqual(bucket.reserve(1000), 0)
+
+    def test_idle_saves_up_to_capacity(self):
+        clock = FakeClock()
+        bucket = TokenBucket(1000, 2000, clock)
+        bucket.reserve(2000)
+
+        clock.now = 100
+        self.assertEqual(bucket.reserve(2000), 0)
+        self.assertEqual(bucket.reserve(1000), 1)
+
+
+class BandwidthSchedulerTests(TestCase):
+    def test_paces_at_multiple_of_byte_rate(self):
+        scheduler = BandwidthScheduler(pace=2, burst=1, clock=FakeClock())
+        scheduler.add('render', 8000)
+
+        self.assertEqual(scheduler.rates(), {'render': 16000})
+        self.assertEqual(scheduler.reserve('render', 8000), 0)
+        self.assertEqual(scheduler.reserve('render', 8000), 0.5)
+
+    def test_unknown_stream_not_paced(self):
+        self.assertEqual(BandwidthScheduler().reserve('render', 10 ** 9), 0)
+
+    def test_global_rate_fair_shares(self):
+        scheduler = BandwidthScheduler(pace=2, global_rate=30000, clock=FakeClock())
+        scheduler.add('slow', 4000)
+        scheduler.add('fast1', 16000)
+        scheduler.add('fast2', 16000)
+
+        # slow keeps its 8000, the fast ones split the 22000 left
+        self.assertEqual(scheduler.rates(), {'slow': 8000, 'fast1': 11000,
+                                             'fast2': 11000})
+
+    def test_priority_weights(self):
+        scheduler = BandwidthScheduler(global_rate=30000, clock=FakeClock())
+        scheduler.add('high', 16000, 'high')
+        scheduler.add('low', 16000, 'low')
+
+        self.assertEqual(scheduler.rates(), {'high': 24000, 'low': 6000})
+
+    def test_remove_rebalances(self):
+        scheduler = BandwidthScheduler(global_rate=30000, clock=FakeClock())
+        scheduler.add('a', 16000)
+        scheduler.add('b', 16000)
+
+        scheduler.remove('b')
+
+        self.assertEqual(scheduler.rates(), {'a': 30000})
+
+
+class DelayQueueTests(TestCase):
+    def test_calls_in_deadline_order(self):
+        queue = DelayQueue()
+        self.addCleanup(queue.stop)
+        calls = []
+        done = threading.Event()
+
+        queue.call_later(0.1, done.set)
+        queue.call_later(0.05, calls.append, 'second')
+        queue.call_later(0, calls.append, 'first')
+
+        self.assertTrue(done.wait(1))
+        self.assertEqual(calls, ['first', 'second'])
@@ -0,0 +1,140 @@
+import random
+from typing import NamedTuple
+from unittest import TestCase
+
+from catalog_index import CatalogIndex
+
+
+class Track(NamedTuple):
+    id: str
+    title: str
+    filename: str
+
+
+def track(name, title=None):
+    return Track(f'{name}.mp3', title or name, f'{name}.mp3')
+
+
+class CatalogIndexTests(TestCase):
+    def setUp(self):
+        self.sut = CatalogIndex([
+            track('still-alive', 'Still Alive'),
+            track('want-you-gone', 'Want You Gone'),
+            track('science', 'Science is Fun'),
+            track('cara-mia', 'Cara Mia Addio'),
+        ])
+
+    def titles(self, tracks):
+        return [t.title for t in tracks]
+
+    def test_list_pages(self):
+        first, cursor = self.sut.list('title', '', 3)
+        second, last_cursor = self.sut.list('title', cursor, 3)
+
+        self.assertEqual(self.titles(first), ['Cara Mia Addio', 'Science is Fun',
+                                              'Still Alive'])
+        self.assertEqual(self.titles(second), ['Want You Gone'])
+        self.assertEqual(last_cursor, '')
+
+    def test_list_by_filename(self):
+        tracks, _ = self.sut.list('filename', '', 10)
+
+        self.assertEqual(tracks[0].filename, 'cara-mia.mp3')
+
+    def test_prefix_search(self):
+        tracks, _ = self.sut.search('s', True, '', 10)
+
+        self.assertEqual(self.titles(tracks), ['Science is Fun', 'Still Alive'])
+
+    def test_substring_search(self):
+        tracks, _ = self.sut.search('ALIVE', False, '', 10)
+        self.assertEqual(self.titles(tracks), ['Still Alive'])
+
+        tracks, _ = self.sut.search('ou', False, '', 10)
+        self.assertEqual(self.titles(tracks), ['Want You Gone'])
+
+    def test_remove(self):
+        self.sut.remove('science.mp3')
+
+        self.assertEqual(self.sut.search('science', False, '', 10)[0], [])
+        self.assertEqual(len(self.sut.list('title', '', 10)[0]), 3)
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(ValueError):
+            self.sut.list('title', 'garbage', 10)
+
+    def test_search_sees_added_tracks(self):
+        self.assertEqual(self.sut.search('gone', False, '', 10)[0][0].title,
+                         'Want You Gone')
+
+        self.sut.add(track('gone-fishing', 'Gone Fishing'))
+
+        tracks, _ = self.sut.search('gone', False, '', 10)
+        self.assertEqual(self.titles(tracks), ['Gone Fishing', 'Want You Gone'])
+
+
+class SearchPagingTests(TestCase):
+    """Pages walked through every search path against a brute force search"""
+
+    def setUp(self):
+        rng = random.Random(7)
+        words = ['alpha', 'beta', 'gamma', 'an', 'xylo', 'zed', 'qua', 'mia']
+        self.tracks = [track(f'{i:03d}-{rng.choice(words)}',
+                             ' '.join(rng.choices(words, k=2)).title())
+                       for i in range(300)]
+        self.sut = CatalogIndex(self.tracks)
+
+    def expected(self, query, prefix):
+        def matches(key):
+            return key.startswith(query) if prefix else query in key
+
+        found = [t for t in self.tracks
+                 if matches(t.title.lower()) or matches(t.filename.lower())]
+        return sorted(found, key=lambda t: (t.title.lower(), t.id))
+
+    def all_pages(self, query, prefix, limit):
+        tracks, cursor = self.sut.search(query, prefix, '', limit)
+        while cursor:
+            page, cursor = self.sut.search(query, prefix, cursor, limit)
+            tracks += page
+        return tracks
+
+    def test_pages_cover_matches_in_order(self):
+        for query in ['a', 'an', 'gamma', 'xy', 'zed', '00', 'nothing']:
+            for prefix in [True, False]:
+                for scan_factor in [0, 8, 1000]:
+                    self.sut.SCAN_FACTOR = scan_factor
+                    self.sut.results.clear()
+                    with self.subTest(query=query, prefix=prefix, scan=scan_factor):
+                        self.assertEqual(self.all_pages(query, prefix, 7),
+                                         self.expected(query, prefix))
+
+
+class DeferredPostingsTests(TestCase):
+    def setUp(self):
+        self.sut = CatalogIndex([track('still-alive', 'Still Alive'),
+                                 track('want-you-gone', 'Want You Gone')],
+                                build_postings=False)
+
+    def titles(self, query):
+        return [t.title for t in self.sut.search(query, False, '', 10)[0]]
+
+    def test_substring_search_before_postings_are_built(self):
+        self.assertIsNone(self.sut.postings)
+        self.assertEqual(self.titles('you'), ['Want You Gone'])
+
+    def test_changes_while_building_reach_the_postings(self):
+        self.sut.changed = set()
+        keys = dict(self.sut.keys)
+        postings = self.sut.collect_postings(keys)
+
+        self.sut.remove('want-you-gone.mp3')
+        self.sut.add(track('still-alive', 'Still Alive Again'))
+        self.sut.add(track('gone-fishing', 'Gone Fishing'))
+        self.sut.install_postings(keys, postings)
+
+        self.assertEqual(self.titles('gone'), ['Gone Fishing'])
+        self.assertEqual(self.titles('again'), ['Still Alive Again'])
+        self.assertNotIn('you', self.sut.postings)
+        self.assertEqual(self.sut.postings,
+                         self.sut.collect_postings(self.sut.keys))
@@ -0,0 +1,90 @@
+from pathlib import Path
+from unittest import TestCase
+
+from chunk_cache import BlockCache
+from handle_pool import HandlePool
+from media_server import Spotifice, StreamedFile, open_mapped_file
+
+
+class BlockLoader:
+    def __init__(self, data, block_size):
+        self.data = data
+        self.block_size = block_size
+        self.loads = []
+
+    def __call__(self, index):
+        self.loads.append(index)
+        start = index * self.block_size
+        return self.data[start:start + self.block_size]
+
+
+class BlockCacheTests(TestCase):
+    def setUp(self):
+        self.data = bytes(range(256)) * 10
+        self.loader = BlockLoader(self.data, 100)
+
+    def test_read_spanning_blocks(self):
+        sut = BlockCache(10000, 100)
+
+        self.assertEqual(sut.read('f', 50, 200, self.loader), self.data[50:250])
+        self.assertEqual(self.loader.loads, [0, 1, 2])
+
+    def test_read_past_end(self):
+        sut = BlockCache(10000, 100)
+
+        self.assertEqual(sut.read('f', 2500, 200, self.loader), self.data[2500:])
+        self.assertEqual(sut.read('f', 2560, 100, self.loader), b'')
+
+    def test_hits_share_blocks_across_readers(self):
+        sut = BlockCache(10000, 100)
+
+        sut.read('f', 0, 100, self.loader)
+        sut.read('f', 0, 100, self.loader)
+
+        self.assertEqual(self.loader.loads, [0])
+        self.assertEqual((sut.hits, sut.misses), (1, 1))
+
+    def test_eviction_keeps_budget(self):
+        sut = BlockCache(300, 100)
+
+        sut.read('f', 0, 500, self.loader)
+
+        self.assertEqual(sut.size, 300)
+        self.assertEqual(sut.evictions, 2)
+        sut.read('f', 0, 100, self.loader)
+        self.assertEqual(self.loader.loads[-1], 0)
+
+    def test_zero_budget_disables_storage(self):
+        sut = BlockCache(0, 100)
+
+        sut.read('f', 0, 100, self.loader)
+        sut.read('f', 0, 100, self.loader)
+
+        self.assertEqual(sut.stats()['blocks'], 0)
+        self.assertEqual(sut.misses, 2)
+
+    def test_buffer_blocks_are_sliced_not_copied(self):
+        sut = BlockCache(10000, 100)
+        data = bytearray(self.data)
+        view = memoryview(data)
+
+        chunk = sut.read('f', 150, 20, lambda index: view[index * 100:index * 100 + 100])
+
+        self.assertIs(chunk.obj, data)
+        self.assertEqual(chunk, self.data[150:170])
+
+
+class StreamedFileCacheTests(TestCase):
+    def test_cached_blocks_do_not_pin_evicted_mappings(self):
+        track = Spotifice.TrackInfo(id='4s', title='4s', filename='4s.mp3')
+        pool = HandlePool(1, open_mapped_file)
+        cache = BlockCache(1024 * 1024, 1024)
+        sut = StreamedFile(track, Path('test/media/4s.mp3'), pool, cache)
+
+        chunk = sut.read(100)
+        with pool.borrow(sut.key) as mapped:
+            pass
+        pool.close_all()
+
+        self.assertTrue(mapped.map.closed)
+        self.assertIsInstance(chunk.obj, bytes)
@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from chunk_sizer import ChunkSizer
+
+
+class ChunkSizerTests(TestCase):
+    def sizer(self, **kwargs):
+        # 16000 bytes of margin at 8000 bytes/s: reads may take up to 1 s
+        return ChunkSizer(**{'read_size': 16384, 'margin': 16000, 'byte_rate': 8000,
+                             **kwargs})
+
+    def test_fast_reads_grow(self):
+        sizer = self.sizer()
+
+        sizer.observe(16384, 0.1)
+
+        self.assertEqual(sizer.read_size, 32768)
+
+    def test_slow_reads_shrink(self):
+        sizer = self.sizer()
+
+        sizer.observe(16384, 1.5)
+
+        self.assertEqual(sizer.read_size, 8192)
+
+    def test_reads_within_budget_keep_size(self):
+        sizer = self.sizer()
+
+        sizer.observe(16384, 0.7)
+
+        self.assertEqual(sizer.read_size, 16384)
+
+    def test_short_read_does_not_grow(self):
+        sizer = self.sizer()
+
+        sizer.observe(1000, 0.01)
+
+        self.assertEqual(sizer.read_size, 16384)
+
+    def test_unknown_byte_rate_keeps_size(self):
+        sizer = self.sizer(byte_rate=0)
+
+        sizer.observe(16384, 10)
+
+        self.assertEqual(sizer.read_size, 16384)
+
+    def test_bounds(self):
+        sizer = self.sizer(min_read=4096, max_read=65536)
+        for _ in range(10):
+            sizer.observe(sizer.read_size, 0.01)
+        self.assertEqual(sizer.read_size, 65536)
+
+        for _ in range(10):
+            sizer.observe(sizer.read_size, 5)
+        self.assertEqual(sizer.read_size, 4096)
+
+    def test_more_chunks_per_read_past_max_chunk(self):
+        self.assertEqual(self.sizer(max_chunk=65536).next_read(), (16384, 1))
+        self.assertEqual(self.sizer(max_chunk=4096).next_read(), (4096, 4))
+        self.assertEqual(self.sizer(read_size=5000, max_chunk=4096).next_read(),
+                         (4096, 2))
+
+    def test_reads_in_flight_cover_latency(self):
+        sizer = self.sizer(max_depth=4)
+
+        sizer.observe(16384, 0.7)
+        self.assertEqual(sizer.depth, 1)
+
+        sizer.observe(16384, 4)  # 1.5 * 8000 B/s * 4 s = 48000 bytes per read time
+        self.assertEqual(sizer.depth, 3)
+
+        sizer.observe(16384, 60)
+        self.assertEqual(sizer.depth, 4)
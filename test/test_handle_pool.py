@@ -0,0 +1,55 @@
+from unittest import TestCase
+
+from handle_pool import HandlePool
+
+
+class FakeHandle:
+    def __init__(self, key):
+        self.key = key
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class HandlePoolTests(TestCase):
+    def setUp(self):
+        self.opened = []
+        self.sut = HandlePool(2, self.open)
+
+    def open(self, key):
+        self.opened.append(FakeHandle(key))
+        return self.opened[-1]
+
+    def test_handles_are_shared(self):
+        with self.sut.borrow('a') as first, self.sut.borrow('a') as second:
+            self.assertIs(first, second)
+
+        self.assertEqual(self.sut.opened, 1)
+
+    def test_least_recently_used_handle_is_closed(self):
+        for key in 'aba':
+            with self.sut.borrow(key):
+                pass
+
+        with self.sut.borrow('c'):
+            pass
+
+        self.assertEqual([h.key for h in self.opened if h.closed], ['b'])
+        self.assertEqual(self.sut.stats()['handles'], 2)
+
+    def test_borrowed_handles_are_not_closed(self):
+        with self.sut.borrow('a'), self.sut.borrow('b'), self.sut.borrow('c'):
+            self.assertEqual(self.sut.stats()['borrowed'], 3)
+            self.assertFalse(any(h.closed for h in self.opened))
+
+        self.assertEqual(self.sut.stats()['handles'], 2)
+
+    def test_close_all(self):
+        with self.sut.borrow('a'):
+            pass
+
+        self.sut.close_all()
+
+        self.assertTrue(self.opened[0].closed)
+        self.assertEqual(self.sut.stats()['handles'], 0)
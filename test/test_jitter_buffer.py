@@ -0,0 +1,116 @@
+import threading
+from unittest import TestCase
+
+from jitter_buffer import JitterBuffer, parse_watermark
+
+
+class ChunkSource:
+    def __init__(self, data, release=True):
+        self.data = data
+        self.offset = 0
+        self.calls = 0
+        self.released = threading.Event()
+        if release:
+            self.released.set()
+
+    def fetch(self, size):
+        self.released.wait()
+        self.calls += 1
+        chunk = self.data[self.offset:self.offset + size]
+        self.offset += len(chunk)
+        return chunk
+
+
+class ClosableSource(ChunkSource):
+    def __init__(self, data):
+        super().__init__(data)
+        self.closed = threading.Event()
+
+    def __call__(self, size):
+        return self.fetch(size)
+
+    def close(self):
+        self.closed.set()
+
+
+class ParseWatermarkTests(TestCase):
+    def test_bytes(self):
+        self.assertEqual(parse_watermark('32768', 16000), 32768)
+        self.assertEqual(parse_watermark('64k', 16000), 65536)
+
+    def test_seconds(self):
+        self.assertEqual(parse_watermark('1.5s', 16000), 24000)
+
+
+class JitterBufferTests(TestCase):
+    def test_read_whole_stream(self):
+        data = bytes(range(256)) * 40
+        buffer = JitterBuffer(ChunkSource(data).fetch, 1024, 4096, 1000).start()
+
+        received = bytearray()
+        while chunk := buffer.read(700, timeout=1):
+            received += chunk
+
+        self.assertEqual(received, data)
+
+    def test_prefetch_stops_at_high_watermark(self):
+        source = ChunkSource(bytes(100000))
+        buffer = JitterBuffer(source.fetch, 1000, 4000, 1000).start()
+
+        with buffer.changed_c:
+            self.assertTrue(buffer.changed_c.wait_for(lambda: buffer.level >= 4000, 1))
+        buffer.stop()
+
+        self.assertEqual(source.calls, 4)
+        self.assertEqual(buffer.overruns, 0)
+
+    def test_underrun_is_counted(self):
+        source = ChunkSource(bytes(3000), release=False)
+        buffer = JitterBuffer(source.fetch, 1000, 4000, 1000).start()
+        threading.Timer(0.1, source.released.set).start()
+
+        self.assertEqual(len(buffer.read(500, timeout=1)), 500)
+        self.assertEqual(buffer.underruns, 1)
+
+    def test_overrun_is_counted(self):
+        buffer = JitterBuffer(ChunkSource(bytes(10000)).fetch, 1000, 2500, 1000).start()
+
+        with buffer.changed_c:
+            buffer.changed_c.wait_for(lambda: buffer.level >= 2500, 1)
+
+        self.assertEqual(buffer.overruns, 1)
+
+    def test_read_timeout(self):
+        source = ChunkSource(bytes(1000), release=False)
+        buffer = JitterBuffer(source.fetch, 0, 1000).start()
+
+        self.assertIsNone(buffer.read(100, timeout=0.05))
+        source.released.set()
+
+    def test_reset_refills_from_new_position(self):
+        data = bytes(range(256)) * 40
+        source = ChunkSource(data)
+        buffer = JitterBuffer(source.fetch, 1000, 4000, 1000).start()
+        buffer.read(1000, timeout=1)
+
+        buffer.reset(lambda: setattr(source, 'offset', 5000))
+
+        self.assertEqual(buffer.read(1000, timeout=1), data[5000:6000])
+
+    def test_reset_after_end_of_stream(self):
+        data = bytes(range(256)) * 4
+        source = ChunkSource(data)
+        buffer = JitterBuffer(source.fetch, 100, 4000, 100).start()
+        while buffer.read(100, timeout=1):
+            pass
+
+        buffer.reset(lambda: setattr(source, 'offset', 1000))
+        self.assertEqual(buffer.read(100, timeout=1), data[1000:])
+
+    def test_stop_closes_source(self):
+        source = ClosableSource(b'x' * 1000)
+        buffer = JitterBuffer(source, 100, 400, 100).start()
+
+        buffer.stop()
+
+        self.assertTrue(source.closed.wait(1))
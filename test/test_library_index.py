@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest.mock import patch
+
+from library_index import LibraryIndex
+
+
+class LibraryIndexTests(TestCase):
+    def setUp(self):
+        self.media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        for name in ['1s.mp3', '2s.mp3', 'bad-file.mp3']:
+            shutil.copy(Path('test/media') / name, self.media_dir)
+        (self.media_dir / 'notes.txt').write_text('not media')
+        self.db_path = self.media_dir / 'index.db'
+
+    def scan(self):
+        index = LibraryIndex(self.db_path, workers=2)
+        self.addCleanup(index.close)
+        probed = []
+        probe = index.probe
+        index.probe = lambda *args: probed.append(args[0].name) or probe(*args)
+        return index.scan(self.media_dir), sorted(probed)
+
+    def test_scan_probes_metadata(self):
+        records, probed = self.scan()
+
+        self.assertEqual([r.filename for r in records],
+                         ['1s.mp3', '2s.mp3', 'bad-file.mp3'])
+        self.assertEqual(probed, ['1s.mp3', '2s.mp3', 'bad-file.mp3'])
+        self.assertEqual(records[0].title, '1s')
+        self.assertAlmostEqual(records[0].bitrate, 64, delta=2)
+        self.assertGreater(records[1].duration, 1900)
+        self.assertEqual(records[2].duration, 0)
+
+    def test_rescan_only_probes_changed_files(self):
+        self.scan()
+        shutil.copy('test/media/4s.mp3', self.media_dir / '2s.mp3')
+        shutil.copy('test/media/4s.mp3', self.media_dir / '4s.mp3')
+
+        records, probed = self.scan()
+
+        self.assertEqual(probed, ['2s.mp3', '4s.mp3'])
+        self.assertGreater(records[1].duration, 3900)
+
+    def test_rescan_drops_removed_files(self):
+        self.scan()
+        (self.media_dir / '1s.mp3').unlink()
+
+        records, probed = self.scan()
+
+        self.assertEqual([r.filename for r in records], ['2s.mp3', 'bad-file.mp3'])
+        self.assertEqual(probed, [])
+
+    def test_seek_table_is_persisted(self):
+        filepath = self.media_dir / '2s.mp3'
+        first = LibraryIndex(self.db_path)
+        table = first.seek_table(filepath)
+        first.close()
+
+        index = LibraryIndex(self.db_path)
+        self.addCleanup(index.close)
+        with patch('mp3info.seek_table') as build:
+            self.assertEqual(index.seek_table(filepath), table)
+
+        build.assert_not_called()
+
+    def test_seek_table_rebuilt_when_file_changes(self):
+        index = LibraryIndex(self.db_path)
+        self.addCleanup(index.close)
+        filepath = self.media_dir / '2s.mp3'
+        index.seek_table(filepath)
+        shutil.copy('test/media/4s.mp3', filepath)
+
+        self.assertEqual(index.seek_table(filepath).step, 40)
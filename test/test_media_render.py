@@ -1,6 +1,27 @@
+import shutil
+import signal
+import tempfile
+from pathlib import Path
+from time import sleep
+from unittest import TestCase, mock
+
+import Ice
+import pytest
+
+pytest.importorskip('gi', reason="the render tests need GStreamer's Python bindings")
+
+from chunk_sizer import ChunkSizer
 from gst_player import GstPlayer
-from media_render import Spotifice
+from jitter_buffer import JitterBuffer
+from media_render import (
+    ChunkReader,
+    MediaRenderI,
+    Spotifice,
+    ThroughputMeter,
+    choose_bitrate,
+)
 from media_render import main as render_main
+from media_server import MediaServerI
 from media_server import main as server_main
 
 from .icetest import IceTestCase
@@ -9,23 +30,27 @@ from .icetest import IceTestCase
 class TestRender(IceTestCase):
     render_port = 10001
     server_port = 10000
+    player_options = {}
+    render_options = {}
 
     def setUp(self):
         server_props = {
             'MediaServerAdapter.Endpoints': f'tcp -p {self.server_port}',
-            'MediaServer.Content': 'test/media'}
+            'MediaServer.Content': 'test/media',
+            'MediaServer.IndexFile': ':memory:'}
         server_endpoint = f'mediaServer1:default -p {self.server_port} -t 500'
         self.create_server(server_main, server_props)
 
-        player = GstPlayer()
-        player.start()
+        player = GstPlayer(**self.player_options)
         self.addCleanup(player.shutdown)
 
         render_props = {
-            'MediaRenderAdapter.Endpoints': f'tcp -p {self.render_port}'}
+            'MediaRenderAdapter.Endpoints': f'tcp -p {self.render_port}',
+            **self.render_options}
         render_enpoint = f'mediaRender1:default -p {self.render_port} -t 500'
         self.create_server(render_main, render_props, player)
 
+        self.player = player
         self.server = self.create_proxy(server_endpoint, Spotifice.MediaServerPrx)
         self.sut = self.create_proxy(render_enpoint, Spotifice.MediaRenderPrx)
 
@@ -59,6 +84,14 @@ class PlaybackTests(TestRender):
 
         self.sut.play()
 
+    def test_play_confirmed_with_first_audio(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('2s.mp3')
+
+        self.sut.play()
+
+        self.assertTrue(self.player.first_audio_e.is_set())
+
     def test_can_not_play_if_player_busy(self):
         tracks = self.server.get_all_tracks()
         self.sut.bind_media_server(self.server)
@@ -70,3 +103,619 @@ class PlaybackTests(TestRender):
             self.sut.play()
 
         self.assertEqual(cm.exception.reason, "Already playing")
+
+
+class UnconfirmedPlayTests(TestRender):
+    def setUp(self):
+        super().setUp()
+        self.player.confirm_play_starts = lambda: False
+
+    def test_failed_play_closes_stream(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+
+        with self.assertRaises(Spotifice.PlayerError) as cm:
+            self.sut.play()
+
+        self.assertEqual(cm.exception.reason, "Failed to confirm playback")
+        self.assertEqual(self.server.get_active_streams(), 0)
+        self.assertTrue(self.player.stop_confirmed_e.is_set())
+
+    def test_failed_group_start_leaves_group(self):
+        group = self.server.create_group('house')
+        group.add_member(self.sut)
+
+        group.play('4s.mp3')
+
+        self.assertEqual(self.server.get_active_streams(), 0)
+        self.assertTrue(self.player.stop_confirmed_e.is_set())
+
+
+class SeekTests(TestRender):
+    def test_seek_while_stopped_sets_start_position(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+
+        self.sut.seek(2000)
+
+        self.assertEqual(self.sut.get_position(), 2000)
+
+    def test_load_track_resets_position(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+        self.sut.seek(2000)
+
+        self.sut.load_track('2s.mp3')
+
+        self.assertEqual(self.sut.get_position(), 0)
+
+    def test_seek_while_playing(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+        self.sut.play()
+
+        self.sut.seek(3000)
+
+        self.assertGreaterEqual(self.sut.get_position(), 3000)
+
+    def test_seek_invalid_position(self):
+        self.sut.bind_media_server(self.server)
+
+        with self.assertRaises(Spotifice.PlayerError) as cm:
+            self.sut.seek(-1)
+
+        self.assertEqual(cm.exception.reason, "Invalid seek position")
+
+
+class ReusedPipelineTests(TestRender):
+    player_options = dict(
+        pipeline='appsrc name=src ! decodebin ! fakesink name=sink sync=true',
+        reuse_pipeline=True)
+
+    def test_play_again_after_stop(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('2s.mp3')
+
+        for _ in range(2):
+            self.sut.play()
+            self.assertTrue(self.player.first_audio_e.wait(5))
+            self.sut.stop()
+
+    def test_pipeline_kept_across_tracks(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('2s.mp3')
+        self.sut.play()
+        pipeline = self.player.pipeline
+
+        self.sut.load_track('1s.mp3')
+
+        self.assertIs(self.player.pipeline, pipeline)
+        self.assertTrue(self.player.first_audio_e.wait(5))
+
+
+class QueueTests(TestRender):
+    def test_enqueue_unbound_server(self):
+        with self.assertRaises(Spotifice.BadReference):
+            self.sut.enqueue('1s.mp3')
+
+    def test_enqueue_unknown_track(self):
+        self.sut.bind_media_server(self.server)
+
+        with self.assertRaises(Spotifice.TrackError):
+            self.sut.enqueue('missing.mp3')
+
+    def test_enqueue_keeps_order(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.enqueue('2s.mp3')
+        self.sut.enqueue('1s.mp3')
+
+        self.assertEqual([t.id for t in self.sut.get_queue()], ['2s.mp3', '1s.mp3'])
+
+    def test_next_empty_queue(self):
+        self.sut.bind_media_server(self.server)
+
+        with self.assertRaises(Spotifice.TrackError) as cm:
+            self.sut.next()
+
+        self.assertEqual(cm.exception.reason, "Queue is empty")
+
+    def test_next_loads_queue_head(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.enqueue('2s.mp3')
+        self.sut.enqueue('1s.mp3')
+
+        self.sut.next()
+
+        self.assertEqual(self.sut.get_current_track().id, '2s.mp3')
+        self.assertEqual([t.id for t in self.sut.get_queue()], ['1s.mp3'])
+
+    def test_next_while_playing(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+        self.sut.enqueue('2s.mp3')
+        self.sut.play()
+
+        self.sut.next()
+
+        self.assertEqual(self.sut.get_current_track().id, '2s.mp3')
+
+    def test_clear_queue(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.enqueue('2s.mp3')
+
+        self.sut.clear_queue()
+
+        self.assertEqual(self.sut.get_queue(), [])
+
+
+class TokenStreamTests(TestRender):
+    render_options = {'MediaRender.StreamTokens': '1'}
+
+    def test_play_leaves_no_server_stream(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+
+        self.sut.play()
+
+        self.assertEqual(self.server.get_active_streams(), 0)
+
+    def test_seek_while_playing(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('4s.mp3')
+        self.sut.play()
+
+        self.sut.seek(2000)
+
+        self.assertGreaterEqual(self.sut.get_position(), 2000)
+
+
+class TrackCacheTests(TestRender):
+    def setUp(self):
+        self.cache_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+        self.render_options = {'MediaRender.Cache.Directory': str(self.cache_dir)}
+        super().setUp()
+
+    def wait_cached(self):
+        for _ in range(20):
+            if list(self.cache_dir.glob('*.mp3')):
+                return
+            sleep(0.1)
+
+        self.fail('Track not cached')
+
+    def test_streamed_track_is_cached(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('1s.mp3')
+
+        self.sut.play()
+
+        self.wait_cached()
+        cached, = self.cache_dir.glob('*.mp3')
+        self.assertEqual(cached.read_bytes(), Path('test/media/1s.mp3').read_bytes())
+
+    def test_cached_track_plays_without_server_stream(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('1s.mp3')
+        self.sut.play()
+        self.wait_cached()
+        self.sut.stop()
+
+        self.sut.play()
+
+        self.assertEqual(self.server.get_active_streams(), 0)
+
+
+class UnindexedServerTests(TestCase):
+    """Tracks served without a library index have no bitrate"""
+
+    def setUp(self):
+        self.player = GstPlayer()
+        self.addCleanup(self.player.shutdown)
+        ic = Ice.initialize()
+        self.addCleanup(ic.destroy)
+        adapter = ic.createObjectAdapterWithEndpoints('TestAdapter', 'tcp -h 127.0.0.1')
+        server = MediaServerI(Path('test/media'))
+        self.addCleanup(server.shutdown)
+        self.server = Spotifice.MediaServerPrx.uncheckedCast(adapter.addWithUUID(server))
+        self.sut = Spotifice.MediaRenderPrx.uncheckedCast(
+            adapter.addWithUUID(MediaRenderI(self.player)))
+        adapter.activate()
+
+    def test_play_track_without_bitrate(self):
+        self.sut.bind_media_server(self.server)
+        self.sut.load_track('1s.mp3')
+        self.assertIs(self.sut.get_current_track().bitrate, Ice.Unset)
+
+        self.sut.play()
+
+        self.assertTrue(self.player.first_audio_e.wait(5))
+
+
+class MultipleRendersTests(IceTestCase):
+    render_port = 10001
+    server_port = 10000
+
+    def setUp(self):
+        server_props = {
+            'MediaServerAdapter.Endpoints': f'tcp -p {self.server_port}',
+            'MediaServer.Content': 'test/media',
+            'MediaServer.IndexFile': ':memory:'}
+        self.create_server(server_main, server_props)
+
+        players = [GstPlayer(), GstPlayer()]
+        for player in players:
+            self.addCleanup(player.shutdown)
+
+        render_props = {
+            'MediaRenderAdapter.Endpoints': f'tcp -p {self.render_port}',
+            'MediaRender.Identities': 'zone1 zone2'}
+        self.create_server(render_main, render_props, *players)
+
+        server_endpoint = f'mediaServer1:default -p {self.server_port} -t 500'
+        self.server = self.create_proxy(server_endpoint, Spotifice.MediaServerPrx)
+        self.zones = [
+            self.create_proxy(f'{name}:default -p {self.render_port} -t 500',
+                              Spotifice.MediaRenderPrx)
+            for name in ['zone1', 'zone2']]
+
+    def test_zones_play_independently(self):
+        for zone, track_id in zip(self.zones, ['4s.mp3', '2s.mp3']):
+            zone.bind_media_server(self.server)
+            zone.load_track(track_id)
+            zone.play()
+
+        self.zones[0].stop()
+
+        self.assertEqual(self.zones[1].get_current_track().id, '2s.mp3')
+        with self.assertRaises(Spotifice.PlayerError) as cm:
+            self.zones[1].play()
+
+        self.assertEqual(cm.exception.reason, "Already playing")
+
+
+class GroupTests(MultipleRendersTests):
+    def test_group_plays_track_on_every_member(self):
+        group = self.server.create_group('house')
+        for zone in self.zones:
+            group.add_member(zone)
+
+        group.play('2s.mp3')
+
+        for zone in self.zones:
+            self.assertEqual(zone.get_current_track().id, '2s.mp3')
+            with self.assertRaises(Spotifice.PlayerError) as cm:
+                zone.play()
+            self.assertEqual(cm.exception.reason, "Already playing")
+
+    def test_group_stop_stops_members(self):
+        group = self.server.create_group('house')
+        group.add_member(self.zones[0])
+        group.play('2s.mp3')
+
+        group.stop()
+
+        self.zones[0].bind_media_server(self.server)
+        self.zones[0].play()
+
+    def test_seek_in_group_rejected(self):
+        group = self.server.create_group('house')
+        group.add_member(self.zones[0])
+        group.play('4s.mp3')
+
+        with self.assertRaises(Spotifice.PlayerError) as cm:
+            self.zones[0].seek(1000)
+
+        self.assertEqual(cm.exception.reason, "Can not seek in a group")
+
+    def test_solo_play_leaves_group(self):
+        group = self.server.create_group('house')
+        group.add_member(self.zones[0])
+        group.play('4s.mp3')
+
+        self.zones[0].stop()
+        self.zones[0].bind_media_server(self.server)
+        self.zones[0].load_track('1s.mp3')
+        self.zones[0].play()
+
+        self.assertEqual(self.zones[0].get_current_track().id, '1s.mp3')
+
+
+class ReplicaTests(IceTestCase):
+    render_port = 10001
+    server_ports = [10000, 10002]
+
+    def setUp(self):
+        # replicas run in processes of their own, so failing one is a real crash
+        self.server_processes = []
+        self.servers = []
+        for port in self.server_ports:
+            server_props = {
+                'MediaServerAdapter.Endpoints': f'tcp -p {port}',
+                'MediaServer.Content': 'test/media',
+                'MediaServer.IndexFile': ':memory:'}
+            self.server_processes.append(
+                self.create_server_process('media_server.py', server_props))
+            self.servers.append(self.create_proxy(
+                f'mediaServer1:default -p {port} -t 500', Spotifice.MediaServerPrx))
+
+        player = GstPlayer()
+        self.addCleanup(player.shutdown)
+
+        render_props = {
+            'MediaRenderAdapter.Endpoints': f'tcp -p {self.render_port}'}
+        self.create_server(render_main, render_props, player)
+        self.sut = self.create_proxy(f'mediaRender1:default -p {self.render_port} -t 500',
+                                     Spotifice.MediaRenderPrx)
+
+    def unreachable_server(self):
+        return Spotifice.MediaServerPrx.uncheckedCast(
+            self.client_ic.stringToProxy('mediaServer1:default -p 10009 -t 500'))
+
+    def test_bind_skips_unreachable_replica(self):
+        self.sut.bind_media_servers([self.unreachable_server(), self.servers[0]])
+
+        self.sut.load_track('1s.mp3')
+        self.sut.play()
+
+        self.assertEqual(self.servers[0].get_active_streams(), 1)
+
+    def test_bind_without_reachable_replica(self):
+        with self.assertRaises(Spotifice.BadReference):
+            self.sut.bind_media_servers([self.unreachable_server()])
+
+    def test_stream_goes_to_least_loaded_replica(self):
+        self.servers[0].open_stream('1s.mp3', Ice.Identity(name='other-render'))
+        self.sut.bind_media_servers(self.servers)
+        self.sut.load_track('4s.mp3')
+
+        self.sut.play()
+
+        self.assertEqual([s.get_active_streams() for s in self.servers], [1, 1])
+
+    def test_clear_queue_closes_prefetch_on_its_replica(self):
+        self.sut.bind_media_servers(self.servers)
+        self.sut.load_track('4s.mp3')
+        self.sut.play()
+        self.sut.enqueue('2s.mp3')  # prefetched on the less loaded replica
+        for _ in range(20):
+            if [s.get_active_streams() for s in self.servers] == [1, 1]:
+                break
+            sleep(0.1)
+
+        self.sut.clear_queue()
+
+        self.assertEqual([s.get_active_streams() for s in self.servers], [1, 0])
+
+    def test_reader_fails_over_at_same_offset(self):
+        render_id = Ice.Identity(name='failover-render')
+        self.servers[0].open_stream('4s.mp3', render_id)
+        reader = ChunkReader(self.servers[0], render_id, '4s.mp3', 1, ThroughputMeter(),
+                             replicas=lambda failed: [self.servers[1]])
+
+        data = reader(4096)
+        self.server_processes[0].kill()
+        while chunk := reader(4096):
+            data += chunk
+
+        self.assertEqual(reader.server, self.servers[1])
+        with open('test/media/4s.mp3', 'rb') as f:
+            self.assertEqual(data, f.read())
+
+    @mock.patch('media_render.READ_TIMEOUT_MS', 500)
+    def test_reader_fails_over_from_hung_replica(self):
+        render_id = Ice.Identity(name='failover-render')
+        self.servers[0].open_stream('4s.mp3', render_id)
+        reader = ChunkReader(self.servers[0], render_id, '4s.mp3', 1, ThroughputMeter(),
+                             replicas=lambda failed: [self.servers[1]])
+
+        data = reader(4096)
+        hung = self.server_processes[0]
+        hung.send_signal(signal.SIGSTOP)
+        self.addCleanup(hung.kill)
+        while chunk := reader(4096):
+            data += chunk
+
+        self.assertEqual(reader.server, self.servers[1])
+        with open('test/media/4s.mp3', 'rb') as f:
+            self.assertEqual(data, f.read())
+
+
+class StreamLeaseTests(IceTestCase):
+    def setUp(self):
+        server_props = {
+            'MediaServerAdapter.Endpoints': 'tcp -p 10000',
+            'MediaServer.Content': 'test/media',
+            'MediaServer.IndexFile': ':memory:',
+            'MediaServer.StreamLease': '1'}
+        self.create_server(server_main, server_props)
+        self.server = self.create_proxy('mediaServer1:default -p 10000 -t 500',
+                                        Spotifice.MediaServerPrx)
+
+    def test_reader_reopens_reaped_stream(self):
+        # a prefetched stream sits idle until the current track ends
+        render_id = Ice.Identity(name='prefetch-render')
+        self.server.open_stream('4s.mp3', render_id)
+        reader = ChunkReader(self.server, render_id, '4s.mp3', 1, ThroughputMeter())
+        data = reader(4096)
+
+        sleep(2)
+        while chunk := reader(4096):
+            data += chunk
+
+        with open('test/media/4s.mp3', 'rb') as f:
+            self.assertEqual(data, f.read())
+
+
+class FixedMeter:
+    def __init__(self, rate):
+        self.rate = rate
+
+    def add(self, nbytes, elapsed):
+        pass
+
+
+class VariantServer:
+    """Serves silence; switches to the variants in ready, at twice the offset"""
+
+    def __init__(self, ready):
+        self.ready = ready
+        self.switches = []
+        self.seeks = []
+
+    def ice_invocationTimeout(self, timeout):
+        return self
+
+    def read_chunks(self, render_id, offset, count, chunk_size):
+        return [bytes(chunk_size)]
+
+    def read_chunksAsync(self, render_id, offset, count, chunk_size):
+        future = Ice.Future()
+        future.set_result(self.read_chunks(render_id, offset, count, chunk_size))
+        return future
+
+    def open_stream_variant_at(self, track_id, render_id, bitrate, from_bitrate, offset):
+        self.switches.append((bitrate, from_bitrate, offset))
+        if bitrate not in self.ready:
+            return Spotifice.StreamPoint(from_bitrate, offset)
+        return Spotifice.StreamPoint(bitrate, offset * 2)
+
+    def seek_stream(self, render_id, position):
+        self.seeks.append(position)
+        return position * 10
+
+
+class FileServer:
+    """Serves test/media/4s.mp3, bounding reads to max_read bytes"""
+
+    def __init__(self, max_read=None):
+        self.data = Path('test/media/4s.mp3').read_bytes()
+        self.max_read = max_read
+        self.offsets = []
+
+    def ice_invocationTimeout(self, timeout):
+        return self
+
+    def read_chunksAsync(self, render_id, offset, count, chunk_size):
+        self.offsets.append(offset)
+        end = offset + min(count * chunk_size, self.max_read or count * chunk_size)
+        future = Ice.Future()
+        future.set_result([self.data[i:min(i + chunk_size, end)]
+                           for i in range(offset, min(end, len(self.data)), chunk_size)])
+        return future
+
+
+class ReadsInFlightTests(TestCase):
+    def read_all(self, server):
+        sizer = ChunkSizer(4096, 16000, max_depth=3)
+        sizer.depth = 3  # no byte rate, so it stays
+        reader = ChunkReader(server, Ice.Identity(name='render'), '4s.mp3', 1,
+                             ThroughputMeter(), sizer=sizer)
+        data = b''
+        while chunk := reader(4096):
+            data += chunk
+        return data
+
+    def test_reads_sent_ahead_at_consecutive_offsets(self):
+        server = FileServer()
+
+        self.assertEqual(self.read_all(server), server.data)
+        self.assertEqual(server.offsets[:3], [0, 4096, 8192])
+
+    def test_bounded_reads_resend_reads_ahead(self):
+        server = FileServer(max_read=1000)
+
+        self.assertEqual(self.read_all(server), server.data)
+
+
+class ChunkReaderSwitchTests(TestCase):
+    def reader(self, server, bitrate, rate):
+        return ChunkReader(server, Ice.Identity(name='render'), '4s.mp3', 1,
+                           FixedMeter(rate), variants=[32, 64, 128], bitrate=bitrate)
+
+    def test_steps_down_when_bitrate_not_sustained(self):
+        server = VariantServer({32, 64, 128})
+        sut = self.reader(server, 128, 64 * 125 * 1.5)
+
+        sut(1000)
+
+        self.assertEqual(server.switches, [(64, 128, 1000)])
+        self.assertEqual((sut.bitrate, sut.offset), (64, 2000))
+
+    def test_keeps_bitrate_sustained_without_headroom(self):
+        server = VariantServer({32, 64, 128})
+        sut = self.reader(server, 128, 128 * 125 * 1.2)
+
+        sut(1000)
+
+        self.assertEqual(server.switches, [])
+
+    def test_switches_back_up_when_throughput_recovers(self):
+        server = VariantServer({32, 64, 128})
+        sut = self.reader(server, 32, 128 * 125 * 2)
+
+        sut(1000)
+
+        self.assertEqual(server.switches, [(128, 32, 1000)])
+        self.assertEqual(sut.bitrate, 128)
+
+    def test_retries_variant_being_transcoded(self):
+        server = VariantServer({128})
+        sut = self.reader(server, 128, 1000)
+
+        sut(1000)
+        sut.pending.clear()
+        sut(1000)
+        self.assertEqual(len(server.switches), 1)
+
+        sut.switch_after = 0
+        sut(1000)
+        self.assertEqual(len(server.switches), 2)
+        self.assertEqual(sut.bitrate, 128)
+
+    def test_seek_locates_again_after_switch(self):
+        server = VariantServer({32, 128})
+        sut = self.reader(server, 128, 1000)
+        reposition = sut.locate(2000)
+
+        sut(1000)
+        reposition()
+        sut(1000)
+
+        self.assertEqual(sut.bitrate, 32)
+        self.assertEqual(server.seeks, [2000, 2000])
+        self.assertEqual(sut.offset, 20000 + 1000)
+
+
+class SlowServerPlayer:
+    EVENT_TIMEOUT_SECS = 0.1
+
+
+class ReadBufferTests(TestCase):
+    def setUp(self):
+        self.sut = MediaRenderI(SlowServerPlayer())
+
+    def test_stall_waits_for_data(self):
+        def slow_fetch(chunk_size):
+            sleep(0.3)
+            return b'x' * chunk_size
+
+        self.sut.buffer = JitterBuffer(slow_fetch, 0, 8192, 4096).start()
+        self.addCleanup(self.sut.buffer.stop)
+
+        self.assertEqual(self.sut.read_buffer()(4096), b'x' * 4096)
+
+    def test_watermarks_in_seconds_follow_bitrate(self):
+        self.assertEqual(self.sut.buffer_watermarks(320), (40000, 160000))
+        self.assertEqual(self.sut.buffer_watermarks(0), (16000, 64000))
+
+
+class ChooseBitrateTests(TestCase):
+    def test_original_without_measurement(self):
+        self.assertEqual(choose_bitrate([32, 64, 128], None), 128)
+
+    def test_highest_affordable(self):
+        self.assertEqual(choose_bitrate([32, 64, 128], 64 * 125 * 1.5), 64)
+
+    def test_lowest_when_none_affordable(self):
+        self.assertEqual(choose_bitrate([32, 64, 128], 1000), 32)
@@ -1,17 +1,34 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from time import monotonic, sleep, time
+from unittest import TestCase, mock
+
 import Ice
 
-from media_server import Spotifice, main
+import mp3info
+import tracing
+from library_index import LibraryIndex
+from media_server import MediaServerI, Spotifice, main, state_dir
+from render_group import NetClock
+from stream_token import TokenSigner
 
 from .icetest import IceTestCase
 
 
 class TestServer(IceTestCase):
     server_port = 10000
+    extra_props = {}
 
     def setUp(self):
         server_props = {
             'MediaServerAdapter.Endpoints': f'tcp -p {self.server_port}',
-            'MediaServer.Content': 'test/media'
+            'MediaServer.Content': 'test/media',
+            'MediaServer.IndexFile': ':memory:',
+            **self.extra_props
         }
         server_endpoint = f'mediaServer1:default -p {self.server_port} -t 500'
         self.create_server(main, server_props)
@@ -28,6 +45,9 @@ class MusicLibraryTests(TestServer):
         track = self.sut.get_track_info('1s.mp3')
         self.assertEqual(track.id, '1s.mp3')
         self.assertEqual(track.title, '1s')
+        self.assertEqual(track.bitrate, 65)
+        self.assertAlmostEqual(track.duration, 1000, delta=100)
+        self.assertTrue(track.version)
 
     def test_get_track_info_wrong_track(self):
         with self.assertRaises(Spotifice.TrackError) as cm:
@@ -36,6 +56,217 @@ class MusicLibraryTests(TestServer):
         self.assertEqual(cm.exception.item, 'bad-track-id')
         self.assertEqual(cm.exception.reason, 'Track not found')
 
+    def test_list_tracks_pages(self):
+        first = self.sut.list_tracks(Spotifice.SortKey.Title, '', 3)
+        last = self.sut.list_tracks(Spotifice.SortKey.Title, first.next_cursor, 3)
+
+        self.assertEqual([t.id for t in first.tracks], ['1s.mp3', '2s.mp3', '4s.mp3'])
+        self.assertEqual([t.id for t in last.tracks], ['bad-file.mp3'])
+        self.assertEqual(last.next_cursor, '')
+
+    def test_search_tracks(self):
+        page = self.sut.search_tracks('file', False, '', 10)
+
+        self.assertEqual([t.id for t in page.tracks], ['bad-file.mp3'])
+
+    def test_list_tracks_bad_cursor(self):
+        with self.assertRaises(Spotifice.CursorError) as cm:
+            self.sut.list_tracks(Spotifice.SortKey.Title, 'bad-cursor', 3)
+
+        self.assertEqual(cm.exception.item, 'bad-cursor')
+
+
+class CatalogChangesTests(TestServer):
+    def setUp(self):
+        self.media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        shutil.copy('test/media/1s.mp3', self.media_dir)
+        self.extra_props = {'MediaServer.Content': str(self.media_dir),
+                            'MediaServer.WatchInterval': '1'}
+        super().setUp()
+
+    def wait_version(self, version):
+        for _ in range(20):
+            if self.sut.get_catalog_version() >= version:
+                return
+            sleep(0.1)
+
+        self.fail(f'Catalog version {version} not reached')
+
+    def test_added_file_is_listed(self):
+        version = self.sut.get_catalog_version()
+        shutil.copy('test/media/2s.mp3', self.media_dir)
+        self.wait_version(version + 1)
+
+        changes = self.sut.get_changes(version)
+
+        self.assertEqual([(c.kind, c.track_id) for c in changes],
+                         [(Spotifice.ChangeKind.Added, '2s.mp3')])
+        self.assertEqual(changes[0].info.title, '2s')
+        self.assertEqual(len(self.sut.get_all_tracks()), 2)
+
+    def test_removed_file_is_unlisted(self):
+        version = self.sut.get_catalog_version()
+        (self.media_dir / '1s.mp3').unlink()
+        self.wait_version(version + 1)
+
+        changes = self.sut.get_changes(version)
+
+        self.assertEqual([(c.kind, c.info) for c in changes],
+                         [(Spotifice.ChangeKind.Removed, None)])
+        with self.assertRaises(Spotifice.TrackError):
+            self.sut.get_track_info('1s.mp3')
+
+    def test_rewritten_file_gets_new_version(self):
+        old = self.sut.get_track_info('1s.mp3').version
+        version = self.sut.get_catalog_version()
+        shutil.copy('test/media/2s.mp3', self.media_dir / '1s.mp3')
+        self.wait_version(version + 1)
+
+        self.assertNotEqual(self.sut.get_track_info('1s.mp3').version, old)
+
+    def test_changes_from_future_version(self):
+        with self.assertRaises(Spotifice.VersionError):
+            self.sut.get_changes(self.sut.get_catalog_version() + 1)
+
+
+class ApplyChangesTests(TestCase):
+    def test_catalog_readable_while_probing(self):
+        media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, media_dir)
+        shutil.copy('test/media/1s.mp3', media_dir)
+        sut = MediaServerI(media_dir)
+        self.addCleanup(sut.shutdown)
+        probing, release = threading.Event(), threading.Event()
+
+        def slow_probe(filepath):
+            probing.set()
+            release.wait(5)
+            return MediaServerI.track_info(filepath)
+
+        sut.track_info = slow_probe
+        shutil.copy('test/media/2s.mp3', media_dir)
+        rescan = threading.Thread(target=sut.apply_media_changes, args=(['2s.mp3'], []))
+        rescan.start()
+        probing.wait(1)
+
+        reader = threading.Thread(target=sut.get_all_tracks)
+        reader.start()
+        reader.join(1)
+        self.assertFalse(reader.is_alive())
+
+        release.set()
+        rescan.join()
+        self.assertEqual(len(sut.get_all_tracks()), 2)
+
+
+class SeekTableCacheTests(TestCase):
+    def setUp(self):
+        self.media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        for name in ['1s.mp3', '2s.mp3']:
+            shutil.copy(f'test/media/{name}', self.media_dir)
+        self.sut = MediaServerI(self.media_dir)
+        self.addCleanup(self.sut.shutdown)
+
+    def seek(self, track_id):
+        render_id = Ice.Identity(name=f'render-{track_id}')
+        self.sut.open_stream(track_id, render_id)
+        self.sut.seek_stream(render_id, 500)
+
+    def test_least_recently_used_dropped(self):
+        self.sut.SEEK_TABLE_CACHE_SIZE = 1
+
+        self.seek('1s.mp3')
+        self.seek('2s.mp3')
+
+        self.assertEqual([key[0] for key in self.sut.seek_tables],
+                         [str(self.media_dir / '2s.mp3')])
+
+    def test_changed_files_dropped(self):
+        self.seek('1s.mp3')
+        self.seek('2s.mp3')
+
+        self.sut.apply_media_changes(['2s.mp3'], ['1s.mp3'])
+
+        self.assertEqual(len(self.sut.seek_tables), 0)
+
+
+class CopiedVariants:
+    """Variants that are copies of the source, ready for the bitrates in ready"""
+
+    def __init__(self, cache_dir, bitrates):
+        self.cache_dir = Path(cache_dir)
+        self.bitrates = bitrates
+        self.ready = set(bitrates)
+
+    def get(self, filepath, bitrate):
+        if bitrate not in self.ready:
+            return None
+
+        path = self.cache_dir / f'{bitrate}k-{filepath.name}'
+        if not path.exists():
+            shutil.copy(filepath, path)
+        return path
+
+    def shutdown(self):
+        pass
+
+
+class VariantTests(TestCase):
+    def setUp(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.variants = CopiedVariants(cache_dir, [32, 48])
+        self.sut = MediaServerI(
+            'test/media', index=LibraryIndex(':memory:'), variants=self.variants)
+        self.addCleanup(self.sut.shutdown)
+        self.render_id = Ice.Identity(name='fake-render-id')
+        self.table = mp3info.seek_table('test/media/4s.mp3')
+
+    def streamed_path(self):
+        return self.sut.active_streams['fake-render-id'].filepath
+
+    def test_get_variants_below_original(self):
+        self.assertEqual(self.sut.get_variants('4s.mp3'), [32, 48, 64])
+
+    def test_open_stream_variant_at_original_bitrate_streams_original(self):
+        for bitrate in (64, 128):
+            self.assertEqual(
+                self.sut.open_stream_variant('4s.mp3', self.render_id, bitrate), 64)
+            self.assertEqual(self.streamed_path(), Path('test/media/4s.mp3'))
+
+    def test_open_stream_variant_picks_best_below(self):
+        self.assertEqual(self.sut.open_stream_variant('4s.mp3', self.render_id, 40), 32)
+        self.assertEqual(self.streamed_path().name, '32k-4s.mp3')
+
+    def test_switch_goes_on_at_the_same_time(self):
+        offset = self.table.interpolate(2000) + 100
+
+        point = self.sut.open_stream_variant_at('4s.mp3', self.render_id, 32, 64, offset)
+
+        self.assertEqual(point.bitrate, 32)
+        self.assertAlmostEqual(
+            self.table.position(point.offset), self.table.position(offset), delta=30)
+        data = self.streamed_path().read_bytes()
+        self.assertIsNotNone(
+            mp3info.parse_frame_header(data[point.offset:point.offset + 4]))
+        self.assertEqual(self.sut.active_streams['fake-render-id'].position, point.offset)
+
+    def test_switch_up_to_original(self):
+        point = self.sut.open_stream_variant_at('4s.mp3', self.render_id, 128, 32, 5000)
+
+        self.assertEqual(point.bitrate, 64)
+        self.assertEqual(self.streamed_path(), Path('test/media/4s.mp3'))
+
+    def test_switch_stays_while_transcoding(self):
+        self.variants.ready = {48}
+
+        point = self.sut.open_stream_variant_at('4s.mp3', self.render_id, 32, 48, 5000)
+
+        self.assertEqual((point.bitrate, point.offset), (48, 5000))
+        self.assertEqual(self.streamed_path().name, '48k-4s.mp3')
+
 
 class StreamManagerTests(TestServer):
     def test_open_stream_wrong_track(self):
@@ -73,6 +304,104 @@ class StreamManagerTests(TestServer):
             expected = f.read(len(chunk))
             self.assertEqual(chunk, expected)
 
+    def test_get_audio_chunk_empty_file(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('bad-file.mp3', render_id)
+
+        self.assertEqual(self.sut.get_audio_chunk(render_id, 1024), b'')
+
+    def test_get_variants_without_transcoder(self):
+        self.assertEqual(self.sut.get_variants('1s.mp3'), [65])
+
+    def test_open_stream_variant_falls_back_to_original(self):
+        render_id = Ice.Identity(name='fake-render-id')
+
+        bitrate = self.sut.open_stream_variant('1s.mp3', render_id, 32)
+
+        self.assertEqual(bitrate, 65)
+        with open('test/media/1s.mp3', 'rb') as f:
+            self.assertEqual(self.sut.get_audio_chunk(render_id, 1024), f.read(1024))
+
+    def test_read_chunks(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        chunks = self.sut.read_chunks(render_id, 100, 3, 1024)
+
+        self.assertEqual(len(chunks), 3)
+        with open('test/media/1s.mp3', 'rb') as f:
+            f.seek(100)
+            self.assertEqual(b''.join(chunks), f.read(3 * 1024))
+
+    def test_read_chunks_is_idempotent(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        first = self.sut.read_chunks(render_id, 0, 2, 1024)
+        retry = self.sut.read_chunks(render_id, 0, 2, 1024)
+
+        self.assertEqual(first, retry)
+
+    def test_read_chunks_past_end(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        chunks = self.sut.read_chunks(render_id, 8000, 4, 1024)
+
+        self.assertEqual([len(c) for c in chunks], [585])
+        self.assertEqual(self.sut.read_chunks(render_id, 8585, 4, 1024), [])
+
+    def test_read_chunks_invalid_offset(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            self.sut.read_chunks(render_id, -1, 1, 1024)
+
+        self.assertEqual(cm.exception.reason, 'Invalid read parameters')
+
+    def test_seek_stream(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('4s.mp3', render_id)
+
+        offset = self.sut.seek_stream(render_id, 2000)
+        chunk = self.sut.get_audio_chunk(render_id, 1024)
+
+        self.assertGreater(offset, 0)
+        with open('test/media/4s.mp3', 'rb') as f:
+            f.seek(offset)
+            self.assertEqual(chunk, f.read(1024))
+
+    def test_seek_stream_back_to_start(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('4s.mp3', render_id)
+        self.sut.seek_stream(render_id, 3000)
+
+        self.assertEqual(self.sut.seek_stream(render_id, 0), 44)
+
+    def test_seek_stream_invalid_position(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('4s.mp3', render_id)
+
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            self.sut.seek_stream(render_id, -1)
+
+        self.assertEqual(cm.exception.reason, 'Invalid seek position')
+
+    def test_seek_stream_unreadable_file(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('bad-file.mp3', render_id)
+
+        with self.assertRaises(Spotifice.IOError):
+            self.sut.seek_stream(render_id, 0)
+
+    def test_get_active_streams(self):
+        self.sut.open_stream('1s.mp3', Ice.Identity(name='render-1'))
+        self.sut.open_stream('2s.mp3', Ice.Identity(name='render-2'))
+        self.sut.close_stream(Ice.Identity(name='render-1'))
+
+        self.assertEqual(self.sut.get_active_streams(), 1)
+
     def test_get_audio_chunk_not_open_stream(self):
         render_id = Ice.Identity(name='missing-render-id')
 
@@ -81,3 +410,460 @@ class StreamManagerTests(TestServer):
 
         self.assertEqual(cm.exception.item, 'missing-render-id')
         self.assertEqual(cm.exception.reason, 'No open stream for render')
+
+
+class AsyncStreamManagerTests(StreamManagerTests):
+    extra_props = {'MediaServer.Dispatch': 'async'}
+
+
+class ChunkBoundsTests(TestServer):
+    extra_props = {'MediaServer.MinChunkSize': '2048',
+                   'MediaServer.MaxChunkSize': '4096'}
+
+    def test_small_chunks_raised_to_min(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        chunks = self.sut.read_chunks(render_id, 0, 2, 100)
+
+        self.assertEqual([len(c) for c in chunks], [2048, 2048])
+
+    def test_large_chunks_cut_to_max(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        self.assertEqual(len(self.sut.get_audio_chunk(render_id, 65536)), 4096)
+
+
+class PacingTests(TestServer):
+    # 1s.mp3 is 65 kbps: paced at 4 x 8125 bytes/s, with no burst allowance
+    extra_props = {'MediaServer.Pacing.Rate': '4', 'MediaServer.Pacing.Burst': '0'}
+
+    def test_reads_paced(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        start = monotonic()
+        chunks = self.sut.read_chunks(render_id, 0, 8, 1024)
+
+        self.assertEqual(len(chunks), 8)
+        self.assertGreater(monotonic() - start, 0.2)
+
+    def test_streams_paced_apart(self):
+        renders = [Ice.Identity(name=f'render-{i}') for i in range(2)]
+        for render_id in renders:
+            self.sut.open_stream('1s.mp3', render_id)
+        self.sut.read_chunks(renders[0], 0, 8, 1024)
+
+        start = monotonic()
+        self.sut.read_chunks(renders[1], 0, 1, 1024)
+
+        self.assertLess(monotonic() - start, 0.2)
+
+
+class AsyncPacingTests(PacingTests):
+    extra_props = {**PacingTests.extra_props, 'MediaServer.Dispatch': 'async'}
+
+
+class StreamLeaseTests(TestServer):
+    extra_props = {'MediaServer.StreamLease': '1'}
+
+    def test_idle_stream_is_reaped(self):
+        render_id = Ice.Identity(name='crashed-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+
+        sleep(2)
+
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            self.sut.get_audio_chunk(render_id, 1024)
+
+        self.assertEqual(cm.exception.reason, 'No open stream for render')
+
+
+class SinkI(Spotifice.AudioSink):
+    def __init__(self):
+        self.chunks = {}
+        self.end_offset = None
+        self.changed_c = threading.Condition()
+
+    def push_chunk(self, offset, chunk, current=None):
+        with self.changed_c:
+            self.chunks[offset] = chunk
+            self.changed_c.notify_all()
+
+    def end_of_stream(self, offset, current=None):
+        with self.changed_c:
+            self.end_offset = offset
+            self.changed_c.notify_all()
+
+    def wait_for(self, predicate, timeout=2):
+        with self.changed_c:
+            return self.changed_c.wait_for(predicate, timeout)
+
+
+class PushStreamTests(TestServer):
+    def setUp(self):
+        super().setUp()
+        adapter = self.client_ic.createObjectAdapterWithEndpoints(
+            'SinkAdapter', 'tcp -h 127.0.0.1')
+        adapter.activate()
+        self.sink = SinkI()
+        self.sink_prx = Spotifice.AudioSinkPrx.uncheckedCast(
+            adapter.addWithUUID(self.sink))
+        self.render_id = Ice.Identity(name='push-render-id')
+
+    def test_push_respects_window(self):
+        self.sut.open_stream('1s.mp3', self.render_id)
+        self.sut.start_push(self.render_id, self.sink_prx, 1024, 2)
+
+        self.assertTrue(self.sink.wait_for(lambda: len(self.sink.chunks) == 2))
+        sleep(0.2)
+        self.assertEqual(len(self.sink.chunks), 2)
+
+        self.sut.grant_credits(self.render_id, 100)
+        self.assertTrue(self.sink.wait_for(lambda: self.sink.end_offset is not None))
+
+        data = b''.join(self.sink.chunks[k] for k in sorted(self.sink.chunks))
+        with open('test/media/1s.mp3', 'rb') as f:
+            self.assertEqual(data, f.read())
+        self.assertEqual(self.sink.end_offset, len(data))
+
+    def test_push_not_open_stream(self):
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            self.sut.start_push(self.render_id, self.sink_prx, 1024, 2)
+
+        self.assertEqual(cm.exception.reason, 'No open stream for render')
+
+    def test_push_counts_as_one_active_stream(self):
+        self.sut.open_stream('1s.mp3', self.render_id)
+        self.sut.start_push(self.render_id, self.sink_prx, 1024, 1)
+
+        self.assertEqual(self.sut.get_active_streams(), 1)
+
+    def test_grant_credits_oneway(self):
+        self.sut.open_stream('1s.mp3', self.render_id)
+        self.sut.start_push(self.render_id, self.sink_prx, 1024, 1)
+        self.assertTrue(self.sink.wait_for(lambda: len(self.sink.chunks) == 1))
+
+        self.sut.ice_oneway().grant_credits(self.render_id, 1)
+
+        self.assertTrue(self.sink.wait_for(lambda: len(self.sink.chunks) == 2))
+
+
+class MemberI(Spotifice.MediaRender):
+    """Group member handing out a SinkI; enough of a render for the group"""
+
+    def __init__(self, sink_prx):
+        self.sink_prx = sink_prx
+        self.clock = None
+        self.stopped = 0
+
+    def join_group(self, server, track_id, current=None):
+        return self.sink_prx
+
+    def start_group(self, clock, current=None):
+        self.clock = clock
+
+    def stop(self, current=None):
+        self.stopped += 1
+
+
+class GroupTests(TestServer):
+    extra_props = {'MediaServer.GroupClock.Port': '-1'}
+
+    def setUp(self):
+        super().setUp()
+        self.adapter = self.client_ic.createObjectAdapterWithEndpoints(
+            'MemberAdapter', 'tcp -h 127.0.0.1')
+        self.adapter.activate()
+
+    def add_member(self, group, name):
+        sink = SinkI()
+        sink_prx = Spotifice.AudioSinkPrx.uncheckedCast(self.adapter.addWithUUID(sink))
+        member = MemberI(sink_prx)
+        group.add_member(Spotifice.MediaRenderPrx.uncheckedCast(
+            self.adapter.add(member, Ice.Identity(name=name))))
+        return member, sink
+
+    def test_create_group_is_idempotent(self):
+        group = self.sut.create_group('living-room')
+
+        self.assertEqual(self.sut.create_group('living-room'), group)
+        self.assertEqual(group.get_members(), [])
+
+    def test_create_group_bad_name(self):
+        with self.assertRaises(Spotifice.BadIdentity):
+            self.sut.create_group('')
+
+    def test_remove_group(self):
+        group = self.sut.create_group('living-room')
+        self.sut.remove_group('living-room')
+
+        with self.assertRaises(Ice.ObjectNotExistException):
+            group.get_members()
+
+    def test_play_reads_once_for_every_member(self):
+        group = self.sut.create_group('living-room')
+        members = [self.add_member(group, f'render-{i}') for i in range(2)]
+
+        group.play('1s.mp3')
+
+        with open('test/media/1s.mp3', 'rb') as f:
+            expected = f.read()
+        for member, sink in members:
+            self.assertTrue(sink.wait_for(lambda: sink.end_offset is not None))
+            data = b''.join(sink.chunks[k] for k in sorted(sink.chunks))
+            self.assertEqual(data, expected)
+            self.assertIsNotNone(member.clock)
+
+        stats = Spotifice.StatsPrx.checkedCast(self.sut, 'stats')
+        served = next(family for family in stats.get_metrics()
+                      if family.name == 'spotifice_served_bytes_total')
+        self.assertEqual(served.samples[0].value, len(expected))
+
+    def test_play_without_members(self):
+        group = self.sut.create_group('living-room')
+
+        with self.assertRaises(Spotifice.PlayerError):
+            group.play('1s.mp3')
+
+    def test_stop_stops_members(self):
+        group = self.sut.create_group('living-room')
+        member, sink = self.add_member(group, 'render-1')
+        group.play('1s.mp3')
+
+        group.stop()
+
+        self.assertEqual(member.stopped, 1)
+
+
+class NetClockTests(TestCase):
+    @mock.patch('render_group.load_gst', return_value=None)
+    def test_started_by_first_group_only(self, load_gst):
+        clock = NetClock(0)
+        self.assertFalse(load_gst.called)
+
+        clock.start()
+        clock.start()
+
+        self.assertEqual(load_gst.call_count, 1)
+
+    @mock.patch('render_group.load_gst')
+    def test_disabled_never_starts(self, load_gst):
+        NetClock(None).start()
+
+        self.assertFalse(load_gst.called)
+
+
+class StreamTokenTests(TestServer):
+    extra_props = {'MediaServer.TokenSecret': 'shared-secret'}
+
+    def read_all(self, server, token):
+        data = b''
+        while (result := server.read_token(token, 2, 4096)).chunks:
+            data += b''.join(result.chunks)
+            token = result.token
+        return data
+
+    def start_replica(self, secret):
+        server_props = {
+            'MediaServerAdapter.Endpoints': 'tcp -p 10002',
+            'MediaServer.Content': 'test/media',
+            'MediaServer.IndexFile': ':memory:',
+            'MediaServer.TokenSecret': secret}
+        self.create_server(main, server_props)
+        return self.create_proxy('mediaServer1:default -p 10002 -t 500',
+                                 Spotifice.MediaServerPrx)
+
+    def test_read_track(self):
+        token = self.sut.open_stream_token('4s.mp3', 0, 0)
+
+        with open('test/media/4s.mp3', 'rb') as f:
+            self.assertEqual(self.read_all(self.sut, token), f.read())
+
+        self.assertEqual(self.sut.get_active_streams(), 0)
+
+    def test_token_stream_active_until_track_end(self):
+        token = self.sut.open_stream_token('4s.mp3', 0, 0)
+        token = self.sut.read_token(token, 1, 1024).token
+        self.sut.read_token(token, 1, 1024)
+
+        self.assertEqual(self.sut.get_active_streams(), 1)
+
+    def test_read_token_is_idempotent(self):
+        token = self.sut.open_stream_token('4s.mp3', 0, 0)
+
+        first = self.sut.read_token(token, 1, 1024)
+        second = self.sut.read_token(token, 1, 1024)
+
+        self.assertEqual(first.chunks, second.chunks)
+        signer = TokenSigner(b'shared-secret')
+        self.assertEqual(signer.decode(first.token).offset,
+                         signer.decode(second.token).offset)
+
+    def test_open_at_position(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('4s.mp3', render_id)
+        offset = self.sut.seek_stream(render_id, 2000)
+
+        token = self.sut.open_stream_token('4s.mp3', 0, 2000)
+
+        with open('test/media/4s.mp3', 'rb') as f:
+            f.seek(offset)
+            self.assertEqual(self.read_all(self.sut, token), f.read())
+
+    def test_replica_continues_stream(self):
+        replica = self.start_replica('shared-secret')
+        token = self.sut.open_stream_token('2s.mp3', 0, 0)
+        first = self.sut.read_token(token, 1, 4096)
+
+        rest = self.read_all(replica, first.token)
+
+        with open('test/media/2s.mp3', 'rb') as f:
+            self.assertEqual(first.chunks[0] + rest, f.read())
+
+    def test_replica_with_other_secret(self):
+        replica = self.start_replica('other-secret')
+        token = self.sut.open_stream_token('2s.mp3', 0, 0)
+
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            replica.read_token(token, 1, 4096)
+
+        self.assertEqual(cm.exception.reason, 'Invalid token signature')
+
+    def test_forged_token(self):
+        token = self.sut.open_stream_token('2s.mp3', 0, 0)
+        forged = ('B' if token[0] == 'A' else 'A') + token[1:]
+
+        with self.assertRaises(Spotifice.StreamError):
+            self.sut.read_token(forged, 1, 4096)
+
+    def test_open_token_wrong_track(self):
+        with self.assertRaises(Spotifice.TrackError):
+            self.sut.open_stream_token('bad-track-id', 0, 0)
+
+
+class AsyncStreamTokenTests(StreamTokenTests):
+    extra_props = {**StreamTokenTests.extra_props, 'MediaServer.Dispatch': 'async'}
+
+
+class StaleTokenTests(TestCase):
+    def setUp(self):
+        self.media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        shutil.copy('test/media/2s.mp3', self.media_dir)
+        self.sut = MediaServerI(self.media_dir, token_lifetime=60)
+        self.addCleanup(self.sut.shutdown)
+
+    def test_token_rejected_once_file_is_rewritten(self):
+        token = self.sut.open_stream_token('2s.mp3', 0, 0)
+        token = self.sut.read_token(token, 1, 1024).token
+        path = self.media_dir / '2s.mp3'
+        stat = path.stat()
+        path.write_bytes(bytes(reversed(path.read_bytes())))  # same size
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        with self.assertRaises(Spotifice.StreamError) as cm:
+            self.sut.read_token(token, 1, 1024)
+
+        self.assertEqual(cm.exception.reason, 'Track changed')
+
+    def test_token_expires(self):
+        token = self.sut.open_stream_token('2s.mp3', 0, 0)
+        token = self.sut.read_token(token, 1, 1024).token
+
+        with mock.patch('media_server.time', return_value=time() + 61):
+            with self.assertRaises(Spotifice.StreamError) as cm:
+                self.sut.read_token(token, 1, 1024)
+
+        self.assertEqual(cm.exception.reason, 'Token expired')
+
+
+class TracingTests(TestServer):
+    def setUp(self):
+        super().setUp()
+        self.path = Path(tempfile.mkdtemp()) / 'spans.jsonl'
+        self.addCleanup(shutil.rmtree, self.path.parent)
+        self.addCleanup(setattr, tracing, 'span_log', tracing.span_log)
+        tracing.span_log = tracing.SpanLog(self.path)
+        self.addCleanup(tracing.span_log.close)
+
+    def test_traced_requests_record_spans(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        traced = self.sut.ice_context(tracing.trace_context('trace-1'))
+
+        traced.open_stream('1s.mp3', render_id)
+        self.sut.read_chunks(render_id, 0, 1, 1024)
+
+        spans = [json.loads(line) for line in self.path.read_text().splitlines()]
+        self.assertEqual([(s['trace'], s['service'], s['span']) for s in spans],
+                         [('trace-1', 'server', 'open_stream')])
+
+
+class StateDirTests(TestCase):
+    def test_default_is_outside_media_dir(self):
+        with mock.patch.dict('os.environ', {'XDG_STATE_HOME': '/var/lib/state'}):
+            state = state_dir(Ice.createProperties(), 'test/media')
+
+        self.assertEqual(state.parent, Path('/var/lib/state/spotifice'))
+        self.assertTrue(state.name.startswith('media-'))
+
+    def test_media_dirs_get_their_own(self):
+        properties = Ice.createProperties()
+
+        self.assertNotEqual(state_dir(properties, 'test/media'),
+                            state_dir(properties, 'media'))
+
+    def test_property(self):
+        properties = Ice.createProperties()
+        properties.setProperty('MediaServer.StateDir', '/srv/spotifice')
+
+        self.assertEqual(state_dir(properties, 'test/media'), Path('/srv/spotifice'))
+
+
+class StatsTests(TestServer):
+    def setUp(self):
+        super().setUp()
+        self.stats = Spotifice.StatsPrx.checkedCast(self.sut, 'stats')
+
+    def metrics(self):
+        return {family.name: family for family in self.stats.get_metrics()}
+
+    def test_stats_facet(self):
+        self.assertIsNotNone(self.stats)
+        self.assertEqual(self.metrics()['spotifice_catalog_tracks'].samples[0].value, 4)
+
+    def test_stream_bytes(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+        self.sut.get_audio_chunk(render_id, 1024)
+        self.sut.read_chunks(render_id, 1024, 2, 1024)
+
+        metrics = self.metrics()
+
+        self.assertEqual(metrics['spotifice_open_streams'].samples[0].value, 1)
+        stream_bytes = metrics['spotifice_stream_bytes_total'].samples[0]
+        self.assertEqual(stream_bytes.labels, {'render': 'fake-render-id'})
+        self.assertEqual(stream_bytes.value, 3 * 1024)
+
+    def test_read_latency(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+        self.sut.get_audio_chunk(render_id, 1024)
+
+        samples = self.metrics()['spotifice_read_seconds'].samples
+        count = next(s for s in samples if s.name == 'spotifice_read_seconds_count')
+
+        self.assertEqual(count.labels, {'operation': 'get_audio_chunk'})
+        self.assertEqual(count.value, 1)
+
+    def test_closed_stream_drops_its_series(self):
+        render_id = Ice.Identity(name='fake-render-id')
+        self.sut.open_stream('1s.mp3', render_id)
+        self.sut.get_audio_chunk(render_id, 1024)
+        self.sut.close_stream(render_id)
+
+        metrics = self.metrics()
+
+        self.assertEqual(metrics['spotifice_stream_bytes_total'].samples, [])
+        self.assertEqual(metrics['spotifice_served_bytes_total'].samples[0].value, 1024)
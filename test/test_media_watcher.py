@@ -0,0 +1,54 @@
+import queue
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import media_watcher
+from media_watcher import MediaWatcher
+
+
+class MediaWatcherTests(TestCase):
+    def setUp(self):
+        self.media_dir = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.media_dir)
+        shutil.copy('test/media/1s.mp3', self.media_dir)
+        self.changes = queue.Queue()
+
+    def start_watcher(self):
+        watcher = MediaWatcher(
+            self.media_dir, lambda *change: self.changes.put(change), interval=0.1)
+        watcher.start()
+        self.addCleanup(watcher.join)
+        self.addCleanup(watcher.stop)
+
+    def assert_changes(self, updated, removed):
+        seen_updated, seen_removed = set(), set()
+        while seen_updated != set(updated) or seen_removed != set(removed):
+            changed, gone = self.changes.get(timeout=2)
+            seen_updated |= set(changed)
+            seen_removed |= set(gone)
+            seen_updated -= set(gone)
+
+    def exercise(self):
+        self.start_watcher()
+        shutil.copy('test/media/2s.mp3', self.media_dir)
+        (self.media_dir / 'notes.txt').write_text('not media')
+        self.assert_changes(['2s.mp3'], [])
+
+        (self.media_dir / '2s.mp3').rename(self.media_dir / 'two.mp3')
+        (self.media_dir / '1s.mp3').unlink()
+        self.assert_changes(['two.mp3'], ['1s.mp3', '2s.mp3'])
+
+    def test_inotify(self):
+        self.exercise()
+
+    def test_polling_fallback(self):
+        def unavailable(directory):
+            raise OSError("no inotify")
+
+        original = media_watcher.Inotify
+        media_watcher.Inotify = unavailable
+        self.addCleanup(setattr, media_watcher, 'Inotify', original)
+
+        self.exercise()
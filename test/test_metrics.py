@@ -0,0 +1,85 @@
+from unittest import TestCase
+
+from metrics import Histogram, Registry, format_text
+
+
+class RegistryTests(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def collect(self):
+        return {family.name: family for family in self.registry.collect()}
+
+    def test_counter(self):
+        counter = self.registry.counter('bytes_total', "Bytes")
+        counter.inc()
+        counter.inc(10)
+
+        self.assertEqual(self.collect()['bytes_total'].samples[0].value, 11)
+
+    def test_labelled_counter(self):
+        counter = self.registry.counter('bytes_total', "Bytes", ['stream'])
+        counter.labels('a').inc(5)
+        counter.labels('b').inc(7)
+        counter.remove('a')
+
+        samples = self.collect()['bytes_total'].samples
+        self.assertEqual([(s.labels, s.value) for s in samples], [({'stream': 'b'}, 7)])
+
+    def test_function_gauge(self):
+        items = [1, 2, 3]
+        self.registry.gauge('items', "Items", function=lambda: len(items))
+        items.append(4)
+
+        self.assertEqual(self.collect()['items'].samples[0].value, 4)
+
+    def test_duplicate_name(self):
+        self.registry.counter('bytes_total', "Bytes")
+
+        with self.assertRaises(AssertionError):
+            self.registry.gauge('bytes_total', "Bytes")
+
+
+class HistogramTests(TestCase):
+    def test_cumulative_buckets(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in [0.05, 0.5, 0.7, 3]:
+            histogram.observe(value)
+
+        samples = {(s.name, s.labels.get('le')): s.value
+                   for s in histogram.samples('latency', {})}
+
+        self.assertEqual(samples[('latency_bucket', '0.1')], 1)
+        self.assertEqual(samples[('latency_bucket', '1')], 3)
+        self.assertEqual(samples[('latency_bucket', '+Inf')], 4)
+        self.assertEqual(samples[('latency_count', None)], 4)
+        self.assertAlmostEqual(samples[('latency_sum', None)], 4.25)
+
+    def test_quantile(self):
+        histogram = Histogram(buckets=(0.1, 1.0))
+        for value in [0.05] * 50 + [0.5] * 49 + [3]:
+            histogram.observe(value)
+
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(0.99), 1.0)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+        self.assertIsNone(Histogram().quantile(0.5))
+
+    def test_timer(self):
+        histogram = Histogram()
+        with histogram.time():
+            pass
+
+        self.assertEqual(histogram.counts[0], 1)
+
+
+class FormatTextTests(TestCase):
+    def test_exposition(self):
+        registry = Registry()
+        registry.counter('bytes_total', "Bytes served", ['stream']).labels('a"b').inc(3)
+
+        text = format_text(registry.collect(), {'instance': 'server1'})
+
+        self.assertEqual(text, '# HELP bytes_total Bytes served\n'
+                               '# TYPE bytes_total counter\n'
+                               'bytes_total{instance="server1",stream="a\\"b"} 3\n')
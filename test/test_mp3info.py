@@ -0,0 +1,89 @@
+import struct
+from unittest import TestCase
+
+import mp3info
+
+
+class ProbeTests(TestCase):
+    def test_probe_vbr_header(self):
+        info = mp3info.probe('test/media/4s.mp3')
+
+        self.assertEqual(info.audio_start, 44)
+        self.assertEqual(info.sample_rate, 44100)
+        self.assertEqual(info.bitrate, 64)
+        self.assertAlmostEqual(info.duration, 4000, delta=100)
+
+    def test_probe_empty_file(self):
+        with self.assertRaises(ValueError):
+            mp3info.probe('test/media/bad-file.mp3')
+
+    def test_parse_frame_header(self):
+        header = mp3info.parse_frame_header(b'\xff\xfb\x90\x64')
+
+        self.assertEqual((header.bitrate, header.sample_rate), (128, 44100))
+        self.assertEqual(header.length, 417)
+
+    def test_parse_id3v2_text_frames(self):
+        frame = b'TIT2' + (6).to_bytes(4, 'big') + b'\0\0' + b'\x03Song\0'
+        tag = b'ID3\x04\0\0' + bytes([0, 0, 0, len(frame)]) + frame
+
+        tags, length = mp3info.parse_id3v2(tag)
+
+        self.assertEqual(tags, {'title': 'Song'})
+        self.assertEqual(length, len(tag))
+
+
+class SeekTableTests(TestCase):
+    def test_xing_toc(self):
+        table = mp3info.seek_table('test/media/4s.mp3')
+
+        self.assertEqual(len(table.offsets), 100)
+        self.assertEqual(table.offset(0), 44)
+        self.assertEqual(table.offsets, sorted(table.offsets))
+
+    def test_frame_scan(self):
+        data = open('test/media/4s.mp3', 'rb').read()
+
+        table = mp3info.scan_seek_table(data, 44, step=250)
+
+        self.assertAlmostEqual(len(table.offsets), 17, delta=1)
+        for offset in table.offsets:
+            self.assertIsNotNone(mp3info.parse_frame_header(data[offset:offset + 4]))
+
+    def test_offset_is_clamped(self):
+        table = mp3info.SeekTable(100, [10, 20, 30])
+
+        self.assertEqual(table.offset(-5), 10)
+        self.assertEqual(table.offset(150), 20)
+        self.assertEqual(table.offset(10 ** 6), 30)
+
+    def test_interpolate_between_entries(self):
+        table = mp3info.SeekTable(100, [10, 20, 30])
+
+        self.assertEqual(table.interpolate(150), 25)
+        self.assertEqual(table.interpolate(-5), 10)
+        self.assertEqual(table.interpolate(300), 40)
+
+    def test_position_inverts_interpolate(self):
+        table = mp3info.seek_table('test/media/4s.mp3')
+
+        for position in (0, 1234, 2500, 3900):
+            self.assertAlmostEqual(
+                table.position(table.interpolate(position)), position, delta=1)
+
+    def test_toc_close_to_frame_scan(self):
+        data = open('test/media/4s.mp3', 'rb').read()
+        toc = mp3info.seek_table('test/media/4s.mp3')
+        scan = mp3info.scan_seek_table(data, 44)
+
+        self.assertAlmostEqual(toc.offset(2000), scan.offset(2000), delta=1000)
+
+    def test_vbri_table(self):
+        frame = bytearray(mp3info.VBRI_OFFSET) + b'VBRI' + bytes(6) + \
+            struct.pack('>IIHHHH', 3000, 20, 3, 1, 2, 4) + \
+            b''.join(size.to_bytes(2, 'big') for size in (1000, 1000, 1000))
+
+        frames, nbytes, frames_per_entry, sizes = mp3info.parse_vbri(frame)
+
+        self.assertEqual((frames, nbytes, frames_per_entry), (20, 3000, 4))
+        self.assertEqual(sizes, [1000, 1000, 1000])
@@ -0,0 +1,73 @@
+from unittest import TestCase
+
+from stream_token import StreamToken, TokenSigner, TokenStreamGauge, version_digest
+
+
+class TokenSignerTests(TestCase):
+    def setUp(self):
+        self.signer = TokenSigner(b'secret')
+        self.token = StreamToken(
+            '4s.mp3', 64, version_digest('7f69-1'), 4096, 1_800_000_000)
+
+    def test_round_trip(self):
+        self.assertEqual(self.signer.decode(self.signer.encode(self.token)), self.token)
+
+    def test_compact(self):
+        self.assertLess(len(self.signer.encode(self.token)), 64)
+
+    def test_other_secret(self):
+        text = TokenSigner(b'other').encode(self.token)
+
+        with self.assertRaises(ValueError):
+            self.signer.decode(text)
+
+    def test_modified_offset(self):
+        forged = self.token._replace(offset=0)
+        text = self.signer.encode(self.token)
+        mac = text[-16:]
+        forged_text = TokenSigner(b'other').encode(forged)[:-16] + mac
+
+        with self.assertRaises(ValueError):
+            self.signer.decode(forged_text)
+
+    def test_truncated(self):
+        with self.assertRaises(ValueError):
+            self.signer.decode(self.signer.encode(self.token)[:8])
+
+
+class TokenStreamGaugeTests(TestCase):
+    def setUp(self):
+        self.now = 1000
+        self.sut = TokenStreamGauge(10, clock=lambda: self.now)
+
+    def test_reads_in_one_period_count_once(self):
+        self.sut.opened()
+        self.sut.read(1000)
+        self.sut.read(1005)
+
+        self.assertEqual(self.sut.count(), 1)
+
+    def test_stream_carried_into_next_period(self):
+        self.sut.opened()
+        self.now = 1012
+
+        self.assertEqual(self.sut.count(), 1)
+        self.sut.read(1000)
+        self.assertEqual(self.sut.count(), 1)
+
+    def test_idle_stream_ages_out(self):
+        self.sut.opened()
+        self.now = 1025
+
+        self.assertEqual(self.sut.count(), 0)
+
+    def test_ended_stream_is_not_counted(self):
+        self.sut.opened()
+        self.sut.opened()
+        self.now = 1012
+        self.sut.read(1000)
+
+        self.sut.ended(1012)
+        self.sut.ended(1000)
+
+        self.assertEqual(self.sut.count(), 0)
@@ -0,0 +1,83 @@
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import trace_report
+import tracing
+
+
+class FakeCurrent:
+    def __init__(self, ctx):
+        self.ctx = ctx
+
+
+class TracedServant:
+    @tracing.traced('server')
+    def operation(self, value, current=None):
+        return value
+
+
+class TracingTests(TestCase):
+    def setUp(self):
+        self.path = Path(tempfile.mkdtemp()) / 'spans.jsonl'
+        self.addCleanup(setattr, tracing, 'span_log', tracing.span_log)
+        tracing.span_log = tracing.SpanLog(self.path)
+        self.addCleanup(tracing.span_log.close)
+
+    def spans(self):
+        return [json.loads(line) for line in self.path.read_text().splitlines()]
+
+    def test_span_recorded(self):
+        with tracing.span('t1', 'render', 'play', track='1s.mp3'):
+            pass
+
+        [span] = self.spans()
+        self.assertEqual((span['trace'], span['service'], span['span'], span['track']),
+                         ('t1', 'render', 'play', '1s.mp3'))
+        self.assertGreaterEqual(span['duration'], 0)
+
+    def test_untraced_span_not_recorded(self):
+        with tracing.span(None, 'render', 'play'):
+            pass
+
+        self.assertEqual(self.spans(), [])
+
+    def test_traced_dispatch(self):
+        servant = TracedServant()
+        traced = FakeCurrent(tracing.trace_context('t1'))
+
+        self.assertEqual(servant.operation(1, traced), 1)
+        servant.operation(2, FakeCurrent({}))
+        servant.operation(3)
+
+        self.assertEqual([(s['trace'], s['span']) for s in self.spans()],
+                         [('t1', 'operation')])
+
+
+def span(service, name, start, duration):
+    return dict(trace='t1', service=service, span=name, start=start, duration=duration)
+
+
+class TraceReportTests(TestCase):
+    spans = [span('control', 'play', 100.0, 0.5),
+             span('render', 'play', 100.1, 0.3),
+             span('render', 'first_read', 100.3, 0.15),
+             span('server', 'read_chunks', 100.32, 0.05),
+             span('render', 'first_audio', 100.1, 0.35)]
+
+    def test_callee_time_counts_overlaps_once(self):
+        rows = {s['span'] + s['service']: callee
+                for _, _, callee, s in trace_report.breakdown(self.spans)}
+
+        self.assertAlmostEqual(rows['playcontrol'], 0.35)
+        self.assertAlmostEqual(rows['first_readrender'], 0.05)
+
+    def test_time_to_first_audio(self):
+        self.assertAlmostEqual(trace_report.time_to_first_audio(self.spans), 0.45)
+
+    def test_format_trace(self):
+        text = trace_report.format_trace('t1', self.spans)
+
+        self.assertTrue(text.startswith('Trace t1: first audio after 450.0 ms'))
+        self.assertIn('server.read_chunks', text)
@@ -0,0 +1,115 @@
+import os
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from slice_loader import Spotifice
+from track_cache import TrackCache
+
+
+def track(track_id, version='v1'):
+    return Spotifice.TrackInfo(id=track_id, title=track_id, filename=track_id + '.mp3',
+                               version=version)
+
+
+class TrackCacheTests(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.directory = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cache(self, sut, track, data):
+        writer = sut.writer(track)
+        writer.write(data)
+        writer.commit()
+
+    def test_whole_track_is_cached(self):
+        sut = TrackCache(self.directory, 1000)
+        self.assertIsNone(sut.get(track('a')))
+
+        self.cache(sut, track('a'), b'abc')
+
+        self.assertEqual(sut.get(track('a')).read_bytes(), b'abc')
+        self.assertEqual(sut.stats()['hits'], 1)
+        self.assertEqual(sut.stats()['misses'], 1)
+
+    def test_aborted_track_is_not_cached(self):
+        sut = TrackCache(self.directory, 1000)
+
+        writer = sut.writer(track('a'))
+        writer.write(b'abc')
+        writer.abort()
+
+        self.assertIsNone(sut.get(track('a')))
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_new_version_misses(self):
+        sut = TrackCache(self.directory, 1000)
+        self.cache(sut, track('a', 'v1'), b'abc')
+
+        self.assertIsNone(sut.get(track('a', 'v2')))
+
+    def test_tracks_without_version_are_not_cached(self):
+        sut = TrackCache(self.directory, 1000)
+        unversioned = Spotifice.TrackInfo(id='a', title='a', filename='a.mp3')
+
+        self.assertIsNone(sut.writer(unversioned))
+        self.assertIsNone(sut.get(unversioned))
+
+    def test_least_recently_used_is_evicted(self):
+        sut = TrackCache(self.directory, 250)
+        self.cache(sut, track('a'), b'a' * 100)
+        self.cache(sut, track('b'), b'b' * 100)
+        sut.get(track('a'))
+
+        self.cache(sut, track('c'), b'c' * 100)
+
+        self.assertIsNotNone(sut.get(track('a')))
+        self.assertIsNone(sut.get(track('b')))
+        self.assertEqual(sut.size, 200)
+        self.assertEqual(sut.stats()['evictions'], 1)
+
+    def test_track_over_budget_is_dropped(self):
+        sut = TrackCache(self.directory, 100)
+
+        writer = sut.writer(track('a'))
+        self.assertTrue(writer.write(b'a' * 60))
+        self.assertFalse(writer.write(b'a' * 60))
+
+        self.assertIsNone(sut.get(track('a')))
+        self.assertEqual(list(self.directory.iterdir()), [])
+
+    def test_entries_survive_restart(self):
+        sut = TrackCache(self.directory, 1000)
+        self.cache(sut, track('a'), b'abc')
+        leftover = sut.writer(track('b'))
+        leftover.write(b'partial')
+
+        sut = TrackCache(self.directory, 1000)
+
+        self.assertEqual(sut.get(track('a')).read_bytes(), b'abc')
+        self.assertEqual(sut.size, 3)
+        self.assertEqual(list(self.directory.glob('*.part')), [])
+
+    def test_restart_evicts_oldest_down_to_budget(self):
+        sut = TrackCache(self.directory, 1000)
+        self.cache(sut, track('a'), b'a' * 100)
+        self.cache(sut, track('b'), b'b' * 100)
+        path = sut.get(track('a'))
+        os.utime(path, ns=(0, 0))
+
+        sut = TrackCache(self.directory, 150)
+
+        self.assertIsNone(sut.get(track('a')))
+        self.assertIsNotNone(sut.get(track('b')))
+
+    def test_discard(self):
+        sut = TrackCache(self.directory, 1000)
+        self.cache(sut, track('a'), b'abc')
+
+        sut.discard(sut.get(track('a')).name)
+
+        self.assertIsNone(sut.get(track('a')))
+        self.assertEqual(sut.size, 0)
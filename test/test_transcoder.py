@@ -0,0 +1,108 @@
+import os
+import shutil
+import threading
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase, mock
+
+from transcoder import VariantCache
+
+MEDIA = Path(__file__).parent / 'media'
+
+
+class GatedCache(VariantCache):
+    """Transcodes by copying, once the test opens the gate"""
+
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir, [32])
+        self.gate = threading.Event()
+
+    def transcode(self, source, target, bitrate):
+        self.gate.wait(5)
+        target.write_bytes(source.read_bytes())
+
+
+class VariantCacheTests(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.sut = GatedCache(self.tmp.name)
+        self.source = MEDIA / '1s.mp3'
+
+    def tearDown(self):
+        self.sut.gate.set()
+        self.sut.executor.shutdown()
+        self.tmp.cleanup()
+
+    def test_miss_returns_while_transcoding(self):
+        self.assertIsNone(self.sut.get(self.source, 32))
+        self.assertIsNone(self.sut.get(self.source, 32))
+        self.assertEqual(len(self.sut.jobs), 1)
+
+    def test_later_request_finds_variant(self):
+        self.sut.get(self.source, 32)
+        job = self.sut.jobs[self.sut.variant_path(self.source, 32)]
+
+        self.sut.gate.set()
+        job.result(5)
+
+        self.assertEqual(self.sut.get(self.source, 32),
+                         self.sut.variant_path(self.source, 32))
+
+
+class FailingCache(VariantCache):
+    def __init__(self, cache_dir):
+        super().__init__(cache_dir, [32])
+        self.attempts = 0
+
+    def transcode(self, source, target, bitrate):
+        self.attempts += 1
+        raise RuntimeError("no decoder")
+
+
+class FailedTranscodeTests(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.sut = FailingCache(Path(self.tmp.name) / 'variants')
+        self.addCleanup(self.sut.executor.shutdown)
+        self.source = Path(self.tmp.name) / '1s.mp3'
+        shutil.copy(MEDIA / '1s.mp3', self.source)
+
+    def request(self):
+        self.sut.get(self.source, 32)
+        if job := self.sut.jobs.get(self.sut.variant_path(self.source, 32)):
+            with self.assertRaises(RuntimeError):
+                job.result(5)
+            self.sut.executor.submit(lambda: None).result(5)  # after finished()
+
+    def test_not_retried_until_source_changes(self):
+        self.request()
+        self.request()
+        self.assertEqual(self.sut.attempts, 1)
+
+        stat = self.source.stat()
+        os.utime(self.source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        self.request()
+
+        self.assertEqual(self.sut.attempts, 2)
+
+
+class SetupTests(TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    @mock.patch('transcoder.load_gst')
+    def test_gst_loaded_by_first_transcode_only(self, load_gst):
+        sut = VariantCache(self.tmp.name, [32])
+        sut.shutdown()
+
+        self.assertFalse(load_gst.called)
+
+    def test_partial_files_removed(self):
+        partial = Path(self.tmp.name) / 'abc-32k.part'
+        partial.write_bytes(b'half')
+
+        VariantCache(self.tmp.name, [32]).shutdown()
+
+        self.assertFalse(partial.exists())
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Time-to-first-audio breakdown of traced plays.
+
+Reads the span files (Tracing.File) of control, render and server, and prints
+every trace as a waterfall: each span's offset from the start of the trace and
+its duration. Spans of remote calls show how much of them the callee spent,
+the rest being transport and dispatch.
+
+Usage: trace_report.py <span-file>... [--trace ID]
+"""
+
+import argparse
+import json
+from collections import defaultdict
+
+BAR_WIDTH = 40
+
+
+def load_spans(paths):
+    """Spans by trace id, in start order"""
+    traces = defaultdict(list)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    span = json.loads(line)
+                    traces[span['trace']].append(span)
+
+    for spans in traces.values():
+        spans.sort(key=lambda span: (span['start'], -span['duration']))
+    return traces
+
+
+def end(span):
+    return span['start'] + span['duration']
+
+
+def within(inner, outer):
+    return inner['start'] >= outer['start'] and end(inner) <= end(outer)
+
+
+def callee_time(span, spans):
+    """Time covered by spans of other services within span"""
+    covered, reached = 0, span['start']
+    for other in spans:  # in start order
+        if other['service'] != span['service'] and within(other, span):
+            covered += max(0, end(other) - max(other['start'], reached))
+            reached = max(reached, end(other))
+    return covered
+
+
+def breakdown(spans):
+    """(offset, duration, callee, span) rows, times in seconds from the start of
+    the trace"""
+    origin = spans[0]['start']
+    return [(span['start'] - origin, span['duration'], callee_time(span, spans), span)
+            for span in spans]
+
+
+def time_to_first_audio(spans):
+    origin = spans[0]['start']
+    ends = [end(span) - origin for span in spans if span['span'] == 'first_audio']
+    return ends[0] if ends else None
+
+
+def format_trace(trace_id, spans):
+    rows = breakdown(spans)
+    total = max(offset + duration for offset, duration, _, _ in rows) or 1
+    lines = [f"Trace {trace_id}"]
+    if (ttfa := time_to_first_audio(spans)) is not None:
+        lines[0] += f": first audio after {ttfa * 1000:.1f} ms"
+
+    for offset, duration, callee, span in rows:
+        start = round(offset / total * BAR_WIDTH)
+        width = max(1, round(duration / total * BAR_WIDTH))
+        bar = ' ' * start + '#' * width
+        remote = f" (callee {callee * 1000:.1f} ms)" if callee else ''
+        lines.append(f"  {offset * 1000:8.1f} {duration * 1000:8.1f} ms "
+                     f"{bar:<{BAR_WIDTH}} {span['service']}.{span['span']}{remote}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--trace', help='only this trace id')
+    args = parser.parse_args()
+
+    traces = load_spans(args.files)
+    for trace_id, spans in traces.items():
+        if args.trace in (None, trace_id):
+            print(format_trace(trace_id, spans))
+            print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+"""Request tracing across control, render and server.
+
+A trace id travels in the Ice request context under TRACE_CONTEXT. Every
+process given a Tracing.File property appends the spans of traced requests to
+it, one JSON object per line; trace_report.py merges the files of several
+processes into a breakdown of each trace.
+"""
+
+import functools
+import json
+import os
+import threading
+from contextlib import contextmanager
+from time import monotonic, perf_counter, time
+
+TRACE_CONTEXT = 'trace-id'
+
+span_log = None  # of this process, set by configure()
+
+
+class SpanLog:
+    """Spans appended to a file shared by every traced process"""
+
+    def __init__(self, path):
+        self.file = open(path, 'a', buffering=1)
+        self.lock = threading.Lock()
+
+    def record(self, trace_id, service, name, start, duration, **attrs):
+        line = json.dumps(dict(trace=trace_id, service=service, span=name,
+                               start=start, duration=duration, pid=os.getpid(), **attrs))
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+def configure(properties):
+    """Record spans in the Tracing.File property, if set"""
+    global span_log
+    if path := properties.getProperty('Tracing.File'):
+        span_log = SpanLog(path)
+
+
+def new_trace_id():
+    return os.urandom(8).hex()
+
+
+def trace_context(trace_id):
+    return {TRACE_CONTEXT: trace_id}
+
+
+def current_trace(current):
+    """Trace id of the request being dispatched; None if it is not traced"""
+    ctx = getattr(current, 'ctx', None)  # dispatch passes an IcePy.Current
+    return ctx.get(TRACE_CONTEXT) if ctx else None
+
+
+def traced_proxy(proxy, trace_id):
+    """proxy sending trace_id along with its requests"""
+    return proxy.ice_context(trace_context(trace_id)) if trace_id else proxy
+
+
+@contextmanager
+def span(trace_id, service, name, **attrs):
+    if not (trace_id and span_log):
+        yield
+        return
+
+    start, started = time(), perf_counter()
+    try:
+        yield
+    finally:
+        span_log.record(trace_id, service, name, start, perf_counter() - started, **attrs)
+
+
+def record(trace_id, service, name, start, end, **attrs):
+    """Span between two monotonic() times already measured"""
+    if trace_id and span_log and start is not None and end is not None:
+        span_log.record(trace_id, service, name, time() - (monotonic() - start),
+                        end - start, **attrs)
+
+
+def traced(service):
+    """Servant method decorator: a span for each dispatch of a traced request"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            current = kwargs.get('current', args[-1] if args else None)
+            with span(current_trace(current), service, method.__name__):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import Ice
+
+logger = logging.getLogger("TrackCache")
+
+
+class TrackCache:
+    """Tracks streamed in full, kept on disk by track id and content version
+    within a size budget, least recently used evicted first.
+
+    Entries survive restarts: recency is kept in the file mtimes. One process
+    should own the directory; its renders share the cache.
+    """
+
+    SUFFIX = '.mp3'
+    PARTIAL_SUFFIX = '.part'
+
+    def __init__(self, directory, budget):
+        self.directory = Path(directory)
+        self.budget = budget
+        self.entries = OrderedDict()  # filename -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.load()
+
+    def stats(self):
+        return dict(size=self.size, tracks=len(self.entries), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+    def load(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path in self.directory.glob('*' + self.PARTIAL_SUFFIX):
+            path.unlink(missing_ok=True)
+
+        files = sorted(((path.stat(), path.name)
+                        for path in self.directory.glob('*' + self.SUFFIX)),
+                       key=lambda entry: entry[0].st_mtime_ns)
+        with self.lock:
+            for stat, name in files:
+                self.entries[name] = stat.st_size
+                self.size += stat.st_size
+            self.evict()
+
+        logger.info(f"{len(self.entries)} tracks cached ({self.size} bytes)")
+
+    @classmethod
+    def entry_name(cls, track):
+        """File name of track's entry; None for tracks without a version"""
+        version = getattr(track, 'version', Ice.Unset)
+        if version is Ice.Unset or not version:
+            return None
+
+        key = f'{track.id}\0{version}'.encode()
+        return hashlib.sha256(key).hexdigest()[:32] + cls.SUFFIX
+
+    def get(self, track):
+        """Path of the whole track if cached, else None"""
+        if (name := self.entry_name(track)) is None:
+            return None
+
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(name)
+            self.hits += 1
+
+        path = self.directory / name
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.discard(name)
+            return None
+        return path
+
+    def writer(self, track):
+        """CacheWriter for track, None if it can not be cached"""
+        if (name := self.entry_name(track)) is None:
+            return None
+
+        fd, path = tempfile.mkstemp(self.PARTIAL_SUFFIX, dir=self.directory)
+        return CacheWriter(self, name, os.fdopen(fd, 'wb'), Path(path))
+
+    def add(self, name, path, size):
+        with self.lock:
+            if name in self.entries or size > self.budget:
+                path.unlink(missing_ok=True)
+                return
+
+            os.replace(path, self.directory / name)
+            self.entries[name] = size
+            self.size += size
+            self.evict()
+
+        logger.info(f"Cached {name} ({size} bytes)")
+
+    def discard(self, name):
+        with self.lock:
+            if (size := self.entries.pop(name, None)) is not None:
+                self.size -= size
+        (self.directory / name).unlink(missing_ok=True)
+
+    def evict(self):
+        while self.size > self.budget:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            (self.directory / name).unlink(missing_ok=True)
+
+
+class CacheWriter:
+    """Entry being written as a track streams; it only becomes visible if the
+    whole track arrives in order"""
+
+    def __init__(self, cache, name, file, path):
+        self.cache = cache
+        self.name = name
+        self.file = file
+        self.path = path
+        self.size = 0
+
+    def write(self, data):
+        """False, and the entry dropped, if it no longer fits the budget"""
+        if self.size + len(data) > self.cache.budget:
+            self.abort()
+            return False
+
+        self.file.write(data)
+        self.size += len(data)
+        return True
+
+    def commit(self):
+        self.file.close()
+        self.cache.add(self.name, self.path, self.size)
+
+    def abort(self):
+        self.file.close()
+        self.path.unlink(missing_ok=True)
@@ -0,0 +1,141 @@
+import hashlib
+import importlib.util
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import mp3info
+
+logger = logging.getLogger("Transcoder")
+
+
+def load_gst():
+    """Gst module, initialized on first use; None if GStreamer is not installed"""
+    try:
+        import gi
+        gi.require_version('Gst', '1.0')
+        from gi.repository import Gst  # type: ignore
+    except (ImportError, ValueError):
+        return None
+
+    Gst.init(None)
+    return Gst
+
+
+class VariantCache:
+    """Lower-bitrate variants of media files, transcoded with GStreamer on first
+    request and kept on disk. Variants keep the source sample rate, so a render
+    can switch between them mid-stream.
+
+    Failed transcodes are not retried until the source changes."""
+
+    PIPELINE = ('filesrc name=src ! decodebin ! audioconvert ! audioresample ! '
+                'audio/x-raw,rate={rate} ! '
+                'lamemp3enc target=bitrate cbr=true bitrate={bitrate} ! '
+                'xingmux ! filesink name=sink')
+    TIMEOUT_SECS = 60  # allowed on top of the source duration for a transcode
+    FAILED_SIZE = 1024  # failed variants remembered
+
+    def __init__(self, cache_dir, bitrates, workers=1):
+        self.cache_dir = Path(cache_dir)
+        self.bitrates = sorted(bitrates)
+        self.executor = ThreadPoolExecutor(workers, thread_name_prefix='Transcoder')
+        self.jobs = {}  # variant path -> Future
+        self.failed = OrderedDict()  # variant path of a source version -> None
+        self.lock = threading.Lock()
+        self.gst = None  # loaded by the first transcode
+        self.gst_lock = threading.Lock()
+
+        for partial in self.cache_dir.glob('*.part'):  # left by a crash
+            partial.unlink(missing_ok=True)
+        if importlib.util.find_spec('gi') is None:
+            logger.warning("GStreamer not available, variants disabled")
+            self.bitrates = []
+        else:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def variant_path(self, filepath, bitrate):
+        stat = filepath.stat()
+        key = f'{filepath.name}:{stat.st_mtime_ns}:{stat.st_size}'
+        digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+        return self.cache_dir / f'{digest}-{bitrate}k.mp3'
+
+    def get(self, filepath, bitrate):
+        """Path of the variant, or None while it is not transcoded yet.
+
+        A miss starts the transcode in the background, so callers serve the
+        original meanwhile and find the variant cached on a later request."""
+        path = self.variant_path(filepath, bitrate)
+        if path.exists():
+            return path
+
+        with self.lock:
+            if path in self.jobs or path in self.failed:
+                return None
+            job = self.jobs[path] = self.executor.submit(
+                self.transcode, filepath, path, bitrate)
+
+        # outside the lock: a job already done runs the callback right here
+        job.add_done_callback(lambda job: self.finished(job, filepath, path, bitrate))
+        return None
+
+    def finished(self, job, filepath, path, bitrate):
+        failed = not job.cancelled() and (error := job.exception()) is not None
+        if failed:
+            logger.error(f"Transcoding '{filepath.name}' to {bitrate}k failed: {error}")
+        with self.lock:
+            self.jobs.pop(path, None)
+            if failed:
+                self.failed[path] = None
+                while len(self.failed) > self.FAILED_SIZE:
+                    self.failed.popitem(last=False)
+
+    def get_gst(self):
+        """Gst, loaded on the first transcode so servers that never transcode
+        do not pay for it"""
+        with self.gst_lock:
+            if self.gst is None and self.bitrates:
+                if (gst := load_gst()) is None:
+                    logger.warning("GStreamer not usable, variants disabled")
+                    self.bitrates = []
+                self.gst = gst
+            return self.gst
+
+    def transcode(self, source, target, bitrate):
+        if (Gst := self.get_gst()) is None:
+            raise RuntimeError("GStreamer not available")
+
+        try:
+            info = mp3info.probe(source)
+            sample_rate, duration = info.sample_rate, info.duration
+        except ValueError:
+            sample_rate, duration = 44100, 0
+
+        partial = target.with_suffix('.part')
+        try:
+            pipeline = Gst.parse_launch(
+                self.PIPELINE.format(rate=sample_rate, bitrate=bitrate))
+            pipeline.get_by_name('src').set_property('location', str(source))
+            pipeline.get_by_name('sink').set_property('location', str(partial))
+
+            pipeline.set_state(Gst.State.PLAYING)
+            timeout = duration * Gst.MSECOND + self.TIMEOUT_SECS * Gst.SECOND
+            message = pipeline.get_bus().timed_pop_filtered(
+                timeout, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+            pipeline.set_state(Gst.State.NULL)
+
+            if message is None:
+                raise TimeoutError(f"Not done within {timeout // Gst.SECOND} s")
+            if message.type == Gst.MessageType.ERROR:
+                raise RuntimeError(message.parse_error()[0].message)
+
+            partial.rename(target)
+        finally:
+            partial.unlink(missing_ok=True)
+
+        logger.info(f"Transcoded '{source.name}' to {bitrate}k")
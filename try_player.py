@@ -5,7 +5,6 @@ import time
 from gst_player import GstPlayer
 
 player = GstPlayer()
-player.start()
 
 with open('test/media/4s.mp3', 'rb') as fd:
     player.configure(fd.read)